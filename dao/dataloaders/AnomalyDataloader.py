@@ -5,27 +5,34 @@
 # @Copy From:
 
 
-from torch.utils.data import DataLoader
-
 from dao.register import Registers
 from dao.dataloaders.augments import get_transformer
+from dao.dataloaders.dataloading import DataLoader, get_worker_kwargs
 
 
 @Registers.dataloaders.register
 class MVTecDataloader(DataLoader):
-    def __init__(self, dataset, batch_size=1, num_workers=0, shuffle=False):
+    def __init__(self, dataset, batch_size=1, num_workers=0, shuffle=False,
+                 persistent_workers=False, prefetch_factor=None):
+        """
+        dataset:DotMap 数据集配置
+        batch_size:int batchsize大小
+        num_workers:int 读取数据进程数
+        shuffle:bool 是否打乱数据
+        persistent_workers:bool 是否保留worker进程, 多次迭代同一个dataloader时避免重复启动worker
+        prefetch_factor:int 每个worker预加载的batch数, None为torch默认值
+        """
         dataset = Registers.datasets.get(dataset.type)(
             preproc=get_transformer(dataset.transforms.kwargs), **dataset.kwargs)
         super(MVTecDataloader, self).__init__(
             dataset=dataset,
             batch_size=batch_size,
             shuffle=shuffle,
-            num_workers=num_workers
+            **get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
         )
 
 
 if __name__ == "__main__":
-    from dao.dataloaders.augments import get_transformer
     from dotmap import DotMap
     dataloader_c = {
         "dataset": {
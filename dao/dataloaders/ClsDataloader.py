@@ -11,14 +11,15 @@ import torch.multiprocessing
 from torch import distributed as dist
 
 from .augments import get_transformer
-from dao.dataloaders.dataloading import DataLoader, worker_init_reset_seed
-from dao.dataloaders.samplers import InfiniteSampler, BatchSampler
+from dao.dataloaders.dataloading import DataLoader, worker_init_reset_seed, get_worker_kwargs
+from dao.dataloaders.samplers import InfiniteSampler, BatchSampler, InferenceSampler
 from dao.utils import wait_for_the_master, get_local_rank, get_world_size
 from dao.register import Registers
 
 
 @Registers.dataloaders.register
-def ClsDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None, dataset=None, seed=0, **kwargs):
+def ClsDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None, dataset=None, seed=0,
+                       persistent_workers=False, prefetch_factor=None, **kwargs):
     """
     ClsDataset的dataloader类
 
@@ -26,6 +27,8 @@ def ClsDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
     batch_size: int batchsize大小，多个GPU的batchsize总和
     num_workers:int 使用线程数
     dataset:ClsDataset类 数据集类的实例
+    persistent_workers:bool 是否保留worker进程
+    prefetch_factor:int 每个worker预加载的batch数, None为torch默认值
     """
     # 获得local_rank
     local_rank = get_local_rank()
@@ -51,7 +54,8 @@ def ClsDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
     )
 
     # dataloader的kwargs配置
-    dataloader_kwargs = {"num_workers": num_workers, "pin_memory": True}
+    dataloader_kwargs = get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+    dataloader_kwargs["pin_memory"] = True
     dataloader_kwargs["batch_sampler"] = batch_sampler
     # Make sure each process has different random seed, especially for 'fork' method.
     # Check https://github.com/pytorch/pytorch/issues/63311 for more details.
@@ -62,7 +66,8 @@ def ClsDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
 
 
 @Registers.dataloaders.register
-def ClsDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, dataset=None, **kwargs):
+def ClsDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, dataset=None,
+                      persistent_workers=True, prefetch_factor=None, **kwargs):
     """
     ClsDataset的dataloader类
 
@@ -70,6 +75,8 @@ def ClsDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, d
     batch_size: int batchsize大小，多个GPU的batchsize总和
     num_workers:int 使用线程数
     dataset:ClsDataset类 配置字典
+    persistent_workers:bool 是否保留worker进程，默认True, 避免每次验证都重新启动worker
+    prefetch_factor:int 每个worker预加载的batch数, None为torch默认值
     """
     val_dataset = Registers.datasets.get(dataset.type)(
         preproc=get_transformer(dataset.transforms.kwargs),
@@ -77,13 +84,15 @@ def ClsDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, d
     )
     if is_distributed:
         batch_size = batch_size // get_world_size()
-        sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+        # 不使用DistributedSampler, 因为它会用重复样本填充最后的分片，导致验证指标偏差
+        sampler = InferenceSampler(len(val_dataset))
     else:
-        sampler = torch.utils.data.SequentialSampler(val_dataset)
+        sampler = InferenceSampler(len(val_dataset), rank=0, world_size=1)   # 不切分, 支持set_subset(也用于只在rank0上异步验证)
 
-    dataloader_kwargs = {"num_workers": num_workers, "pin_memory": True, "sampler": sampler, "batch_size": batch_size}
+    dataloader_kwargs = get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+    dataloader_kwargs.update({"pin_memory": True, "sampler": sampler, "batch_size": batch_size})
 
-    dataloader = torch.utils.data.DataLoader(val_dataset, **dataloader_kwargs)
+    dataloader = DataLoader(val_dataset, **dataloader_kwargs)
     return dataloader
 
 
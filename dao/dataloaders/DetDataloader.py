@@ -9,8 +9,8 @@ from loguru import logger
 import torch
 import torch.multiprocessing
 
-from dao.dataloaders.dataloading import DataLoader, worker_init_reset_seed, detection_collate
-from dao.dataloaders.samplers import InfiniteSampler, BatchSampler
+from dao.dataloaders.dataloading import DataLoader, worker_init_reset_seed, DetectionCollate, get_worker_kwargs
+from dao.dataloaders.samplers import InfiniteSampler, BatchSampler, InferenceSampler
 from dao.utils import wait_for_the_master, get_local_rank, get_world_size
 from dao.dataloaders.augments import get_transformerYOLO, get_transformer
 
@@ -18,7 +18,8 @@ from dao.register import Registers
 
 
 @Registers.dataloaders.register
-def DetDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None, dataset=None, seed=0, no_aug=False):
+def DetDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None, dataset=None, seed=0, no_aug=False,
+                       persistent_workers=False, prefetch_factor=None, max_boxes=None):
     """
     Function： 目标检测DetDataset的数据加载DataLoader
 
@@ -28,6 +29,10 @@ def DetDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
     :param dataset: DotMap 数据集配置， 详细看configs文件夹下的内容
     :param seed: int 随机种子
     :param no_aug: bool 是否进行数据增强
+    :param persistent_workers: bool 是否保留worker进程
+    :param prefetch_factor: int 每个worker预加载的batch数, None为torch默认值
+    :param max_boxes: int 每张图片最多的bbox数量, 设置后targets填充为[B, max_boxes, 6], 并额外返回counts[B];
+        None时targets为[N, 6]
     :return:
         返回dataloader对象
     """
@@ -52,12 +57,13 @@ def DetDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
     batch_sampler = BatchSampler(sampler=sampler, batch_size=batch_size, drop_last=False)
 
     # 6. dataloader的kwargs配置
-    dataloader_kwargs = {"num_workers": num_workers, "pin_memory": True}
+    dataloader_kwargs = get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+    dataloader_kwargs["pin_memory"] = True
     dataloader_kwargs["batch_sampler"] = batch_sampler
     # Make sure each process has different random seed, especially for 'fork' method.
     # Check https://github.com/pytorch/pytorch/issues/63311 for more details.
     dataloader_kwargs["worker_init_fn"] = worker_init_reset_seed
-    dataloader_kwargs["collate_fn"] = detection_collate
+    dataloader_kwargs["collate_fn"] = DetectionCollate(max_boxes=max_boxes)
 
     # 7. 生成Dataloader类， 具体看dataloading文件内容
     train_loader = DataLoader(dataset_Det, **dataloader_kwargs)
@@ -65,7 +71,8 @@ def DetDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
 
 
 @Registers.dataloaders.register
-def DetDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, dataset=None):
+def DetDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, dataset=None,
+                      persistent_workers=True, prefetch_factor=None):
     """
     Function： 目标检测DetDataset的数据加载DataLoader
 
@@ -74,7 +81,8 @@ def DetDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, d
     :param num_workers: int 读取数据线程数，每个rank的读取数据的线程数
     :param dataset: DotMap 数据集配置， 详细看configs文件夹下的内容
     :param seed: int 随机种子
-    :param no_aug: bool 是否进行数据增强
+    :param persistent_workers: bool 是否保留worker进程，默认True, 避免每次验证都重新启动worker
+    :param prefetch_factor: int 每个worker预加载的batch数, None为torch默认值
     :return:
         返回dataloader对象
     """
@@ -88,16 +96,18 @@ def DetDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, d
     # 2. 如果是分布式，batch size需要改变。 例如有2个机器，每个有8张卡，batchsize为16，那么每张卡可得到1张图片
     if is_distributed:
         batch_size = batch_size // get_world_size()
-        sampler = torch.utils.data.distributed.DistributedSampler(valdataset, shuffle=False)
+        # 不使用DistributedSampler, 因为它会用重复样本填充最后的分片，导致验证指标偏差
+        sampler = InferenceSampler(len(valdataset))
     else:
-        sampler = torch.utils.data.SequentialSampler(valdataset)
+        sampler = InferenceSampler(len(valdataset), rank=0, world_size=1)   # 不切分, 支持set_subset(也用于只在rank0上异步验证)
 
     # 3. dataloader的kwargs配置
-    dataloader_kwargs = {"num_workers": num_workers, "pin_memory": True, "batch_size":batch_size}
-    dataloader_kwargs["collate_fn"] = detection_collate
+    dataloader_kwargs = get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+    dataloader_kwargs.update({"pin_memory": True, "sampler": sampler, "batch_size": batch_size})
+    dataloader_kwargs["collate_fn"] = DetectionCollate()
 
     # 4. 生成Dataloader类， 具体看dataloading文件内容
-    val_loader = torch.utils.data.DataLoader(valdataset, **dataloader_kwargs)
+    val_loader = DataLoader(valdataset, **dataloader_kwargs)
     return val_loader
 
 
@@ -10,18 +10,21 @@ import torch.multiprocessing
 from dao.dataloaders.augments import get_transformer
 from dao.register import Registers
 from dao.utils import wait_for_the_master, get_local_rank, get_world_size
-from dao.dataloaders.dataloading import DataLoader, worker_init_reset_seed
-from dao.dataloaders.samplers import InfiniteSampler, BatchSampler
+from dao.dataloaders.dataloading import DataLoader, worker_init_reset_seed, get_worker_kwargs
+from dao.dataloaders.samplers import InfiniteSampler, BatchSampler, InferenceSampler
 
 
 @Registers.dataloaders.register
-def SegDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None, dataset=None, seed=0):
+def SegDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None, dataset=None, seed=0,
+                       persistent_workers=False, prefetch_factor=None):
     """
     is_distributed : bool 是否是分布式
     batch_size : int batchsize大小
     num_workers : int 读取数据线程数
     dataset : DotMap 数据集配置
     seed : int 随机种子
+    persistent_workers : bool 是否保留worker进程
+    prefetch_factor : int 每个worker预加载的batch数, None为torch默认值
     """
     # 获得local_rank
     local_rank = get_local_rank()
@@ -48,7 +51,8 @@ def SegDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
     )
 
     # dataloader的kwargs配置
-    dataloader_kwargs = {"num_workers": num_workers, "pin_memory": True}
+    dataloader_kwargs = get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+    dataloader_kwargs["pin_memory"] = True
     dataloader_kwargs["batch_sampler"] = batch_sampler
     # Make sure each process has different random seed, especially for 'fork' method.
     # Check https://github.com/pytorch/pytorch/issues/63311 for more details.
@@ -59,13 +63,15 @@ def SegDataloaderTrain(is_distributed=False, batch_size=None, num_workers=None,
 
 
 @Registers.dataloaders.register
-def SegDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, dataset=None):
+def SegDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, dataset=None,
+                      persistent_workers=True, prefetch_factor=None):
     """
     is_distributed : bool 是否是分布式
     batch_size : int batchsize大小
     num_workers : int 读取数据线程数
     dataset : DotMap 数据集配置
-    seed : int 随机种子
+    persistent_workers : bool 是否保留worker进程，默认True, 避免每次验证都重新启动worker
+    prefetch_factor : int 每个worker预加载的batch数, None为torch默认值
     """
     val_dataset = Registers.datasets.get(dataset.type)(
         preproc=get_transformer(dataset.transforms.kwargs),
@@ -73,12 +79,14 @@ def SegDataloaderEval(is_distributed=False, batch_size=None, num_workers=None, d
     )
     if is_distributed:
         batch_size = batch_size // get_world_size()
-        sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+        # 不使用DistributedSampler, 因为它会用重复样本填充最后的分片，导致验证指标偏差
+        sampler = InferenceSampler(len(val_dataset))
     else:
-        sampler = torch.utils.data.SequentialSampler(val_dataset)
+        sampler = InferenceSampler(len(val_dataset), rank=0, world_size=1)   # 不切分, 支持set_subset(也用于只在rank0上异步验证)
 
-    dataloader_kwargs = {"num_workers": num_workers, "pin_memory": True, "sampler": sampler, "batch_size":batch_size}
-    val_loader = torch.utils.data.DataLoader(val_dataset, **dataloader_kwargs)
+    dataloader_kwargs = get_worker_kwargs(num_workers, persistent_workers, prefetch_factor)
+    dataloader_kwargs.update({"pin_memory": True, "sampler": sampler, "batch_size": batch_size})
+    val_loader = DataLoader(val_dataset, **dataloader_kwargs)
     return val_loader
 
 
@@ -7,6 +7,12 @@
 # albumentations数据增强
 from .data_augment import get_transformer, get_transformerYOLO
 
+# 自定义增强，注册到Registers.transforms
+from . import custom
+
+# GPU batch数据增强，在prefetcher拷贝到GPU之后执行
+from .gpu_augment import get_transformerGPU, GPUCompose, GPUTransform
+
 # torchvision数据增强，自己定义的。 for yolox
 from .data_augment_yolox import (
     ValTransform,
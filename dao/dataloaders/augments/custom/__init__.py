@@ -4,3 +4,5 @@
 # @Date: 2021.10.1
 # @github:https://github.com/felixfu520
 
+# 自定义增强, 通过Registers.transforms注册, 配置中使用注册名
+from .histogram import Custom as Histogram
@@ -9,7 +9,10 @@ import numpy as np
 
 from albumentations.core.transforms_interface import ImageOnlyTransform
 
+from dao.register import Registers
 
+
+@Registers.transforms.register("histogram")
 class Custom(ImageOnlyTransform):
     def apply(self, img, **params):
         return histogram_fn(img)
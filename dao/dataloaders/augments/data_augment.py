@@ -9,45 +9,71 @@ The data augmentation procedures were interpreted from @weiliu89's SSD paper
 http://arxiv.org/abs/1512.02325
 """
 
-import importlib
+import json
 import albumentations
 
+from dao.register import Registers
 
-def get_transformer(transform_params):
+# 已构建的增强pipeline, key为(pipeline类型, transform配置), 同一进程中相同配置只构建一次
+_TRANSFORMS_CACHE = {}
+
+
+def _config_key(kind, transform_params):
+    """将transform配置(DotMap/dict)转为可hash的key, 保留配置顺序"""
+    if hasattr(transform_params, "toDict"):
+        transform_params = transform_params.toDict()
+    return kind, json.dumps(transform_params, default=str)
+
+
+def _build_transforms(transform_params):
+    """
+    Function: 通过配置构建单个增强列表
+        优先从Registers.transforms中获取(自定义增强), 其次为albumentations中的增强
+
+    :param transform_params:transform参数
+    :return: list
+    """
     trans_albumentations = []
-    for i, (k, v) in enumerate(transform_params.items()):
-        if getattr(albumentations, k, False):
+    for k, v in transform_params.items():
+        if k in Registers.transforms:
+            trans_albumentations.append(Registers.transforms.get(k)(**v))
+        elif getattr(albumentations, k, False):
             trans_albumentations.append(getattr(albumentations, k)(**v))
         else:
-            custom = importlib.import_module(
-                "dao.dataloaders.augments.custom.{}".format(k)).Custom(v)
-            trans_albumentations.append(custom)
-    return albumentations.Compose(trans_albumentations)
+            raise KeyError("transform {} not found in Registers.transforms or albumentations".format(k))
+    return trans_albumentations
+
+
+def get_transformer(transform_params):
+    """
+    Function: 对图片(和mask)进行增强, 相同配置返回缓存的pipeline
+
+    :param transform_params:transform参数
+    :return: albumentations.Compose
+    """
+    key = _config_key("default", transform_params)
+    if key not in _TRANSFORMS_CACHE:
+        _TRANSFORMS_CACHE[key] = albumentations.Compose(_build_transforms(transform_params))
+    return _TRANSFORMS_CACHE[key]
 
 
 def get_transformerYOLO(transform_params):
     """
-    Function: 对目标检测数据进行增强
+    Function: 对目标检测数据进行增强, 相同配置返回缓存的pipeline
 
     :param transform_params:transform参数
     :return:
     """
-    trans_albumentations = []
-    for i, (k, v) in enumerate(transform_params.items()):
-        if getattr(albumentations, k, False):
-            trans_albumentations.append(getattr(albumentations, k)(**v))
-        else:
-            custom = importlib.import_module(
-                "dao.dataloaders.augments.custom.{}".format(k)).Custom(v)
-            trans_albumentations.append(custom)
-    return albumentations.Compose(
-        trans_albumentations,
-        bbox_params=albumentations.BboxParams(
-            # format='albumentations',
-            format='yolo',
-            label_fields=['class_labels'],
-            min_area=0.0,
-            min_visibility=0.0
+    key = _config_key("yolo", transform_params)
+    if key not in _TRANSFORMS_CACHE:
+        _TRANSFORMS_CACHE[key] = albumentations.Compose(
+            _build_transforms(transform_params),
+            bbox_params=albumentations.BboxParams(
+                # format='albumentations',
+                format='yolo',
+                label_fields=['class_labels'],
+                min_area=0.0,
+                min_visibility=0.0
+            )
         )
-    )
-
+    return _TRANSFORMS_CACHE[key]
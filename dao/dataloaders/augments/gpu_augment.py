@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# @auther:FelixFu
+# @Date: 2021.10.1
+# @github:https://github.com/felixfu520
+"""
+GPU batch数据增强
+
+    与get_transformer使用相同的配置键(Flip, Normalize, RandomResizedCrop, ColorJitter ...),
+    但对prefetcher拷贝到GPU之后的整个batch进行增强, 每张图片的随机参数独立采样。
+    几何变换对image, mask, bboxes使用同一组参数, 保证三者一致。
+
+    image: tensor [B, C, H, W], Normalize之前的像素范围为[0, max_pixel_value]
+    mask: tensor [B, H, W], 分割标签
+    bboxes: tensor [N, 6] 或 DetectionCollate(max_boxes)填充后的 [B, max_boxes, 6],
+            6为(batch_idx, class, cx, cy, w, h), 坐标为归一化后的值
+    counts: tensor [B] 填充bboxes时每张图片的bbox数量(可选), 丢弃bbox的增强会同时更新counts
+"""
+import math
+from loguru import logger
+
+import torch
+import torch.nn.functional as F
+
+from dao.register import Registers
+
+
+def _expand(cond, x):
+    """将每张图片的条件[B]扩展到x的维度, 用于torch.where"""
+    return cond.view(-1, *([1] * (x.dim() - 1)))
+
+
+def _per_box(param, bboxes):
+    """将每张图片的参数[B]对齐到每个bbox"""
+    if bboxes.dim() == 3:
+        return param[:, None].expand(bboxes.shape[:2])
+    return param[bboxes[:, 0].long()]
+
+
+def _valid_boxes(bboxes, counts=None):
+    """有效的bbox: 有counts时为每张图片的前counts个, 否则按填充的bbox(cx,cy,w,h)全为0判断"""
+    if counts is not None and bboxes.dim() == 3:
+        return torch.arange(bboxes.shape[1], device=bboxes.device)[None] < counts[:, None]
+    return bboxes[..., 4:6].sum(dim=-1) > 0
+
+
+class GPUTransform:
+    def __init__(self, p=0.5, always_apply=False, **kwargs):
+        """
+        Function: GPU batch增强的基类, 子类实现apply
+
+        :param p: float 每张图片进行此增强的概率
+        :param always_apply: bool 与albumentations相同, 为True时p=1
+        :param kwargs: albumentations中有但GPU实现不支持的参数, 忽略
+        """
+        self.p = 1. if always_apply else p
+        if kwargs:
+            logger.warning("{} ignores unsupported params: {}".format(self.__class__.__name__, list(kwargs.keys())))
+
+    def __call__(self, sample):
+        image = sample["image"]
+        apply = torch.rand(image.shape[0], device=image.device) < self.p
+        return self.apply(sample, apply)
+
+    def apply(self, sample, apply):
+        raise NotImplementedError
+
+
+def _flip(sample, cond, dim):
+    """对cond为True的图片进行翻转, dim=-1为水平翻转, dim=-2为垂直翻转"""
+    image = sample["image"]
+    sample["image"] = torch.where(_expand(cond, image), image.flip(dim), image)
+    if sample.get("mask") is not None:
+        mask = sample["mask"]
+        sample["mask"] = torch.where(_expand(cond, mask), mask.flip(dim), mask)
+    if sample.get("bboxes") is not None:
+        bboxes = sample["bboxes"]
+        col = 2 if dim == -1 else 3  # cx or cy
+        box_cond = _per_box(cond, bboxes) & _valid_boxes(bboxes, sample.get("counts"))
+        bboxes[..., col] = torch.where(box_cond, 1 - bboxes[..., col], bboxes[..., col])
+    return sample
+
+
+@Registers.gpu_transforms.register
+class HorizontalFlip(GPUTransform):
+    def apply(self, sample, apply):
+        return _flip(sample, apply, -1)
+
+
+@Registers.gpu_transforms.register
+class VerticalFlip(GPUTransform):
+    def apply(self, sample, apply):
+        return _flip(sample, apply, -2)
+
+
+@Registers.gpu_transforms.register
+class Flip(GPUTransform):
+    def apply(self, sample, apply):
+        # 与albumentations相同, d=-1:水平+垂直, d=0:垂直, d=1:水平
+        d = torch.randint(-1, 2, apply.shape, device=apply.device)
+        sample = _flip(sample, apply & (d != 0), -1)
+        return _flip(sample, apply & (d != 1), -2)
+
+
+@Registers.gpu_transforms.register
+class Normalize(GPUTransform):
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), max_pixel_value=255.0, p=1.0, **kwargs):
+        super().__init__(p=p, **kwargs)
+        self.mean = torch.tensor(mean, dtype=torch.float32) * max_pixel_value
+        self.std = torch.tensor(std, dtype=torch.float32) * max_pixel_value
+
+    def apply(self, sample, apply):
+        image = sample["image"]
+        mean = self.mean.to(image.device, image.dtype).view(1, -1, 1, 1)
+        std = self.std.to(image.device, image.dtype).view(1, -1, 1, 1)
+        sample["image"] = torch.where(_expand(apply, image), (image - mean) / std, image)
+        return sample
+
+
+@Registers.gpu_transforms.register
+class RandomBrightnessContrast(GPUTransform):
+    def __init__(self, brightness_limit=0.2, contrast_limit=0.2, brightness_by_max=True, max_pixel_value=255.0,
+                 p=0.5, **kwargs):
+        super().__init__(p=p, **kwargs)
+        self.brightness_limit = brightness_limit if isinstance(brightness_limit, (list, tuple)) \
+            else (-brightness_limit, brightness_limit)
+        self.contrast_limit = contrast_limit if isinstance(contrast_limit, (list, tuple)) \
+            else (-contrast_limit, contrast_limit)
+        self.brightness_by_max = brightness_by_max
+        self.max_pixel_value = max_pixel_value
+
+    def apply(self, sample, apply):
+        image = sample["image"]
+        b = image.shape[0]
+        alpha = 1 + torch.empty(b, device=image.device, dtype=image.dtype).uniform_(*self.contrast_limit)
+        beta = torch.empty(b, device=image.device, dtype=image.dtype).uniform_(*self.brightness_limit)
+        if self.brightness_by_max:
+            beta = beta * self.max_pixel_value
+        else:
+            beta = beta * image.mean(dim=(1, 2, 3))
+        out = (image * _expand(alpha, image) + _expand(beta, image)).clamp_(0, self.max_pixel_value)
+        sample["image"] = torch.where(_expand(apply, image), out, image)
+        return sample
+
+
+@Registers.gpu_transforms.register
+class ColorJitter(GPUTransform):
+    def __init__(self, brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2, max_pixel_value=255.0, p=0.5, **kwargs):
+        """
+        与albumentations.ColorJitter相同的参数, 依次进行brightness, contrast, saturation, hue变换(顺序固定)
+            hue使用YIQ空间的旋转近似, saturation和hue只对3通道图像生效
+        """
+        super().__init__(p=p, **kwargs)
+        self.brightness = self._range(brightness, 1)
+        self.contrast = self._range(contrast, 1)
+        self.saturation = self._range(saturation, 1)
+        self.hue = self._range(hue, 0)
+        self.max_pixel_value = max_pixel_value
+
+    @staticmethod
+    def _range(value, center):
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+        return (max(center - value, 0) if center else -value), center + value
+
+    @staticmethod
+    def _gray(image):
+        r, g, b = image.unbind(dim=1)
+        return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+    def _factor(self, image, value_range):
+        return _expand(torch.empty(image.shape[0], device=image.device, dtype=image.dtype).uniform_(*value_range), image)
+
+    def apply(self, sample, apply):
+        image = sample["image"]
+        out = image * self._factor(image, self.brightness)
+        mean = out.mean(dim=(1, 2, 3), keepdim=True) if out.shape[1] != 3 else self._gray(out).mean(dim=(2, 3), keepdim=True)
+        c = self._factor(image, self.contrast)
+        out = out * c + mean * (1 - c)
+        if out.shape[1] == 3:
+            s = self._factor(image, self.saturation)
+            out = out * s + self._gray(out) * (1 - s)
+            theta = torch.empty(image.shape[0], device=image.device).uniform_(*self.hue) * 2 * math.pi
+            cos, sin = torch.cos(theta), torch.sin(theta)
+            # RGB -> YIQ, 旋转IQ平面, 再转回RGB
+            rgb2yiq = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]],
+                                   device=image.device)
+            yiq2rgb = torch.linalg.inv(rgb2yiq)
+            rot = torch.zeros(image.shape[0], 3, 3, device=image.device)
+            rot[:, 0, 0] = 1
+            rot[:, 1, 1], rot[:, 1, 2], rot[:, 2, 1], rot[:, 2, 2] = cos, -sin, sin, cos
+            matrix = (yiq2rgb @ rot @ rgb2yiq).to(image.dtype)  # [B, 3, 3]
+            out = torch.einsum("bij,bjhw->bihw", matrix, out)
+        out = out.clamp_(0, self.max_pixel_value)
+        sample["image"] = torch.where(_expand(apply, image), out, image)
+        return sample
+
+
+@Registers.gpu_transforms.register
+class Resize(GPUTransform):
+    def __init__(self, height, width, p=1.0, **kwargs):
+        super().__init__(p=1.0, **kwargs)  # batch中的图片大小必须一致, 总是执行
+        self.size = (height, width)
+
+    def apply(self, sample, apply):
+        sample["image"] = F.interpolate(sample["image"], size=self.size, mode="bilinear", align_corners=False)
+        if sample.get("mask") is not None:
+            mask = sample["mask"]
+            sample["mask"] = F.interpolate(mask[:, None].float(), size=self.size, mode="nearest")[:, 0].to(mask.dtype)
+        return sample  # bboxes为归一化坐标, 不变
+
+
+@Registers.gpu_transforms.register
+class RandomResizedCrop(GPUTransform):
+    def __init__(self, height, width, scale=(0.08, 1.0), ratio=(0.75, 1.3333333333333333), min_visibility=0.,
+                 p=1.0, **kwargs):
+        """
+        每张图片随机裁剪后resize到(height, width), 未执行的图片直接resize
+            使用affine_grid+grid_sample, 整个batch一次完成; 裁剪比例超出图片时截断到整张图片(albumentations为重试10次)
+        :param min_visibility: float bbox裁剪后保留面积比例小于此值时丢弃
+        """
+        super().__init__(p=p, **kwargs)
+        self.size = (height, width)
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.min_visibility = min_visibility
+
+    def apply(self, sample, apply):
+        image = sample["image"]
+        b, _, h, w = image.shape
+        device = image.device
+
+        # 1. 每张图片的裁剪区域, 归一化的(x0, y0, cw, ch)
+        area = torch.empty(b, device=device).uniform_(*self.scale)
+        ratio = torch.exp(torch.empty(b, device=device).uniform_(*self.log_ratio))
+        cw = torch.sqrt(area * ratio * h / w).clamp_(max=1)
+        ch = torch.sqrt(area / ratio * w / h).clamp_(max=1)
+        cw = torch.where(apply, cw, torch.ones_like(cw))
+        ch = torch.where(apply, ch, torch.ones_like(ch))
+        x0 = torch.rand(b, device=device) * (1 - cw)
+        y0 = torch.rand(b, device=device) * (1 - ch)
+
+        # 2. image和mask使用同一个grid
+        theta = torch.zeros(b, 2, 3, device=device)
+        theta[:, 0, 0], theta[:, 0, 2] = cw, 2 * x0 + cw - 1
+        theta[:, 1, 1], theta[:, 1, 2] = ch, 2 * y0 + ch - 1
+        grid = F.affine_grid(theta.to(image.dtype), (b, image.shape[1]) + self.size, align_corners=False)
+        sample["image"] = F.grid_sample(image, grid, mode="bilinear", padding_mode="border", align_corners=False)
+        if sample.get("mask") is not None:
+            mask = sample["mask"]
+            sample["mask"] = F.grid_sample(mask[:, None].to(grid.dtype), grid, mode="nearest",
+                                           padding_mode="border", align_corners=False)[:, 0].to(mask.dtype)
+
+        # 3. bboxes变换到裁剪区域, 并丢弃裁剪后不可见的bbox
+        if sample.get("bboxes") is not None:
+            bboxes = sample["bboxes"]
+            bx0, by0 = _per_box(x0, bboxes), _per_box(y0, bboxes)
+            bcw, bch = _per_box(cw, bboxes), _per_box(ch, bboxes)
+            cx, cy, bw, bh = bboxes[..., 2], bboxes[..., 3], bboxes[..., 4], bboxes[..., 5]
+            x1 = ((cx - bw / 2 - bx0) / bcw).clamp(0, 1)
+            x2 = ((cx + bw / 2 - bx0) / bcw).clamp(0, 1)
+            y1 = ((cy - bh / 2 - by0) / bch).clamp(0, 1)
+            y2 = ((cy + bh / 2 - by0) / bch).clamp(0, 1)
+            visible = (x2 - x1) * (y2 - y1) * bcw * bch
+            keep = _valid_boxes(bboxes, sample.get("counts")) & (x2 > x1) & (y2 > y1) & \
+                (visible >= self.min_visibility * bw * bh)
+            new = torch.stack([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1], dim=-1)
+            bboxes[..., 2:] = torch.where(keep[..., None], new, torch.zeros_like(new))
+            sample["bboxes"] = _compact_boxes(bboxes, keep)
+            if sample.get("counts") is not None:
+                sample["counts"] = keep.sum(dim=1)
+        return sample
+
+
+def _compact_boxes(bboxes, keep):
+    """
+    丢弃keep为False的bbox
+        [N, 6]: 直接索引
+        [B, max_boxes, 6]: 保持有效bbox在前(YOLOX head按labels[b, :num_gt]读取), 丢弃的行置0
+    """
+    if bboxes.dim() == 2:
+        return bboxes[keep]
+    order = torch.sort(keep.int(), dim=1, descending=True, stable=True)[1]
+    bboxes = torch.gather(bboxes, 1, order[..., None].expand_as(bboxes))
+    bboxes[..., 1] = torch.where(torch.gather(keep, 1, order), bboxes[..., 1], torch.zeros_like(bboxes[..., 1]))
+    return bboxes
+
+
+class GPUCompose:
+    def __init__(self, transforms):
+        """
+        Function: 依次执行GPU batch增强, 调用方式与albumentations.Compose相同
+
+        :param transforms: list of GPUTransform
+        """
+        self.transforms = transforms
+
+    @torch.no_grad()
+    def __call__(self, image, mask=None, bboxes=None, counts=None):
+        """
+        :param image: tensor [B, C, H, W]
+        :param mask: tensor [B, H, W]
+        :param bboxes: tensor [N, 6] or [B, max_boxes, 6]
+        :param counts: tensor [B] bboxes为[B, max_boxes, 6]时每张图片的bbox数量
+        :return: dict, 与输入相同的keys
+        """
+        sample = {"image": image if image.is_floating_point() else image.float()}
+        if mask is not None:
+            sample["mask"] = mask
+        if bboxes is not None:
+            sample["bboxes"] = bboxes.clone()
+        if counts is not None:
+            sample["counts"] = counts
+        for t in self.transforms:
+            sample = t(sample)
+        return sample
+
+    def __repr__(self):
+        return "GPUCompose({})".format(", ".join(t.__class__.__name__ for t in self.transforms))
+
+
+def get_transformerGPU(transform_params):
+    """
+    Function: 构建GPU batch增强, 配置与get_transformer相同, 增强名从Registers.gpu_transforms中获取
+
+    :param transform_params: transform参数
+    :return: GPUCompose
+    """
+    transforms = []
+    for k, v in transform_params.items():
+        transforms.append(Registers.gpu_transforms.get(k)(**v))
+    return GPUCompose(transforms)
@@ -3,9 +3,11 @@
 # Copyright (c) Megvii, Inc. and its affiliates.
 
 import random
+import time
 import uuid
 
 import numpy as np
+from loguru import logger
 
 import torch
 from torch.utils.data.dataloader import DataLoader as torchDataLoader
@@ -27,6 +29,7 @@ class DataLoader(torchDataLoader):
         super().__init__(*args, **kwargs)
         self.__initialized = False
         shuffle = False
+        sampler = None
         batch_sampler = None
         if len(args) > 5:
             shuffle = args[2]
@@ -67,12 +70,57 @@ class DataLoader(torchDataLoader):
             # batch_sampler = IterationBasedBatchSampler(batch_sampler, num_iterations =
 
         self.batch_sampler = batch_sampler
+        self._startup_logged = False    # 是否已记录过worker启动时间
 
         self.__initialized = True
 
     def close_mosaic(self):
         self.batch_sampler.mosaic = False
 
+    def __iter__(self):
+        """
+        Function: 记录worker启动时间和首个batch的延迟，用于调优num_workers, persistent_workers, prefetch_factor。
+            只在第一次迭代或worker真正启动时记录; persistent_workers=True时复用worker, 之后的迭代不再记录
+        """
+        workers_start = self.num_workers > 0 and (not self.persistent_workers or self._iterator is None)
+        if self._startup_logged and not workers_start:
+            yield from super().__iter__()
+            return
+        self._startup_logged = True
+        start_time = time.time()
+        iterator = super().__iter__()
+        startup_time = time.time() - start_time
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return
+        first_batch_time = time.time() - start_time - startup_time
+        logger.info("{} dataloader: workers startup {:.3f}s, first batch {:.3f}s "
+                    "(num_workers={}, persistent_workers={}, prefetch_factor={})".format(
+                        type(self.dataset).__name__, startup_time, first_batch_time,
+                        self.num_workers, self.persistent_workers,
+                        self.prefetch_factor if self.num_workers > 0 else None))
+        yield batch
+        yield from iterator
+
+
+def get_worker_kwargs(num_workers=0, persistent_workers=False, prefetch_factor=None):
+    """
+    Function: 生成DataLoader中与worker相关的kwargs
+        persistent_workers与prefetch_factor只有在num_workers>0时才能设置，否则torch会报错
+
+    :param num_workers: int 读取数据的进程数
+    :param persistent_workers: bool 迭代结束后是否保留worker进程，避免每次验证重新fork/spawn进程、import模块、打开文件
+    :param prefetch_factor: int 每个worker预先加载的batch数，None使用torch默认值
+    :return: dict
+    """
+    kwargs = {"num_workers": num_workers}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = persistent_workers
+        if prefetch_factor is not None:
+            kwargs["prefetch_factor"] = prefetch_factor
+    return kwargs
+
 
 def list_collate(batch):
     """
@@ -98,6 +146,93 @@ def worker_init_reset_seed(worker_id):
     np.random.seed(seed)
 
 
+def _empty_batch(shape, dtype=torch.float32, pin_memory=False):
+    """
+    Function: 为一个batch分配内存, 每个batch分配一次(与default_collate相同), collate直接写入, 省去逐张图片的tensor和stack拷贝
+        worker进程中直接在共享内存上分配(与default_collate相同), 主进程取batch时不再拷贝;
+        主进程中(num_workers=0)可直接分配pinned内存, pin_memory线程遇到已pinned的tensor不会再拷贝
+        不跨batch复用: 主进程/pin_memory线程/prefetcher的异步拷贝仍可能持有之前的batch, worker无法得知何时可以覆盖
+
+    :param shape: tuple batch形状
+    :param dtype: torch.dtype
+    :param pin_memory: bool 主进程中是否分配pinned内存
+    :return: tensor
+    """
+    if torch.utils.data.get_worker_info() is not None:
+        numel = int(np.prod(shape))
+        elem = torch.empty(0, dtype=dtype)
+        storage = elem._typed_storage() if hasattr(elem, "_typed_storage") else elem.storage()  # torch<2.0没有_typed_storage
+        return elem.new(storage._new_shared(numel)).view(shape)
+    if pin_memory and torch.cuda.is_available():
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+    return torch.empty(shape, dtype=dtype)
+
+
+class DetectionCollate:
+    def __init__(self, max_boxes=None, pin_memory=True):
+        """
+        Function: 目标检测的collate_fn, 每张图片的bbox数量不同
+            images直接写入预先分配的batch内存中(共享内存或pinned内存), 没有逐张图片的FloatTensor和torch.stack拷贝
+
+        :param max_boxes: int 每张图片最多的bbox数量,
+            None: targets为[N, 6], 6为(batch_idx, class, cx, cy, w, h), 与原detection_collate相同
+            int: targets填充为固定大小[B, max_boxes, 6], 同时返回每张图片的bbox数量counts[B],
+                 YOLOX head所需的labels [B, max_boxes, 5]即targets[..., 1:], 超过max_boxes的bbox被丢弃并输出warning
+        :param pin_memory: bool num_workers=0时, 是否直接分配pinned内存
+        """
+        self.max_boxes = max_boxes
+        self.pin_memory = pin_memory
+
+    def __call__(self, batch):
+        """
+        :param batch: list of (image ndarray[C, H, W], labels ndarray[n, 6], image_path)
+        :return:
+            max_boxes为None: imgs [B, C, H, W], targets [N, 6], paths
+            max_boxes为int: imgs [B, C, H, W], targets [B, max_boxes, 6], paths, counts [B]
+        """
+        # 1. 获取单个batchsize的imgs，targets，paths
+        imgs, targets, paths = list(zip(*batch))
+        batch_size = len(imgs)
+
+        # 2. imgs处理, 直接拷贝到batch内存中, 同时完成dtype转换
+        images = _empty_batch((batch_size,) + tuple(imgs[0].shape), pin_memory=self.pin_memory)
+        images_np = images.numpy()
+        for i, img in enumerate(imgs):
+            np.copyto(images_np[i], img, casting="unsafe")
+
+        # 3. targets处理, 第0列为此bbox属于batch中的第几张图片
+        targets = [boxes if boxes is not None else np.zeros((0, 6), dtype=np.float32) for boxes in targets]
+        if self.max_boxes is None:
+            labels = _empty_batch((sum(len(boxes) for boxes in targets), 6), pin_memory=self.pin_memory)
+            labels_np = labels.numpy()
+            start = 0
+            for i, boxes in enumerate(targets):
+                labels_np[start:start + len(boxes), 1:] = boxes[:, 1:]
+                labels_np[start:start + len(boxes), 0] = i
+                start += len(boxes)
+        else:
+            labels = _empty_batch((batch_size, self.max_boxes, 6), pin_memory=self.pin_memory)
+            counts = _empty_batch((batch_size,), dtype=torch.int64, pin_memory=self.pin_memory)
+            labels_np, counts_np = labels.numpy(), counts.numpy()
+            labels_np.fill(0)
+            for i, boxes in enumerate(targets):
+                n = min(len(boxes), self.max_boxes)
+                if len(boxes) > self.max_boxes:
+                    logger.warning("{} has {} bboxes, more than max_boxes={}, {} bboxes are dropped, "
+                                   "please increase max_boxes".format(paths[i][0], len(boxes), self.max_boxes,
+                                                                      len(boxes) - self.max_boxes))
+                labels_np[i, :n, 1:] = boxes[:n, 1:]
+                labels_np[i, :n, 0] = i
+                counts_np[i] = n
+
+        # 4. paths处理
+        paths = [p[0] for p in paths]
+
+        if self.max_boxes is None:
+            return images, labels, paths
+        return images, labels, paths, counts
+
+
 def detection_collate(batch):
     """
     Function:
@@ -110,24 +245,7 @@ def detection_collate(batch):
     Return:
         A tuple containing:
             1) (tensor) batch of images stacked on their 0 dim
-            2) (list of tensors) annotations for a given image are stacked on 0 dim
+            2) (tensor) annotations [N, 6] of all images, column 0 is the sample index
+            3) (list) image paths
     """
-    # 1. 获取单个batchsize的imgs，targets，paths
-    imgs, targets, paths = list(zip(*batch))
-
-    # 2. imgs处理
-    imgs = [torch.FloatTensor(img) for img in imgs]
-    imgs = torch.stack(imgs, 0)
-
-    # 3. targets处理
-    # Remove empty placeholder targets
-    targets = [torch.FloatTensor(boxes) for boxes in targets if boxes is not None]
-    # Add sample index to targets
-    for i, boxes in enumerate(targets):
-        boxes[:, 0] = i
-    targets = torch.cat(targets, 0)  # target type is tensor， shape（119，6），例如：[[0,...],[1, ...], ..., [19,...]
-
-    # 4. paths处理
-    paths = [p[0] for p in paths]
-
-    return imgs, targets, paths
+    return DetectionCollate()(batch)
@@ -156,10 +156,11 @@ class DetDataset(Dataset):
 
         # 4. 对albumentations增强的images和bboxes进行处理
         transformed_image = transformed_image.transpose(2, 0, 1)  # c, h, w
-        transformed_bboxes = np.asarray(transformed_bboxes)
-        labels_bboxes = np.hstack((np.expand_dims(class_labels, axis=1), transformed_bboxes))  # 将bboxes和labels合并
-        labels = np.zeros((len(labels_bboxes), 6))  # 添加一维，为了存放此张图片是那个batchsize的
-        labels[:, 1:] = labels_bboxes
+        # 一次分配labels[n, 6], 第0列存放此张图片是batch中的第几张(由collate填写), 避免hstack/zeros多次分配
+        labels = np.empty((len(transformed_bboxes), 6), dtype=np.float32)
+        labels[:, 0] = 0
+        labels[:, 1] = class_labels
+        labels[:, 2:] = np.asarray(transformed_bboxes, dtype=np.float32).reshape(-1, 4)
         return transformed_image, labels, image_path
 
     def pull_item(self, index):
@@ -59,6 +59,7 @@ class InfiniteSampler(Sampler):
         assert size > 0
         self._shuffle = shuffle     # 是否打乱数据的顺序
         self._seed = int(seed)      # 随机数
+        self._start = 0             # 跳过无限索引流的前start个索引(所有rank合计), 用于resume
 
         # 获得rank和world_size
         if dist.is_available() and dist.is_initialized():
@@ -68,6 +69,14 @@ class InfiniteSampler(Sampler):
             self._rank = rank
             self._world_size = world_size
 
+    def set_start(self, start):
+        """
+        Function: resume时从断点继续采样, 而不是从seed的第一个permutation重新开始(会重复中断epoch前面的样本, 跳过后面的样本)
+
+        :param start: int 已经训练的索引数(所有rank合计), 即 已训练的iter数 * 每个rank的batch_size * world_size
+        """
+        self._start = int(start)
+
     def __iter__(self):
         """
         Function: 实现了__iter__方法的对象是可迭代的
@@ -84,11 +93,61 @@ class InfiniteSampler(Sampler):
     def _infinite_indices(self):
         g = torch.Generator()
         g.manual_seed(self._seed)
+        epoch, offset = divmod(self._start, self._size)
+        for _ in range(epoch if self._shuffle else 0):  # 已完整用过的permutation只推进随机数状态
+            torch.randperm(self._size, generator=g)
         while True:
             if self._shuffle:
-                yield from torch.randperm(self._size, generator=g)
+                yield from torch.randperm(self._size, generator=g)[offset:]
             else:
-                yield from torch.arange(self._size)
+                yield from torch.arange(self._size)[offset:]
+            offset = 0
 
     def __len__(self):
         return self._size // self._world_size
+
+
+class InferenceSampler(Sampler):
+    def __init__(self, size: int, rank=None, world_size=None):
+        """
+        Function:
+            Produce indices for inference across all workers.
+            Inference needs to run on the __exact__ set of samples,
+            therefore when the total number of samples is not divisible by the number of workers,
+            this sampler produces different number of samples on different workers.
+            与torch.utils.data.distributed.DistributedSampler不同，此sampler不会填充重复样本，
+            每个rank得到互不重叠的连续分片，分片长度可以不相等，保证验证指标不被重复样本影响。
+        Args:
+            size (int): the total number of data of the underlying dataset to sample from
+            rank (int): 当前rank, None时从dist中获取
+            world_size (int): 总rank数, None时从dist中获取
+        """
+        self._size = size  # 数据总数
+        assert size > 0
+        if rank is None or world_size is None:
+            if dist.is_available() and dist.is_initialized():
+                rank, world_size = dist.get_rank(), dist.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        self._rank = rank
+        self._world_size = world_size
+        self.set_subset(None)
+
+    def set_subset(self, indices=None):
+        """
+        Function: 只验证数据集的子集(EvalPolicy使用), 子集同样按rank切分; dataloader不需要重建, 下次迭代生效
+
+        :param indices: list of int 子集的全局下标(所有rank相同), None表示整个数据集
+        """
+        indices = range(self._size) if indices is None else list(indices)
+        size, world_size = len(indices), self._world_size
+        # 前 size % world_size 个rank多分一个样本
+        shard_sizes = [size // world_size + int(r < size % world_size) for r in range(world_size)]
+        begin = sum(shard_sizes[:self._rank])
+        self._local_indices = indices[begin:begin + shard_sizes[self._rank]]
+
+    def __iter__(self):
+        yield from self._local_indices
+
+    def __len__(self):
+        return len(self._local_indices)
@@ -14,6 +14,8 @@ import matplotlib.pyplot as plt
 from loguru import logger
 from tqdm import tqdm
 from copy import deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 import torch
@@ -22,8 +24,8 @@ from torchcam.utils import overlay_mask
 import torch.nn.functional as F
 from torchvision.transforms.functional import normalize, resize, to_pil_image
 
-from dao.utils import MeterClsEval
-from dao.utils import is_main_process, synchronize, time_synchronized, gather
+from dao.utils import MeterClsEval, LogitsDumper
+from dao.utils import is_main_process, synchronize, time_synchronized, get_rank
 
 from dao.register import Registers
 
@@ -35,7 +37,10 @@ class ClsEvaluator:
                  dataloader=None,
                  num_classes=None,
                  is_industry=False,
-                 target_layer="conv_head"):
+                 target_layer="conv_head",
+                 keep_outputs=False,
+                 industry_workers=4,
+                 dump_logits=False):
         """
         验证器
         is_distributed:bool 是否是分布式
@@ -43,6 +48,9 @@ class ClsEvaluator:
         num_classes:int 类别数
         is_industry:bool 是否使用工业方法验证，即输出过漏检
         industry:dict 使用工业验证方法所需的参数
+        keep_outputs:bool 是否保留本rank所有样本的logits(cpu, 在self.outputs中), 默认只保留混淆矩阵等统计量
+        industry_workers:int 工业验证时拷贝图片、绘制CAM、编码PNG的线程数
+        dump_logits:bool 是否把logits(float16 memmap)、标签、图片路径保存到output_dir/logits, 供ClsAnalysis离线分析
         """
         # 获取Dataloader
         self.dataloader = Registers.dataloaders.get(dataloader.type)(
@@ -56,17 +64,16 @@ class ClsEvaluator:
         self.num_class = num_classes
         self.is_industry = is_industry
         self.target_layer = target_layer
+        self.keep_outputs = keep_outputs
+        self.industry_workers = industry_workers
+        self.dump_logits = dump_logits
+        self.outputs = None     # keep_outputs时为本rank的logits (N, C)
+        self.class_metrics = None   # 每个类别的precision, recall, F1
 
         # 获取labels字典
         m = self.dataloader.dataset.labels_dict
         self.labels_ = dict(zip(m.values(), m.keys()))
         self.class_names = list(m.keys())
-        # 定义混淆矩阵
-        # self.confusion_matrix = [[0 for j in range(num_classes)] for i in range(num_classes)]
-        self.pred_target_list = []  # 存放混淆矩阵中所用到的数据
-        # self.pred_target_list_tolerate_count = {}  # 计算容忍混淆矩阵使用
-        self.excel_ng = []
-        self.excel_ok = []
 
     @logger.catch
     def evaluate(self, model, distributed=False, half=False, device=None, output_dir=None):
@@ -82,173 +89,63 @@ class ClsEvaluator:
         tensor_type = torch.cuda.HalfTensor if half else torch.cuda.FloatTensor
         if half:
             model = model.half()
-        data_list = []  # 存放最终的结果，多个gpu上汇集来的结果
         # progress_bar = tqdm if is_main_process() else iter
         progress_bar = iter
 
-        # for industry
+        # for industry: GPU上按batch计算softmax和CAM, 图片拷贝/CAM叠加/PNG编码/Excel写入交给IndustryExporter的线程池
         cam_extractor = CAM(model, target_layer=self.target_layer) if self.is_industry else None    # 热力图
-        ng_workbook = xlsxwriter.Workbook(os.path.join(output_dir, "NG.xlsx")) if self.is_industry else None   # NG表格
-        ng_worksheet = self.setXLSX(ng_workbook) if self.is_industry else None     # ng Excel表格
-        ok_workbook = xlsxwriter.Workbook(os.path.join(output_dir, "OK.xlsx")) if self.is_industry else None   # OK表格
-        ok_worksheet = self.setXLSX(ok_workbook) if self.is_industry else None     # ng Excel表格
-        iter_now = 0 if self.is_industry else None
-
-        for imgs, targets, paths in progress_bar(self.dataloader):
+        exporter = IndustryExporter(output_dir, self.labels_, num_workers=self.industry_workers) \
+            if self.is_industry else None
+        dumper = LogitsDumper(os.path.join(output_dir, "logits"), len(self.dataloader.sampler), self.num_class,
+                              rank=get_rank()) if self.dump_logits and output_dir is not None else None
+
+        # 每个rank只累加自己分片的充分统计量(topk命中数、混淆矩阵)，不保留outputs
+        self.meter.reset_stats(keep_outputs=self.keep_outputs)
+        for i, (imgs, targets, paths) in enumerate(progress_bar(self.dataloader)):
             with torch.no_grad():
                 imgs = imgs.type(tensor_type)
                 outputs = model(imgs)
+                targets = targets.to(device=outputs.device)
                 if self.is_industry:
-                    # 将处理验证集中的每张图片
-                    logger.info("{}/{}".format(iter_now, len(self.dataloader)))
-                    iter_now += 1
-                    self._industry(output_tensor=outputs,
-                                   label=targets,
-                                   output_dir=output_dir,
-                                   img_p=paths[0],
-                                   cam_extractor=cam_extractor)
-                data_list.append((outputs, targets, paths))
-
-        # 根据是否是分布式，将结果分别存储到output_s,target_s,path_s中
-        if distributed:     # 如果是分布式，将每个rank的data_list合并到outpus_s, target_s, path_s中
-            output_s = []
-            target_s = []
-            path_s = []
-            data_list = gather(data_list, dst=0)
-            for data_ in data_list:     # multi gpu
-                for pred, target, path in data_:  # 每个gpu所具有的sample
-                    output_s.append(pred)
-                    target_s.append(target)
-                    path_s.append(path)
-        else:   # 如果不是分布式，即单卡情况，将data_list中的数据分别放到output_s,target_s,path_s中
-            output_s = []
-            target_s = []
-            path_s = []
-            for data_ in data_list:
-                output_s.append(data_[0])
-                target_s.append(data_[1])
-                path_s.append(data_[2])
-
-        # 根据是否是rank=0进程， 将top1, top2, confu_ma混淆矩阵返回
-        if not is_main_process():
-            top1, top2, confu_ma = 0, 0, None
-        else:
-            self.meter.update(
-                outputs=torch.cat([output.to(device=device) for output in output_s]),
-                targets=torch.cat([output.to(device=device) for output in target_s])
-            )  # 更新，计算top1, top2
-            self.meter.eval_confusionMatrix(
-                preds=torch.cat([output.to(device=device) for output in output_s]),
-                labels=torch.cat([output.to(device=device) for output in target_s])
-            )  # 计算混淆矩阵
-
-            top1 = self.meter.precision_top1.avg
-            top2 = self.meter.precision_top2.avg
+                    logger.info("{}/{}".format(i, len(self.dataloader)))
+                    scores, indices = F.softmax(outputs.float(), dim=1).topk(min(2, self.num_class), dim=1)
+                    cams = cam_extractor(indices[:, 0].tolist(), outputs)[0].float().cpu()   # (b, h, w)
+                    exporter.submit(paths, targets.tolist(), indices.tolist(), scores.tolist(), cams)
+                if dumper is not None:
+                    dumper.write(outputs, targets, paths)
+                self.meter.update_stats(outputs, targets, topk=(1, 2))
+
+        # 所有rank的充分统计量all_reduce求和，每个rank都得到全局的top1, top2, confu_ma混淆矩阵
+        (top1, top2), confu_ma = self.meter.reduce_stats(device=device, topk=(1, 2), distributed=distributed)
+        self.class_metrics = self.meter.class_metrics()
+        if self.keep_outputs:
+            self.outputs = torch.cat(self.meter.outputs) if len(self.meter.outputs) else None
+        self.meter.reset_stats()    # 重置，避免下次验证时，累加以前结果
+        if dumper is not None:
+            dumper.close()
+            logger.info("logits saved to {}".format(os.path.join(output_dir, "logits")))
+
+        if self.is_industry:
+            cam_extractor.remove_hooks()
+            logger.info("wait for pictures and xlsx")
+            exporter.close()
+
+        if is_main_process():
             logger.info("top1:{}, top2:{}".format(top1, top2))
-            confu_ma = self.meter.confusion_matrix
-            # 重置top1, top2, 混淆矩阵，避免下次验证时，累加以前结果
-            self.meter.precision_top1.initialized = False
-            self.meter.precision_top2.initialized = False
-            self.meter.confusion_matrix = [[0 for j in range(self.num_class)] for i in range(self.num_class)]
-
+            for name, p, r, f1 in zip(self.class_names, self.class_metrics["precision"],
+                                      self.class_metrics["recall"], self.class_metrics["f1"]):
+                logger.info("{}: precision:{:.4f}, recall:{:.4f}, F1:{:.4f}".format(name, p, r, f1))
             if self.is_industry:    # 是工业分支
                 logger.info("figure confusion matrix")
                 self.plot_confusion_matrix(confu_ma, self.class_names, title="Confusion Matrix",
                                            num_classes=self.num_class,
                                            dst_path=os.path.join(output_dir, "ConfusionMatrix.png"))
-                logger.info("writer NG xlsx")
-                self.writer_ng_XLSX(ng_worksheet, self.excel_ng, output_dir)
-                ng_workbook.close()
-                logger.info("writer OK xlsx")
-                self.writer_ok_XLSX(ok_worksheet, self.excel_ok, output_dir)
-                ok_workbook.close()
 
-        synchronize()
+        if distributed:
+            synchronize()
 
         return top1, top2, confu_ma
 
-    @logger.catch
-    def _industry(self, output_tensor=None,
-                  label=None,
-                  output_dir=None,
-                  img_p=None,
-                  cam_extractor=None):
-        """此函数主要是将原图、直方图拉伸、热力图拷贝到对应位置"""
-        # 获得label
-        label = str(label.cpu().numpy().item())
-        # 获得pred
-        prediction = output_tensor.squeeze(0).cpu().detach().numpy()
-        prediction = F.softmax(torch.from_numpy(prediction), dim=0).argmax(0).cpu().numpy()
-        scores = F.softmax(output_tensor.squeeze(0), dim=0).cpu().numpy().max()  # top1 分数
-        pred = prediction.item()  # top1下标
-
-        self.pred_target_list.append((pred, label))  # 记录预测值和标签值，供计算混淆矩阵使用 (int,str)
-
-        # 将NG，即label != pred(top1) 放到excel中；同时将OK也放到excel中，只不过没有图片
-        excel_ng = {}
-        excel_ok = {}
-        save_cam = False
-        if int(label) != pred:
-            top_i = output_tensor.topk(2, dim=1, largest=True, sorted=True)[1].squeeze(0).cpu().numpy()
-            top_v = F.softmax(output_tensor.squeeze(0), dim=0).cpu().numpy()
-
-            excel_ng["img_p"] = img_p.replace("\\", "/").split("/")[-1]
-
-            excel_ng["top1_id"] = top_i[0]
-            excel_ng["top1_name"] = self.labels_[str(top_i[0])]
-            excel_ng["top1_score"] = top_v[top_i[0]]
-
-            excel_ng["top2_id"] = top_i[1]
-            excel_ng["top2_name"] = self.labels_[str(top_i[1])]
-            excel_ng["top2_score"] = top_v[top_i[1]]
-
-            excel_ng["label"] = int(label)
-            excel_ng["label_name"] = self.labels_[label]
-
-            save_cam = True  # 是否保存原图、热力图的标志位
-        elif int(label) == pred:
-            top_i = output_tensor.topk(3, dim=1, largest=True, sorted=True)[1].squeeze(0).cpu().numpy()
-            top_v = F.softmax(output_tensor.squeeze(0), dim=0).cpu().numpy()
-
-            excel_ok["img_p"] = img_p.replace("\\", "/").split("/")[-1]
-
-            excel_ok["top1_id"] = top_i[0]
-            excel_ok["top1_name"] = self.labels_[str(top_i[0])]
-            excel_ok["top1_score"] = top_v[top_i[0]]
-
-            excel_ok["top2_id"] = top_i[1]
-            excel_ok["top2_name"] = self.labels_[str(top_i[1])]
-            excel_ok["top2_score"] = top_v[top_i[1]]
-
-            excel_ok["label"] = int(label)
-            excel_ok["label_name"] = self.labels_[label]
-
-            self.excel_ok.append(excel_ok)
-
-        # ---------- 图片拷贝
-        pic_path = os.path.join(output_dir, "pictures")
-        os.makedirs(pic_path, exist_ok=True)
-        # 1. 拷贝图片
-        img_path = img_p.split("/")[-2] + "_" + img_p.split("/")[-1]   # labelName_imageName
-        output_name = "img-{}__pred-{}__target-{}__score-{}.{}".format(img_path,
-                                                                       self.labels_[str(pred)],
-                                                                       self.labels_[label],
-                                                                       str(scores),
-                                                                       img_p[-3:]
-                                                                       )
-        shutil.copy(os.path.join(img_p), os.path.join(pic_path, output_name))
-
-        # 2.拷贝CAM图
-        output_name_cam = output_name[:-4] + ".png"
-        activation_map = cam_extractor(output_tensor.cpu().squeeze(0).argmax().item(), output_tensor.cpu())
-        result = overlay_mask(Image.open(img_p).convert("RGB"), to_pil_image(activation_map[0], mode='F'), alpha=0.5)
-        cv2.imencode('.png', np.array(result)[:, :, ::-1])[1].tofile(os.path.join(pic_path, output_name_cam))
-
-        if save_cam:
-            excel_ng["img"] = os.path.join(pic_path, output_name)
-            excel_ng["cam"] = os.path.join(pic_path, output_name_cam)
-            self.excel_ng.append(excel_ng)
-
     @logger.catch
     def plot_confusion_matrix(self, cm, classes, normalize=False, title='Confusion matrix', cmap=plt.cm.Blues,
                               num_classes=38, dst_path=None):
@@ -282,93 +179,110 @@ class ClsEvaluator:
         plt.xlabel('Predicted label')
         plt.savefig(dst_path)
 
-    @logger.catch
-    def setXLSX(self, workbook):
-        worksheet = workbook.add_worksheet()
-        self.col_list = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K']
-        self.col_list_name = ['ImageName',
-                              'top1 ID', 'top1 Name', 'top1 Score',
-                              'top2 ID', 'top2 Name', 'top2 Score',
-                              'label ID', 'label Name',
-                              'OriPicture', 'CAMPicture']
-        # 写入标题
-        for i in range(len(self.col_list)):  # 写入标题
-            worksheet.write(self.col_list[i] + '1', self.col_list_name[i])
 
+class IndustryExporter:
+    """
+    工业验证的结果导出(生产者/消费者):
+        GPU循环调用submit提交每个batch的预测结果和CAM, 线程池拷贝原图、叠加CAM、编码PNG,
+        NG.xlsx/OK.xlsx按样本顺序流式写入(constant_memory), 不在内存中保存所有结果
+    """
+    col_list_name = ['ImageName',
+                     'top1 ID', 'top1 Name', 'top1 Score',
+                     'top2 ID', 'top2 Name', 'top2 Score',
+                     'label ID', 'label Name',
+                     'OriPicture', 'CAMPicture']
+    picture_param = {'x_offset': 0, 'y_offset': 0, 'x_scale': 1, 'y_scale': 1, "width": 100, "height": 80}
+
+    def __init__(self, output_dir, labels_, num_workers=4, max_pending=256):
+        """
+        :param output_dir: 输出路径
+        :param labels_: dict id(str):name
+        :param num_workers: 线程数
+        :param max_pending: 最多未写入Excel的样本数, 超过时GPU循环等待(背压)
+        """
+        self.labels_ = labels_
+        self.pic_path = os.path.join(output_dir, "pictures")
+        os.makedirs(self.pic_path, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = deque()
+        self.max_pending = max_pending
+
+        self.ng_workbook = xlsxwriter.Workbook(os.path.join(output_dir, "NG.xlsx"), {'constant_memory': True})
+        self.ng_worksheet = self._add_worksheet(self.ng_workbook)
+        self.ng_worksheet.set_column(9, 11, 256)
+        self.ok_workbook = xlsxwriter.Workbook(os.path.join(output_dir, "OK.xlsx"), {'constant_memory': True})
+        self.ok_worksheet = self._add_worksheet(self.ok_workbook)
+        self.ng_row, self.ok_row = 1, 1
+
+    def _add_worksheet(self, workbook):
+        worksheet = workbook.add_worksheet()
+        worksheet.set_column(0, 9, 10)
+        for n, name in enumerate(self.col_list_name):  # 写入标题
+            worksheet.write(0, n, name)
         return worksheet
 
-    @logger.catch
-    def writer_ng_XLSX(self, worksheet, excel_ng, output_dir):
-        for m, one_r in enumerate(excel_ng):
-            # 设置表格宽高
-            worksheet.set_column(0, 9, 10)
-            worksheet.set_column(9, 11, 256)
-            worksheet.set_row(m + 1, 512)
-            img_p = one_r['img_p']
-            top1_id = one_r['top1_id']
-            top1_name = one_r['top1_name']
-            top1_score = one_r['top1_score']
-            top2_id = one_r['top2_id']
-            top2_name = one_r['top2_name']
-            top2_score = one_r['top2_score']
-            label = one_r['label']
-            label_name = one_r['label_name']
-            img = one_r['img']
-            cam = one_r['cam']
-            to_w = [img_p, top1_id, top1_name, top1_score, top2_id, top2_name, top2_score, label, label_name, img, cam]
-            for n in range(len(self.col_list)):
-                if n < 9:   # img_p, top1_id, top1_name, top1_score, top2_id, top2_name, top2_score, label, label_name
-                    worksheet.write(str(self.col_list[n]) + str(m + 2), to_w[n])
-                elif n == 9:   # img 字段
-                    param = {
-                        'x_offset': 0,
-                        'y_offset': 0,
-                        'x_scale': 1,
-                        'y_scale': 1,
-                        "width": 100,
-                        "height": 80,
-                        'url': None,
-                        'tip': None,
-                        'image_data': None,
-                        'positioning': None,
-                    }
-                    try:
-                        worksheet.insert_image(self.col_list[n] + str(m + 2), to_w[len(self.col_list) - 2], param)
-                    except Exception as e:
-                        print(e)
-                elif n == 10:   # cam字段
-                    param = {
-                        'x_offset': 0,
-                        'y_offset': 0,
-                        'x_scale': 1,
-                        'y_scale': 1,
-                        "width": 100,
-                        "height": 80,
-                        'url': None,
-                        'tip': None,
-                        'image_data': None,
-                        'positioning': None,
-                    }
-                    try:
-                        worksheet.insert_image(self.col_list[n] + str(m + 2), to_w[len(self.col_list) - 1], param)
-                    except Exception as e:
-                        logger.error(e)
+    def submit(self, paths, labels, indices, scores, cams):
+        """
+        :param paths: list of str 图片路径
+        :param labels: list of int
+        :param indices: list of [top1_id, top2_id]
+        :param scores: list of [top1_score, top2_score] softmax分数
+        :param cams: tensor (b, h, w) cpu
+        """
+        for img_p, label, top_i, top_v, cam in zip(paths, labels, indices, scores, cams):
+            row = [img_p.replace("\\", "/").split("/")[-1],
+                   top_i[0], self.labels_[str(top_i[0])], top_v[0],
+                   top_i[-1], self.labels_[str(top_i[-1])], top_v[-1],
+                   label, self.labels_[str(label)]]
+            future = self.pool.submit(self._save_pictures, img_p, top_i[0], label, top_v[0], cam)
+            self.pending.append((future, row, label != top_i[0]))
+
+        # 按顺序写入已完成的样本; 积压过多时等待
+        while self.pending and (self.pending[0][0].done() or len(self.pending) > self.max_pending):
+            self._write_next()
+
+    def _save_pictures(self, img_p, pred, label, score, cam):
+        """
+        拷贝原图, 保存CAM叠加图, 在线程池中执行
+        :return: (原图路径, CAM图路径)
+        """
+        img_path = img_p.split("/")[-2] + "_" + img_p.split("/")[-1]   # labelName_imageName
+        output_name = "img-{}__pred-{}__target-{}__score-{}.{}".format(img_path,
+                                                                       self.labels_[str(pred)],
+                                                                       self.labels_[str(label)],
+                                                                       str(score),
+                                                                       img_p[-3:]
+                                                                       )
+        shutil.copy(img_p, os.path.join(self.pic_path, output_name))
 
-    @logger.catch
-    def writer_ok_XLSX(self, worksheet, excel_ok, output_dir):
-        for m, one_r in enumerate(excel_ok):
-            # 设置表格宽高
-            worksheet.set_column(0, 9, 10)
-            worksheet.set_row(m + 1, 10)
-            img_p = one_r['img_p']
-            top1_id = one_r['top1_id']
-            top1_name = one_r['top1_name']
-            top1_score = one_r['top1_score']
-            top2_id = one_r['top2_id']
-            top2_name = one_r['top2_name']
-            top2_score = one_r['top2_score']
-            label = one_r['label']
-            label_name = one_r['label_name']
-            to_w = [img_p, top1_id, top1_name, top1_score, top2_id, top2_name, top2_score, label, label_name]
-            for n in range(len(self.col_list)-2):
-                worksheet.write(str(self.col_list[n]) + str(m + 2), to_w[n])
+        output_name_cam = output_name[:-4] + ".png"
+        result = overlay_mask(Image.open(img_p).convert("RGB"), to_pil_image(cam, mode='F'), alpha=0.5)
+        cv2.imencode('.png', np.array(result)[:, :, ::-1])[1].tofile(os.path.join(self.pic_path, output_name_cam))
+        return os.path.join(self.pic_path, output_name), os.path.join(self.pic_path, output_name_cam)
+
+    def _write_next(self):
+        future, row, is_ng = self.pending.popleft()
+        try:
+            img, cam = future.result()
+        except Exception as e:
+            logger.error("save pictures of {} failed: {}".format(row[0], e))
+            img, cam = None, None
+        if is_ng:
+            # constant_memory模式下必须按行顺序写入
+            self.ng_worksheet.set_row(self.ng_row, 512)
+            self.ng_worksheet.write_row(self.ng_row, 0, row)
+            for n, pic in ((9, img), (10, cam)):
+                if pic is not None:
+                    self.ng_worksheet.insert_image(self.ng_row, n, pic, self.picture_param)
+            self.ng_row += 1
+        else:
+            self.ok_worksheet.set_row(self.ok_row, 10)
+            self.ok_worksheet.write_row(self.ok_row, 0, row)
+            self.ok_row += 1
+
+    def close(self):
+        while self.pending:
+            self._write_next()
+        self.pool.shutdown()
+        self.ng_workbook.close()
+        self.ok_workbook.close()
@@ -13,40 +13,10 @@ from PIL import Image
 
 from dao.utils import colorize_mask, get_palette
 from dao.utils import is_main_process, synchronize, time_synchronized, gather, get_world_size, MeterDetEval
+from dao.utils import batched_postprocess, all_gather_tensor, all_reduce_sum, box_iou
 from dao.register import Registers
 def to_cpu(tensor):
     return tensor.detach().cpu()
-def bbox_iou(box1, box2, x1y1x2y2=True):
-    """
-    Returns the IoU of two bounding boxes
-    """
-    if not x1y1x2y2:
-        # Transform from center and width to exact coordinates
-        b1_x1, b1_x2 = box1[:, 0] - box1[:, 2] / 2, box1[:, 0] + box1[:, 2] / 2
-        b1_y1, b1_y2 = box1[:, 1] - box1[:, 3] / 2, box1[:, 1] + box1[:, 3] / 2
-        b2_x1, b2_x2 = box2[:, 0] - box2[:, 2] / 2, box2[:, 0] + box2[:, 2] / 2
-        b2_y1, b2_y2 = box2[:, 1] - box2[:, 3] / 2, box2[:, 1] + box2[:, 3] / 2
-    else:
-        # Get the coordinates of bounding boxes
-        b1_x1, b1_y1, b1_x2, b1_y2 = box1[:, 0], box1[:, 1], box1[:, 2], box1[:, 3]
-        b2_x1, b2_y1, b2_x2, b2_y2 = box2[:, 0], box2[:, 1], box2[:, 2], box2[:, 3]
-
-    # get the corrdinates of the intersection rectangle
-    inter_rect_x1 = torch.max(b1_x1, b2_x1)
-    inter_rect_y1 = torch.max(b1_y1, b2_y1)
-    inter_rect_x2 = torch.min(b1_x2, b2_x2)
-    inter_rect_y2 = torch.min(b1_y2, b2_y2)
-    # Intersection area
-    inter_area = torch.clamp(inter_rect_x2 - inter_rect_x1 + 1, min=0) * torch.clamp(
-        inter_rect_y2 - inter_rect_y1 + 1, min=0
-    )
-    # Union Area
-    b1_area = (b1_x2 - b1_x1 + 1) * (b1_y2 - b1_y1 + 1)
-    b2_area = (b2_x2 - b2_x1 + 1) * (b2_y2 - b2_y1 + 1)
-
-    iou = inter_area / (b1_area + b2_area - inter_area + 1e-16)
-
-    return iou
 def xywh2xyxy(x):
     y = x.new(x.shape)
     y[..., 0] = x[..., 0] - x[..., 2] / 2
@@ -58,59 +28,32 @@ def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4):
     """
     Removes detections with lower object confidence score than 'conf_thres' and performs
     Non-Maximum Suppression to further filter detections.
+    与原逐框循环的weighted NMS相同, 使用批量实现(dao.utils.batched_postprocess)
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, class_score, class_pred)
     """
-
-    # From (center x, center y, width, height) to (x1, y1, x2, y2)
-    prediction[..., :4] = xywh2xyxy(prediction[..., :4])
-    output = [None for _ in range(len(prediction))]
-    for image_i, image_pred in enumerate(prediction):
-        # Filter out confidence scores below threshold
-        image_pred = image_pred[image_pred[:, 4] >= conf_thres]
-        # If none are remaining => process next image
-        if not image_pred.size(0):
-            continue
-        # Object confidence times class confidence
-        score = image_pred[:, 4] * image_pred[:, 5:].max(1)[0]
-        # Sort by it
-        image_pred = image_pred[(-score).argsort()]
-        class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
-        detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
-        # Perform non-maximum suppression
-        keep_boxes = []
-        while detections.size(0):
-            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
-            label_match = detections[0, -1] == detections[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 4:5]
-            # Merge overlapping bboxes by order of confidence
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]
-        if keep_boxes:
-            output[image_i] = torch.stack(keep_boxes)
-
-    return output
+    return batched_postprocess(prediction, conf_thre=conf_thres, nms_thre=nms_thres, conf_type="obj", weighted=True)
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves.
     Code originally from https://github.com/rbgirshick/py-faster-rcnn.
 
     # Arguments
-        recall:    The recall curve (list).
-        precision: The precision curve (list).
+        recall:    The recall curve (list), [N] 或 [N, T](每列一个IoU阈值).
+        precision: The precision curve (list), 与recall形状相同.
     # Returns
-        The average precision as computed in py-faster-rcnn.
+        The average precision as computed in py-faster-rcnn, [N]输入时为float, [N, T]输入时为[T].
     """
+    recall, precision = np.asarray(recall), np.asarray(precision)
+    if recall.ndim == 2:
+        return np.array([compute_ap(recall[:, t], precision[:, t]) for t in range(recall.shape[1])])
+
     # correct AP calculation
     # first append sentinel values at the end
     mrec = np.concatenate(([0.0], recall, [1.0]))
     mpre = np.concatenate(([0.0], precision, [0.0]))
 
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # compute the precision envelope (从后向前的累计最大值)
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -120,7 +63,15 @@ def compute_ap(recall, precision):
     ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 def get_batch_statistics(outputs, targets, iou_threshold):
-    """ Compute true positives, predicted scores and predicted labels per sample """
+    """
+    Compute true positives, predicted scores and predicted labels per sample
+        每张图片计算一次预测框与标注框的IoU矩阵(在outputs的device上), 用mask实现按预测顺序的贪心匹配,
+        结果与逐框循环相同: 预测框只和IoU最大的标注框匹配, 预测类别需出现在该图片标注中, 每个标注框只匹配一次
+
+    :param iou_threshold: float 或 list of float(例如COCO的0.5:0.95), list时true_positives为[P, T]
+    """
+    thresholds = torch.as_tensor(iou_threshold, dtype=torch.float32).view(-1)
+    num_thres = thresholds.numel()
     batch_metrics = []
     for sample_i in range(len(outputs)):
 
@@ -131,93 +82,96 @@ def get_batch_statistics(outputs, targets, iou_threshold):
         pred_boxes = output[:, :4]
         pred_scores = output[:, 4]
         pred_labels = output[:, -1]
+        num_pred = pred_boxes.shape[0]
 
-        true_positives = np.zeros(pred_boxes.shape[0])
+        true_positives = torch.zeros(num_pred, num_thres, dtype=torch.bool, device=output.device)
 
-        annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
+        annotations = targets[targets[:, 0] == sample_i][:, 1:].to(output.device)
         if len(annotations):
-            detected_boxes = []
+            target_labels = annotations[:, 0]
             target_boxes = annotations[:, 1:]
 
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
-
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
-
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
-
-                iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores, pred_labels])
+            # 与原YOLOv3验证相同, 使用像素坐标的+1约定
+            iou, box_index = box_iou(pred_boxes, target_boxes, pixel_offset=1, eps=1e-16).max(1)    # [P]
+            label_match = (pred_labels[:, None] == target_labels[None, :]).any(1)  # [P]
+            valid = label_match[:, None] & (iou[:, None] >= thresholds.to(iou.device)[None, :])    # [P, T]
+
+            # 每个标注框只有第一个(分数最高的)有效预测框是TP
+            order = torch.arange(num_pred, device=output.device)[:, None].expand(-1, num_thres)
+            box_index = box_index[:, None].expand(-1, num_thres)
+            first = torch.full((len(annotations), num_thres), num_pred, dtype=torch.long, device=output.device)
+            first.scatter_reduce_(0, box_index, torch.where(valid, order, torch.full_like(order, num_pred)), reduce="amin")
+            true_positives = valid & (first.gather(0, box_index) == order)
+
+        true_positives = true_positives.float().cpu().numpy()
+        if np.ndim(iou_threshold) == 0:
+            true_positives = true_positives[:, 0]
+        batch_metrics.append([true_positives, pred_scores.cpu(), pred_labels.cpu()])
     return batch_metrics
-def ap_per_class(tp, conf, pred_cls, target_cls):
+def ap_per_class(tp, conf, pred_cls, target_cls, sorted_input=False):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
     # Arguments
-        tp:    True positives (list).
+        tp:    True positives (list), [N] 或 [N, T](每列一个IoU阈值).
         conf:  Objectness value from 0-1 (list).
         pred_cls: Predicted object classes (list).
         target_cls: True object classes (list).
+        sorted_input: conf已经降序排列时不再排序(例如多卡归并后的统计量).
     # Returns
-        The average precision as computed in py-faster-rcnn.
+        The average precision as computed in py-faster-rcnn, p, r, ap, f1为[C] 或 [C, T].
     """
+    tp = np.asarray(tp)
+    squeeze = tp.ndim == 1
+    tp = tp.reshape(len(tp), -1)
 
     # Sort by objectness
-    i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    if not sorted_input:
+        i = np.argsort(-conf)
+        tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
 
     # Find unique classes
-    unique_classes = np.unique(target_cls)
+    unique_classes, n_gts = np.unique(target_cls, return_counts=True)
 
     # Create Precision-Recall curve and compute AP for each class
-    ap, p, r = [], [], []
-    for c in unique_classes:
+    ap = np.zeros((len(unique_classes), tp.shape[1]))
+    p, r = np.zeros_like(ap), np.zeros_like(ap)
+    for ci, c in enumerate(unique_classes):
         i = pred_cls == c
-        n_gt = (target_cls == c).sum()  # Number of ground truth objects
-        n_p = i.sum()  # Number of predicted objects
-
-        if n_p == 0 and n_gt == 0:
+        n_gt = n_gts[ci]  # Number of ground truth objects
+        if i.sum() == 0:  # Number of predicted objects
             continue
-        elif n_p == 0 or n_gt == 0:
-            ap.append(0)
-            r.append(0)
-            p.append(0)
-        else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum()
-            tpc = (tp[i]).cumsum()
 
-            # Recall
-            recall_curve = tpc / (n_gt + 1e-16)
-            r.append(recall_curve[-1])
+        # Accumulate FPs and TPs
+        fpc = (1 - tp[i]).cumsum(0)
+        tpc = tp[i].cumsum(0)
 
-            # Precision
-            precision_curve = tpc / (tpc + fpc)
-            p.append(precision_curve[-1])
+        # Recall
+        recall_curve = tpc / (n_gt + 1e-16)
+        r[ci] = recall_curve[-1]
 
-            # AP from recall-precision curve
-            ap.append(compute_ap(recall_curve, precision_curve))
+        # Precision
+        precision_curve = tpc / (tpc + fpc)
+        p[ci] = precision_curve[-1]
+
+        # AP from recall-precision curve
+        ap[ci] = compute_ap(recall_curve, precision_curve)
 
     # Compute F1 score (harmonic mean of precision and recall)
-    p, r, ap = np.array(p), np.array(r), np.array(ap)
     f1 = 2 * p * r / (p + r + 1e-16)
+    if squeeze:
+        p, r, ap, f1 = p[:, 0], r[:, 0], ap[:, 0], f1[:, 0]
 
     return p, r, ap, f1, unique_classes.astype("int32")
 
 @Registers.evaluators.register
 class DetEvaluator:
-    def __init__(self, is_distributed=False, dataloader=None, num_classes=None):
+    def __init__(self, is_distributed=False, dataloader=None, num_classes=None, postprocess=None):
         """
         验证器
         is_distributed:bool 是否是分布式
         dataloader:dict dataloader的配置字典
         num_classes:int 类别数
+        postprocess:dict 后处理的配置字典(Registers.postprocessors), 默认为YOLOv3的weighted NMS
         """
         self.dataloader = Registers.dataloaders.get(dataloader.type)(
             is_distributed=is_distributed,
@@ -227,6 +181,12 @@ class DetEvaluator:
         self.iters_per_epoch = len(self.dataloader)
         self.meter = MeterDetEval(num_classes)
         self.num_classes = num_classes
+        self.map_range = None   # iou_thresholds时所有阈值的平均mAP
+        if postprocess is None:
+            self.postprocess = Registers.postprocessors.get("DetPostprocess")(conf_type="obj", weighted=True)
+        else:
+            self.postprocess = Registers.postprocessors.get(postprocess.type)(
+                **(postprocess.kwargs if "kwargs" in postprocess else {}))
 
     def evaluate(self,
                  model,
@@ -234,9 +194,18 @@ class DetEvaluator:
                  half=False, device=None, output_dir=None,
                  save_pic=False,
                  iou_thres=0.5,
-                 conf_thres=0.5,
-                 nms_thres=0.5
+                 conf_thres=None,
+                 nms_thres=None,
+                 iou_thresholds=None
                  ):
+        """
+        :param conf_thres: float 后处理的置信度阈值, None时使用postprocess配置(默认0.5)
+        :param nms_thres: float 后处理的NMS阈值, None时使用postprocess配置(默认0.5)
+        :param iou_thres: float 计算AP的IoU阈值
+        :param iou_thresholds: list of float(可选), 一次匹配计算多个IoU阈值的AP, 例如COCO的[0.5, 0.55, ..., 0.95],
+            返回第一个阈值的AP, 所有阈值的平均mAP保存在self.map_range
+        """
+        thresholds = iou_thres if iou_thresholds is None else list(iou_thresholds)
         tensor_type = torch.cuda.HalfTensor if half else torch.cuda.FloatTensor
         model = model.eval()
         # if half:
@@ -246,7 +215,7 @@ class DetEvaluator:
         labels = []
         sample_metrics = []
         for i, (imgs, targets, paths) in enumerate(self.dataloader):
-            logger.info(f"evaluator iter:{i}/{self.iters_per_epoch}")
+            logger.info(f"evaluator iter:{i}/{len(self.dataloader)}")   # 子集验证时长度会变
             img_size = imgs.size(3)
 
             # Extract labels
@@ -258,14 +227,29 @@ class DetEvaluator:
             with torch.no_grad():
                 imgs = imgs.to(device=device)
                 imgs = imgs.type(tensor_type)
-                outputs = to_cpu(model(imgs))
-                outputs = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres)
-
-            sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres)
-
-        # Concatenate sample statistics
-        true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
-        precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+                # 在GPU上对整个batch做后处理, 匹配也在GPU上计算
+                outputs = self.postprocess(model(imgs), conf_thres=conf_thres, nms_thres=nms_thres)
+
+            sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=thresholds)
+
+        # 每个rank的统计量按score降序排列为[P, 2+T](score, class, tp...), 多卡时all_gather后归并, 得到全局精确的AP
+        stats = self._local_statistics(sample_metrics, np.size(thresholds))
+        num_gt = np.bincount(np.asarray(labels, dtype=np.int64), minlength=self.num_classes or 0)
+        if distributed:
+            stats, num_gt = self._gather_statistics(stats, num_gt, device)
+        true_positives = stats[:, 2] if np.ndim(thresholds) == 0 else stats[:, 2:]
+        target_cls = np.repeat(np.arange(len(num_gt)), num_gt)
+        if len(stats) == 0:     # 所有rank都没有检测结果(例如训练初期), 每个有标注的类别AP为0
+            ap_class = np.flatnonzero(num_gt)
+            precision = recall = AP = f1 = np.zeros((len(ap_class),) + np.shape(true_positives)[1:])
+        else:
+            precision, recall, AP, f1, ap_class = ap_per_class(true_positives, stats[:, 0], stats[:, 1], target_cls,
+                                                               sorted_input=True)
+        if AP.ndim == 2:    # 多个IoU阈值
+            self.map_range = AP.mean()
+            logger.info("mAP@{}:{}, mAP@[{}:{}]:{}".format(thresholds[0], AP[:, 0].mean(),
+                                                          thresholds[0], thresholds[-1], self.map_range))
+            precision, recall, AP, f1 = precision[:, 0], recall[:, 0], AP[:, 0], f1[:, 0]
         evaluation_metrics = [
             ("val_precision", precision.mean()),
             ("val_recall", recall.mean()),
@@ -275,28 +259,28 @@ class DetEvaluator:
         # return precision, recall, AP, f1, ap_class
         return AP.mean(), AP
 
-        # if distributed:  # 如果是分布式，将结果gather到0设备上
-        #     pixAccs = gather(pixAcc, dst=0)
-        #     mIoUs = gather(mIoU, dst=0)
-        #     Class_IoUs = gather(Class_IoU, dst=0)
-        #     if is_main_process():
-        #         pixAcc = sum(pixAccs) / get_world_size()
-        #         mIoU = sum(mIoUs) / get_world_size()
-        #         Class_IoU = Class_IoUs[0]
-        #         for classiou in Class_IoUs[1:]:
-        #             for k, v in Class_IoU.items():
-        #                 Class_IoU[k] += classiou[k]
-        #
-        #         for k, v in Class_IoU.items():
-        #             Class_IoU[k] /= get_world_size()
-
-        # if not is_main_process():
-        #     return 0, 0, None
-        #
-        # Class_IoU_dict = {}
-        # for k, v in Class_IoU.items():
-        #     Class_IoU_dict[self.dataloader.dataset.labels_dict[str(k)]] = v
-        #
-        # # synchronize()
-        # return pixAcc, mIoU, Class_IoU_dict
+    @staticmethod
+    def _local_statistics(sample_metrics, num_thres):
+        """
+        :return: np.ndarray [P, 2+T] (score, class, tp...), 按score降序(stable)
+        """
+        if not sample_metrics:
+            return np.zeros((0, 2 + num_thres), dtype=np.float32)
+        true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
+        stats = np.concatenate((pred_scores[:, None], pred_labels[:, None],
+                                true_positives.reshape(len(true_positives), -1)), 1).astype(np.float32)
+        return stats[np.argsort(-stats[:, 0], kind="stable")]
 
+    @staticmethod
+    def _gather_statistics(stats, num_gt, device):
+        """
+        多卡验证: 每个rank的有序统计量作为一个tensor all_gather(不pickle), 每个类别的标注数all_reduce求和;
+        各rank的有序数组按rank顺序拼接后做stable排序, timsort识别出k个有序段后做k路归并, 结果与单卡验证相同
+        :return: (stats, num_gt) 全局的统计量
+        """
+        device = device if device is not None else torch.device("cuda", torch.cuda.current_device())
+        gathered = all_gather_tensor(torch.from_numpy(stats).to(device))
+        stats = torch.cat(gathered).cpu().numpy()
+        stats = stats[np.argsort(-stats[:, 0], kind="stable")]
+        num_gt = all_reduce_sum(torch.from_numpy(num_gt).to(device)).cpu().numpy()
+        return stats, num_gt
@@ -4,25 +4,30 @@
 
 import os
 from tqdm import tqdm
-import numpy as np
 import torch
 import shutil
 from loguru import logger
 from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from dao.utils import colorize_mask, get_palette
-from dao.utils import is_main_process, synchronize, time_synchronized, gather, get_world_size, MeterSegEval
+from dao.utils import colorize_mask_lut, get_palette_lut
+from dao.utils import synchronize, time_synchronized, MeterSegEval
 from dao.register import Registers
 
 
 @Registers.evaluators.register
 class SegEvaluator:
-    def __init__(self, is_distributed=False, dataloader=None, num_classes=None):
+    def __init__(self, is_distributed=False, dataloader=None, num_classes=None, writer_workers=4, max_pending=64,
+                 inference=None):
         """
         验证器
         is_distributed:bool 是否是分布式
         dataloader:dict dataloader的配置字典
         num_classes:int 类别数
+        writer_workers:int save_pic时写图片的线程数
+        max_pending:int save_pic时最多未写完的batch数, 超过时GPU循环等待(背压)
+        inference:dict(可选) 推理方式的配置, 例如滑窗/多尺度/翻转TTA, 见SegInference, 默认整图推理一次
         """
         self.dataloader = Registers.dataloaders.get(dataloader.type)(
             is_distributed=is_distributed,
@@ -32,73 +37,108 @@ class SegEvaluator:
         self.iters_per_epoch = len(self.dataloader)
         self.meter = MeterSegEval(num_classes)
         self.num_classes = num_classes
+        self.seg_metrics = {}   # 上一次evaluate的所有指标
+        self.writer_workers = writer_workers
+        self.max_pending = max_pending
+        self.inference = Registers.seg_inferences.get(inference.type)(
+            **(inference.kwargs if "kwargs" in inference else {})) if inference is not None else None
 
     def evaluate(self, model, distributed=False, half=False, device=None, output_dir=None, save_pic=False):
         tensor_type = torch.cuda.HalfTensor if half else torch.cuda.FloatTensor
         model = model.eval()
         if half:
             model = model.half()
-        pixAccs = []  # 用于存放all world size汇集的数据
-        mIoUs = []  # 用于存放all world size汇集的数据
-        Class_IoUs = []  # 用于存放all world size汇集的数据
-
         # progress_bar = tqdm if is_main_process() else iter
         # progress_bar = iter  # 使用tqdm在多GPU时，可能会卡死
 
         self.meter.reset_metrics()
+        writer = SegMaskWriter(output_dir, self.num_classes, self.writer_workers, self.max_pending) if save_pic else None
         for i, (imgs, targets, paths) in enumerate(self.dataloader):
-            logger.info(f"evaluator iter:{i}/{self.iters_per_epoch}")
+            logger.info(f"evaluator iter:{i}/{len(self.dataloader)}")   # 子集验证时长度会变
             with torch.no_grad():
+                targets_cpu = targets
                 imgs = imgs.to(device=device)
                 targets = targets.to(device=device)
                 imgs = imgs.type(tensor_type)
-                outputs = model(imgs)
-                if save_pic:
-                    pic_path = os.path.join(output_dir, "pictures")
-                    os.makedirs(pic_path, exist_ok=True)
-                    # 存储每张图片 和 mask
-                    for index in range(len(imgs)):
-                        # img = imgs[index]
-                        output = outputs[index]
-                        mask = targets[index]
-                        path_img = paths[0][index]
-                        path_mask = paths[1][index]
-                        # 拷贝image
-                        shutil.copy(path_img, os.path.join(pic_path, os.path.basename(path_img)[:-4] + ".jpg"))
-                        # 生成预测mask
-                        output = np.uint8(output.unsqueeze(0).data.max(1)[1].cpu().numpy()[0])
-                        output = colorize_mask(output, get_palette(self.num_classes))
-                        output.save(os.path.join(pic_path, os.path.basename(path_img)[:-4] + "_pred.png"))
-                        # 生成target mask
-                        mask = colorize_mask(np.uint8(mask.cpu().numpy()), get_palette(self.num_classes))
-                        mask.save(os.path.join(pic_path, os.path.basename(path_img)[:-4] + "_label.png"))
-
-                seg_metrics = self.meter.eval_metrics(outputs, targets, self.num_classes)
-                self.meter.update_seg_metrics(*seg_metrics)
-
-        pixAcc, mIoU, Class_IoU = self.meter.get_seg_metrics().values()
-
-        if distributed:  # 如果是分布式，将结果gather到0设备上
-            pixAccs = gather(pixAcc, dst=0)
-            mIoUs = gather(mIoU, dst=0)
-            Class_IoUs = gather(Class_IoU, dst=0)
-            if is_main_process():
-                pixAcc = sum(pixAccs) / get_world_size()
-                mIoU = sum(mIoUs) / get_world_size()
-                Class_IoU = Class_IoUs[0]
-                for classiou in Class_IoUs[1:]:
-                    for k, v in Class_IoU.items():
-                        Class_IoU[k] += classiou[k]
-
-                for k, v in Class_IoU.items():
-                    Class_IoU[k] /= get_world_size()
-
-        if not is_main_process():
-            return 0, 0, None
-
-        Class_IoU_dict = {}
-        for k, v in Class_IoU.items():
-            Class_IoU_dict[self.dataloader.dataset.labels_dict[str(k)]] = v
+                outputs = self.inference(model, imgs) if self.inference is not None else model(imgs)
+                if writer is not None:
+                    # 整个batch在GPU上argmax, 一次non_blocking拷贝到cpu, 后台线程上色并写PNG
+                    writer.submit(paths[0], outputs.argmax(1).to(torch.uint8), targets_cpu)
+
+                self.meter.update_confusion_matrix(outputs, targets)
+
+        if writer is not None:
+            writer.close()
+
+        # 所有rank的混淆矩阵all_reduce一次，得到全局精确的pixAcc, mIoU, Dice, fwIoU
+        if distributed:
+            self.meter.reduce_seg_metrics(device=device)
+        seg_metrics = self.meter.get_seg_metrics()
+        labels_dict = self.dataloader.dataset.labels_dict
+        for key in ("Class_IoU", "Class_Dice"):
+            seg_metrics[key] = {labels_dict[str(k)]: v for k, v in seg_metrics[key].items()}
+        self.seg_metrics = seg_metrics  # 所有指标, 包括Mean_Dice, Class_Dice, FWIoU
+        pixAcc, mIoU, Class_IoU_dict = seg_metrics["Pixel_Accuracy"], seg_metrics["Mean_IoU"], seg_metrics["Class_IoU"]
 
         # synchronize()
         return pixAcc, mIoU, Class_IoU_dict
+
+
+class SegMaskWriter:
+    """
+    save_pic时的预测mask写入(生产者/消费者):
+        GPU循环提交每个batch的argmax结果(uint8, non_blocking拷贝到pinned memory),
+        线程池拷贝原图、用缓存的调色板上色、编码PNG; 未完成的batch数超过max_pending时等待最早的batch
+    """
+    def __init__(self, output_dir, num_classes, num_workers=4, max_pending=64):
+        self.pic_path = os.path.join(output_dir, "pictures")
+        os.makedirs(self.pic_path, exist_ok=True)
+        self.lut = get_palette_lut(num_classes)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = deque()
+        self.max_pending = max_pending
+
+    def submit(self, paths, preds, targets):
+        """
+        :param paths: list of str 图片路径
+        :param preds: tensor (b, h, w) uint8 预测的类别(device上)
+        :param targets: tensor (b, h, w) cpu上的标签
+        """
+        event = None
+        if preds.is_cuda:
+            preds_cpu = torch.empty(preds.shape, dtype=torch.uint8, pin_memory=True)
+            preds_cpu.copy_(preds, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            preds_cpu = preds
+        self.pending.append(self.pool.submit(self._write, list(paths), preds_cpu, targets, event))
+
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.max_pending):
+            self._wait_next()
+
+    def _write(self, paths, preds, targets, event):
+        """
+        拷贝原图, 保存预测mask和标签mask, 在线程池中执行
+        """
+        if event is not None:
+            event.synchronize()     # 等待non_blocking拷贝完成
+        preds, targets = preds.numpy(), targets.numpy()
+        for path_img, pred, target in zip(paths, preds, targets):
+            name = os.path.basename(path_img)[:-4]
+            shutil.copy(path_img, os.path.join(self.pic_path, name + ".jpg"))
+            colorize_mask_lut(pred, self.lut).save(os.path.join(self.pic_path, name + "_pred.png"))
+            colorize_mask_lut(target, self.lut).save(os.path.join(self.pic_path, name + "_label.png"))
+
+    def _wait_next(self):
+        future = self.pending.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            logger.error("save pictures failed: {}".format(e))
+
+    def close(self):
+        """等待所有图片写完"""
+        while self.pending:
+            self._wait_next()
+        self.pool.shutdown()
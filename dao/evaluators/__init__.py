@@ -11,6 +11,11 @@ from .ClsEvaluator import ClsEvaluator
 
 # 分割
 from .SegEvaluator import SegEvaluator
+from .seg_inference import SegInference
 
 # 目标检测
 from .DetEvaluator import DetEvaluator
+from .postprocess import DetPostprocess
+
+# 验证策略: 子集验证/整个验证集验证
+from .eval_policy import EvalPolicy
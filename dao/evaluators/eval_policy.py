@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+验证策略: 训练中间的epoch只验证验证集的子集, 在里程碑epoch和最后一个epoch验证整个验证集
+    配置文件 exp.trainer.eval_policy, 例如:
+        "eval_policy": {"subset": 0.2, "mode": "stratified", "full_interval": 10, "milestones": [50, 80]}
+"""
+import math
+from statistics import NormalDist
+from loguru import logger
+
+import numpy as np
+
+__all__ = ['EvalPolicy']
+
+
+class EvalPolicy:
+    def __init__(self, subset=1.0, mode="random", full_interval=0, milestones=(), seed=0, confidence=0.95):
+        """
+        :param subset: float(0, 1]为子集比例, int(>1)为子集样本数, 1.0表示总是验证整个验证集
+        :param mode: str random随机子集, stratified按类别分层采样(数据集没有类别标签时退化为random)
+        :param full_interval: int 每full_interval个epoch验证一次整个验证集, 0表示不按间隔
+        :param milestones: list of int 验证整个验证集的epoch(从1开始计数)
+        :param seed: int 随机种子, 子集在整个训练中固定, 不同epoch的子集指标可以直接比较
+        :param confidence: float 子集指标置信区间的置信度
+        """
+        assert mode in ("random", "stratified"), "mode must be random or stratified, but got {}".format(mode)
+        self.subset = subset
+        self.mode = mode
+        self.full_interval = full_interval
+        self.milestones = set(milestones)
+        self.seed = seed
+        self.confidence = confidence
+        self._indices = None    # 缓存的子集下标
+        self.num_samples = 0    # 上一次验证的样本数
+
+    def is_full(self, epoch, max_epoch):
+        """
+        :param epoch: int 当前epoch(从0开始计数)
+        :param max_epoch: int 总epoch数
+        :return: bool 是否验证整个验证集
+        """
+        epoch = epoch + 1
+        if isinstance(self.subset, float) and self.subset >= 1:
+            return True
+        if epoch >= max_epoch or epoch in self.milestones:
+            return True
+        return self.full_interval > 0 and epoch % self.full_interval == 0
+
+    def apply(self, evaluator, epoch, max_epoch):
+        """
+        Function: 设置evaluator.dataloader的sampler为子集或整个验证集
+
+        :return: bool 是否验证整个验证集
+        """
+        dataset, sampler = evaluator.dataloader.dataset, evaluator.dataloader.sampler
+        assert hasattr(sampler, "set_subset"), "EvalPolicy needs InferenceSampler in eval dataloader"
+        if self.is_full(epoch, max_epoch):
+            sampler.set_subset(None)
+            self.num_samples = len(dataset)
+            return True
+        if self._indices is None:
+            self._indices = self._select(dataset)
+            logger.info("eval policy: {} subset of {}/{} samples".format(self.mode, len(self._indices), len(dataset)))
+        sampler.set_subset(self._indices)
+        self.num_samples = len(self._indices)
+        return False
+
+    def _subset_size(self, size):
+        n = int(round(self.subset * size)) if isinstance(self.subset, float) else int(self.subset)
+        return min(max(n, 1), size)
+
+    def _select(self, dataset):
+        """
+        :return: list of int 排好序的子集下标, 所有rank相同
+        """
+        size = len(dataset)
+        n = self._subset_size(size)
+        rng = np.random.RandomState(self.seed)
+        labels = self._labels(dataset) if self.mode == "stratified" else None
+        if labels is None:
+            if self.mode == "stratified":
+                logger.warning("{} has no class labels, use random subset".format(type(dataset).__name__))
+            return sorted(rng.choice(size, n, replace=False).tolist())
+
+        # 每个类别按比例采样, 每个类别至少1个样本
+        indices = []
+        labels = np.asarray(labels)
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            k = min(len(members), max(1, int(round(n * len(members) / size))))
+            indices += rng.choice(members, k, replace=False).tolist()
+        return sorted(indices)
+
+    @staticmethod
+    def _labels(dataset):
+        """
+        分类数据集的类别标签(ClsDataset.ids为(img_path, label_id)), 其他数据集返回None
+        """
+        ids = getattr(dataset, "ids", None)
+        if not ids or not isinstance(ids[0], (tuple, list)) or len(ids[0]) != 2:
+            return None
+        return [label for _, label in ids]
+
+    def confidence_interval(self, score, scale=1.0):
+        """
+        Function: 子集指标的Wilson置信区间, score看作num_samples个样本上的比例;
+            对top1是精确的二项分布区间, 对mIoU/mAP等非逐样本比例的指标是近似值
+
+        :param score: float 子集上的指标
+        :param scale: float 指标的尺度, 百分比为100
+        :return: (low, high) 与score相同尺度
+        """
+        n = max(self.num_samples, 1)
+        p = min(max(score / scale, 0.0), 1.0)
+        z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+        center = (p + z * z / (2 * n)) / (1 + z * z / n)
+        half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+        return (center - half) * scale, (center + half) * scale
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+目标检测后处理, YOLOv3/YOLOX的验证(DetEvaluator)和DetDemo共用, 配置文件的evaluator中:
+    "evaluator": {..., "postprocess": {"type": "DetPostprocess", "kwargs": {"conf_type": "score", "pre_topk": 1000, "max_det": 300}}}
+    DetDemo读取同一个key(exp.evaluator.postprocess), demo配置没有evaluator时读取顶层的exp.postprocess;
+    都没有配置时为YOLOv3的后处理(conf_type="obj", weighted=True)
+"""
+from dao.register import Registers
+from dao.utils import batched_postprocess
+
+__all__ = ['DetPostprocess']
+
+
+@Registers.postprocessors.register
+class DetPostprocess:
+    def __init__(self, conf_thres=0.5, nms_thres=0.5, conf_type="obj", class_agnostic=False, weighted=False,
+                 pre_topk=None, max_det=None, num_classes=None):
+        """
+        :param conf_thres: float 置信度阈值
+        :param nms_thres: float NMS的IoU阈值
+        :param conf_type: str "obj"过滤obj_conf(YOLOv3), "score"过滤obj_conf*cls_conf(YOLOX)
+        :param class_agnostic: bool 不同类别的框之间也做NMS
+        :param weighted: bool 被抑制的框按obj_conf加权合并到保留框(原YOLOv3的weighted NMS)
+        :param pre_topk: int 每张图片NMS前只保留分数最高的pre_topk个框
+        :param max_det: int 每张图片最多输出的框数
+        :param num_classes: int 类别数, None时从模型输出推断
+        """
+        self.conf_thres = conf_thres
+        self.nms_thres = nms_thres
+        self.kwargs = dict(conf_type=conf_type, class_agnostic=class_agnostic, weighted=weighted,
+                           pre_topk=pre_topk, max_det=max_det, num_classes=num_classes)
+
+    def __call__(self, prediction, conf_thres=None, nms_thres=None):
+        """
+        :param prediction: [B, N, 5+num_classes] 模型输出(cx, cy, w, h, obj_conf, cls_conf...)
+        :param conf_thres: float 覆盖初始化时的conf_thres
+        :param nms_thres: float 覆盖初始化时的nms_thres
+        :return: list of [n, 7] (x1, y1, x2, y2, obj_conf, class_conf, class_pred) 或 None
+        """
+        return batched_postprocess(prediction,
+                                   conf_thre=self.conf_thres if conf_thres is None else conf_thres,
+                                   nms_thre=self.nms_thres if nms_thres is None else nms_thres,
+                                   **self.kwargs)
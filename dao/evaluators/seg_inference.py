@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+分割推理(TTA): 整图/滑窗推理 + 多尺度 + 水平翻转, SegEvaluator和SegDemo共用, 配置文件中:
+    "inference": {"type": "SegInference",
+                  "kwargs": {"mode": "slide", "crop_size": [480, 480], "stride": [320, 320],
+                             "scales": [0.75, 1.0, 1.25], "flip": true}}
+    滑窗推理时验证/demo的transforms不需要Resize到固定大小
+"""
+import torch
+import torch.nn.functional as F
+
+from dao.register import Registers
+
+__all__ = ['SegInference']
+
+
+@Registers.seg_inferences.register
+class SegInference:
+    def __init__(self, mode="whole", crop_size=None, stride=None, scales=(1.0,), flip=False,
+                 blend="gaussian", sigma=0.125, window_batch=8):
+        """
+        :param mode: str whole整图推理, slide滑窗推理
+        :param crop_size: [h, w] 滑窗大小
+        :param stride: [h, w] 滑窗步长, 默认为crop_size的2/3
+        :param scales: list of float 多尺度, 每个尺度的结果resize回原图大小后平均
+        :param flip: bool 是否加上水平翻转
+        :param blend: str gaussian窗口中心权重大、边缘权重小的高斯加权, mean平均
+        :param sigma: float 高斯权重的标准差(相对于crop_size)
+        :param window_batch: int 每次前向的窗口数, 每个窗口包含batch中所有图片
+        """
+        assert mode in ("whole", "slide"), "mode must be whole or slide, but got {}".format(mode)
+        assert mode == "whole" or crop_size is not None, "slide mode needs crop_size"
+        assert blend in ("gaussian", "mean"), "blend must be gaussian or mean, but got {}".format(blend)
+        self.mode = mode
+        self.crop_size = tuple(crop_size) if crop_size is not None else None
+        self.stride = tuple(stride) if stride is not None else \
+            (tuple(max(c * 2 // 3, 1) for c in self.crop_size) if self.crop_size is not None else None)
+        self.scales = list(scales)
+        self.flip = flip
+        self.blend = blend
+        self.sigma = sigma
+        self.window_batch = window_batch
+        self._weight = None     # 缓存的窗口权重 (1, 1, ch, cw)
+
+    def __call__(self, model, imgs):
+        """
+        :param model: 分割模型, 输出(b, num_classes, h, w)
+        :param imgs: tensor (b, c, h, w)
+        :return: tensor (b, num_classes, h, w) float32, 所有TTA结果softmax概率的平均, 没有TTA时为模型输出
+        """
+        h, w = imgs.shape[-2:]
+        views = [(scale, flip) for scale in self.scales for flip in ([False, True] if self.flip else [False])]
+        if len(views) == 1 and views[0][0] == 1:
+            return self._infer(model, imgs).float()
+
+        output = None   # 预先分配的累加buffer
+        for scale, flip in views:
+            x = imgs if scale == 1 else F.interpolate(imgs, scale_factor=scale, mode="bilinear", align_corners=False)
+            x = x.flip(-1) if flip else x
+            logits = self._infer(model, x)
+            logits = logits.flip(-1) if flip else logits
+            if logits.shape[-2:] != (h, w):
+                logits = F.interpolate(logits.float(), size=(h, w), mode="bilinear", align_corners=False)
+            if output is None:
+                output = torch.zeros((imgs.shape[0], logits.shape[1], h, w), dtype=torch.float32, device=imgs.device)
+            output += logits.float().softmax(1)
+        return output.div_(len(views))
+
+    def _infer(self, model, x):
+        return self._forward(model, x, x.shape[-2:]) if self.mode == "whole" else self._slide(model, x)
+
+    @staticmethod
+    def _forward(model, x, size):
+        output = model(x)
+        if isinstance(output, (tuple, list)):   # 带辅助分支的模型只取主分支
+            output = output[0]
+        if output.shape[-2:] != tuple(size):
+            output = F.interpolate(output, size=size, mode="bilinear", align_corners=False)
+        return output
+
+    def _window_weight(self, device):
+        if self._weight is None or self._weight.device != device:
+            ch, cw = self.crop_size
+            if self.blend == "gaussian":
+                ys = torch.arange(ch, dtype=torch.float32, device=device) - (ch - 1) / 2
+                xs = torch.arange(cw, dtype=torch.float32, device=device) - (cw - 1) / 2
+                gy = torch.exp(-ys ** 2 / (2 * (self.sigma * ch) ** 2))
+                gx = torch.exp(-xs ** 2 / (2 * (self.sigma * cw) ** 2))
+                weight = (gy[:, None] * gx[None, :]).clamp_(min=1e-3)  # 边缘权重不为0, 图片边缘只被一个窗口覆盖
+                weight /= weight.max()
+            else:
+                weight = torch.ones(ch, cw, device=device)
+            self._weight = weight[None, None]
+        return self._weight
+
+    @staticmethod
+    def _starts(size, crop, stride):
+        starts = list(range(0, max(size - crop, 0) + 1, stride))
+        if starts[-1] + crop < size:    # 最后一个窗口对齐到边缘
+            starts.append(size - crop)
+        return starts
+
+    def _slide(self, model, x):
+        """
+        滑窗推理: 同一批窗口(window_batch个位置 x batch中所有图片)拼成一个batch前向,
+        logits按窗口权重累加到预先分配的buffer, 最后除以权重和
+        """
+        b, _, h, w = x.shape
+        ch, cw = self.crop_size
+        pad_h, pad_w = max(ch - h, 0), max(cw - w, 0)   # 图片小于窗口时padding
+        if pad_h or pad_w:
+            x = F.pad(x, (0, pad_w, 0, pad_h))
+        H, W = x.shape[-2:]
+        weight = self._window_weight(x.device)
+        windows = [(y, x0) for y in self._starts(H, ch, self.stride[0]) for x0 in self._starts(W, cw, self.stride[1])]
+
+        logits_sum, weight_sum = None, torch.zeros((1, 1, H, W), dtype=torch.float32, device=x.device)
+        for i in range(0, len(windows), self.window_batch):
+            chunk = windows[i:i + self.window_batch]
+            crops = torch.cat([x[:, :, y:y + ch, x0:x0 + cw] for y, x0 in chunk])
+            logits = self._forward(model, crops, (ch, cw)).float()
+            if logits_sum is None:
+                logits_sum = torch.zeros((b, logits.shape[1], H, W), dtype=torch.float32, device=x.device)
+            for j, (y, x0) in enumerate(chunk):
+                logits_sum[:, :, y:y + ch, x0:x0 + cw] += logits[j * b:(j + 1) * b] * weight
+                weight_sum[:, :, y:y + ch, x0:x0 + cw] += weight
+        return logits_sum.div_(weight_sum)[:, :, :h, :w]
@@ -15,7 +15,7 @@ from .backbone import (
     resnet18, resnet34, resnet50, resnet101, resnet152,
     resnext50_32x4d, resnext101_32x8d
 )
-from .utils import build_targets, to_cpu, Conv
+from .utils import build_targets, Conv
 
 from dao.register import Registers
 
@@ -138,9 +138,24 @@ class YOLOv3(nn.Module):
         self.anchor_w[grid_index] = self.scaled_anchors[grid_index][:, 0:1].view((1, self.num_anchors, 1, 1))   # size(1,3,1,1), 一个grid中三个anchor的w
         self.anchor_h[grid_index] = self.scaled_anchors[grid_index][:, 1:2].view((1, self.num_anchors, 1, 1))   # size(1,3,1,1), 一个grid中三个anchor的h
 
-    def forward(self, x, targets=None):  # x:torch.Size([32, 3, 416, 416]), VOC
+    def forward(self, x, targets=None, counts=None):  # x:torch.Size([32, 3, 416, 416]), VOC
+        """
+        :param targets: [N, 6] 或 DetectionCollate(max_boxes)填充的 [B, max_boxes, 6]
+        :param counts: [B] 填充targets时每张图片的bbox数量, None时按(w, h)不全为0判断填充行
+        """
         # 1. 额外操作
         self.input_size = x.shape[2]
+        valid = None
+        if targets is not None and targets.dim() == 3:
+            # 保持填充的布局展平为[B * max_boxes, 6], 用valid标记填充行, 不用布尔索引(同步host)去掉填充行
+            B, M = targets.shape[:2]
+            if counts is not None:
+                valid = torch.arange(M, device=targets.device)[None] < counts[:, None]
+            else:
+                valid = targets[..., 4:6].sum(dim=-1) > 0
+            targets = targets.clone()
+            targets[..., 0] = torch.arange(B, device=targets.device, dtype=targets.dtype)[:, None]   # 切分micro-batch后仍从0开始
+            targets, valid = targets.view(-1, 6), valid.view(-1)
         # Tensors for cuda support
         FloatTensor = torch.cuda.FloatTensor if x.is_cuda else torch.FloatTensor
         LongTensor = torch.cuda.LongTensor if x.is_cuda else torch.LongTensor
@@ -225,6 +240,7 @@ class YOLOv3(nn.Module):
                     target=targets,  # 标签 size(N个bbox，6), 6代表的含义（batchsize id, cls id，cx（0～1，相对于整张图),cy（0～1，相对于整张图）,w（0～1，相对于整张图）,h（0～1，相对于整张图）
                     anchors=self.scaled_anchors[i],  # 相对于grid * grid大小的anchor
                     ignore_thres=self.ignore_thres,  # 忽略阈值
+                    valid=valid,  # 填充的targets中有效的bbox, None表示全部有效
                 )
 
                 # Loss : Mask outputs to ignore non-existing objects (except with conf. loss)
@@ -253,20 +269,21 @@ class YOLOv3(nn.Module):
                 recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
                 recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
 
+                # 保存device上的tensor, 由trainer在log时再同步到host
                 self.metrics[i] = {
-                    "loss": to_cpu(total_loss).item(),
-                    "x": to_cpu(loss_x).item(),
-                    "y": to_cpu(loss_y).item(),
-                    "w": to_cpu(loss_w).item(),
-                    "h": to_cpu(loss_h).item(),
-                    "conf": to_cpu(loss_conf).item(),
-                    "cls": to_cpu(loss_cls).item(),
-                    "cls_acc": to_cpu(cls_acc).item(),
-                    "recall50": to_cpu(recall50).item(),
-                    "recall75": to_cpu(recall75).item(),
-                    "precision": to_cpu(precision).item(),
-                    "conf_obj": to_cpu(conf_obj).item(),
-                    "conf_noobj": to_cpu(conf_noobj).item(),
+                    "loss": total_loss.detach(),
+                    "x": loss_x.detach(),
+                    "y": loss_y.detach(),
+                    "w": loss_w.detach(),
+                    "h": loss_h.detach(),
+                    "conf": loss_conf.detach(),
+                    "cls": loss_cls.detach(),
+                    "cls_acc": cls_acc.detach(),
+                    "recall50": recall50.detach(),
+                    "recall75": recall75.detach(),
+                    "precision": precision.detach(),
+                    "conf_obj": conf_obj.detach(),
+                    "conf_noobj": conf_noobj.detach(),
                     "grid_size": grid_size,
                 }
                 yolo_outputs.append(output)
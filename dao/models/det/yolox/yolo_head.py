@@ -9,7 +9,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from dao.utils import bboxes_iou
+from dao.utils import box_iou
 
 from .losses import IOUloss
 from .network_blocks import BaseConv, DWConv
@@ -496,7 +496,7 @@ class YOLOXHead(nn.Module):
             bboxes_preds_per_image = bboxes_preds_per_image.cpu()
 
         # 计算预测框和gt框的配对iou， torch.Size([3, 4]) torch.Size([1750, 4])-》torch.Size([3, 1750])
-        pair_wise_ious = bboxes_iou(gt_bboxes_per_image, bboxes_preds_per_image, False)
+        pair_wise_ious = box_iou(gt_bboxes_per_image, bboxes_preds_per_image, fmt="cxcywh", eps=0)
 
         gt_cls_per_image = (
             F.one_hot(gt_classes.to(torch.int64), self.num_classes)     # gt_classes:3 --> torch.Size([3, 80])
@@ -25,7 +25,10 @@ class YOLOX_(nn.Module):
         self.backbone = YOLOPAFPN(**backbone)
         self.head = YOLOXHead(**head)
 
-    def forward(self, x, targets=None):
+    def forward(self, x, targets=None, counts=None):
+        """
+        :param counts: [B] DetectionCollate(max_boxes)返回的每张图片的bbox数量, 与YOLOv3接口一致; head按labels[b, :num_gt]读取, 不使用
+        """
         # fpn output content features of [dark3, dark4, dark5]
         fpn_outs = self.backbone(x)
 
@@ -81,6 +81,8 @@ class Registers:
     # 3. dataset&dataloader
     datasets = Register("datasets")         # 数据集
     dataloaders = Register("dataloaders")   # 数据加载器
+    transforms = Register("transforms")     # 自定义数据增强(albumentations接口)
+    gpu_transforms = Register("gpu_transforms")     # GPU batch数据增强
 
     # 4. loss
     losses = Register("losses")             # 损失函数
@@ -90,9 +92,12 @@ class Registers:
 
     # 6. evaluator
     evaluators = Register("evaluators")     # 验证器
+    postprocessors = Register("postprocessors")     # 目标检测后处理(NMS)
+    seg_inferences = Register("seg_inferences")     # 分割推理(滑窗/多尺度/翻转TTA)
 
     # 7. trainer
     trainers = Register("trainers")         # 训练过程
+    hooks = Register("hooks")               # 训练过程中的hooks
 
 
 def import_all_modules_for_register(custom_modules=None):
@@ -6,8 +6,13 @@
 
 # 所有model在__init__.py中导入，是为了自动注册到Registers中
 
+# 训练引擎与hooks
+from .base_trainer import BaseTrainer
+from .hooks import Hook, ProfilerHook
+from .async_eval import AsyncEvalRunner
+
 # 分类
-from .trainerCls import ClsTrainer, ClsEval, ClsDemo, ClsExport
+from .trainerCls import ClsTrainer, ClsEval, ClsDemo, ClsExport, ClsAnalysis
 
 # 异常检测
 from .trainerAnomaly import AnomalyTrainer, AnomalyDemo, AnomalyExport  # 使用马氏距离计算，导出ONNX出错
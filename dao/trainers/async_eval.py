@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+训练中异步验证: 在rank0上用后台线程+独立CUDA stream验证模型快照, 训练继续进行
+    配置文件 exp.trainer.async_eval: true 启用
+"""
+import threading
+from loguru import logger
+
+import torch
+
+__all__ = ['AsyncEvalRunner']
+
+
+class AsyncEvalRunner:
+    def __init__(self, evaluate_fn):
+        """
+        :param evaluate_fn: function(model, epoch) -> (score, metrics), 在后台线程中执行, 只计算指标, 日志和best权重由训练线程处理
+        """
+        self.evaluate_fn = evaluate_fn
+        self.stream = torch.cuda.Stream()
+        self._thread = None
+        self._result = None
+
+    def busy(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, model, epoch):
+        """
+        :param model: 模型快照(与训练模型不共享参数)
+        :param epoch: 快照对应的epoch
+        """
+        assert not self.busy(), "previous async eval is still running"
+        self.stream.wait_stream(torch.cuda.current_stream())    # 等待快照拷贝完成
+        self._thread = threading.Thread(target=self._run, args=(model, epoch), daemon=True)
+        self._thread.start()
+
+    def _run(self, model, epoch):
+        try:
+            with torch.cuda.stream(self.stream):    # 当前stream是线程局部的, 不影响训练线程
+                score, metrics = self.evaluate_fn(model, epoch)
+            self.stream.synchronize()
+            self._result = (model, epoch, score, metrics)
+        except Exception as e:
+            logger.error("async eval of epoch {} failed: {}".format(epoch + 1, e))
+
+    def poll(self):
+        """
+        :return: 验证完成时返回(model, epoch, score, metrics), 否则返回None
+        """
+        if self.busy() or self._result is None:
+            return None
+        result, self._result = self._result, None
+        return result
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
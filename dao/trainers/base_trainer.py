@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+训练引擎BaseTrainer
+    Cls/Seg/Det/Anomaly Trainer共用的训练流程(日志, resume, DDP, EMA, 优化, 日志输出, 保存权重)都在这里,
+    子类只需实现与任务相关的部分:
+        _build_model, _build_prefetcher, _build_loss, _build_evaluator, _build_train_metrics,
+        _train_one_iter, _forward, _evaluate, _log_eval, _log_str, _log_tensorboard
+    通用功能(例如profiler)以Hook的形式注册到Registers.hooks, 在exp.trainer.hooks中启用
+    exp.trainer.eval_policy(可选)配置子集验证, 只有整个验证集的验证结果用于选择best权重
+    exp.trainer.async_eval为true时, 验证在rank0的后台线程(独立CUDA stream)中进行, 训练不等待验证
+"""
+import os   # 导入系统相关库
+import json
+import contextlib
+import bisect
+import datetime
+import time
+import shutil
+from copy import deepcopy
+from loguru import logger
+
+import torch    # 深度学习相关库
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.tensorboard import SummaryWriter
+
+from dao.register import Registers
+from dao.dataloaders.augments import get_transformerGPU
+from dao.trainers.hooks import Hook
+from dao.trainers.async_eval import AsyncEvalRunner
+from dao.evaluators.eval_policy import EvalPolicy
+from dao.dataloaders.samplers import InfiniteSampler
+from dao.utils import (       # 导入Train util库
+    setup_logger,       # 日志设置
+    load_ckpt,          # 加载ckpt
+    load_checkpoint_file,   # 读取ckpt, 多卡时rank0读取后广播
+    AsyncCheckpointSaver,   # 异步存储ckpt
+    occupy_mem,         # 占据显存
+    gpu_mem_usage,      # 显存使用情况
+    FusedModelEMA,      # 指数移动平均
+    is_parallel,        # 是否时多卡模型
+    synchronize,        # 同步所有进程(GPU)
+    all_reduce_norm,    # BN 参数进行多卡同步
+    get_rank, get_local_rank, get_world_size,  # 导入分布式库
+    compile_model,      # torch.compile/TorchScript
+    get_memory_format,  # 内存格式
+)
+
+__all__ = ['BaseTrainer']
+
+
+class BaseTrainer:
+    loss_name = "loss"  # 日志和tensorboard中损失的名称
+    score_scale = 1.0   # _evaluate返回的score的尺度, 百分比为100
+
+    def __init__(self, exp, parser):
+        self.exp = exp  # DotMap 格式 的配置文件
+        self.parser = parser  # 命令行配置文件
+
+        self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')   # 此次trainer的开始时间
+        self.data_type = torch.float16 if self.parser.fp16 else torch.float32   # 使用的数据类型
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.parser.amp)  # 在训练开始之前实例化一个Grad Scaler对象
+        # 模型和输入的内存格式, channels_last配合AMP对CNN更快
+        self.memory_format = get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None)
+
+        # 梯度累加: 每个batch切分为accumulate个micro-batch, 显存不够时保持batch_size(与学习率)不变
+        self.accumulate = self.exp.trainer.accumulate if "accumulate" in self.exp.trainer else 1
+        assert self.accumulate >= 1, "exp.trainer.accumulate must >= 1"
+
+        # 按step/时间保存ckpt(可选), 0表示不保存; 只保留最近save_keep_last个
+        self.save_interval_iters = self.exp.trainer.save_interval_iters if "save_interval_iters" in self.exp.trainer else 0
+        self.save_interval_minutes = self.exp.trainer.save_interval_minutes if "save_interval_minutes" in self.exp.trainer else 0
+        self.save_keep_last = self.exp.trainer.save_keep_last if "save_keep_last" in self.exp.trainer else 3
+
+        # 异步验证(可选): rank0用模型快照验证, 训练继续; 上一次验证没结束时跳过本次验证(async_eval_wait为true时等待)
+        self.async_eval = self.exp.trainer.async_eval if "async_eval" in self.exp.trainer else False
+        self.async_eval_wait = self.exp.trainer.async_eval_wait if "async_eval_wait" in self.exp.trainer else False
+        # 验证策略(可选): 中间epoch只验证子集
+        self.eval_policy = EvalPolicy(**self.exp.trainer.eval_policy.toDict()) if "eval_policy" in self.exp.trainer else None
+
+        self._hooks = []
+        for hook_cfg in (self.exp.trainer.hooks if "hooks" in self.exp.trainer else []):
+            hook = Registers.hooks.get(hook_cfg.type)(**(hook_cfg.kwargs if "kwargs" in hook_cfg else {}))
+            self.register_hook(hook, priority=hook_cfg.priority if "priority" in hook_cfg else None)
+
+    # ------------------------------------------ hooks ------------------------------------------
+    def register_hook(self, hook, priority=None):
+        """
+        按priority从小到大插入hook, priority相同时按注册顺序执行
+
+        :param hook: Hook
+        :param priority: int, None表示使用hook.priority
+        """
+        assert isinstance(hook, Hook), "hook must be a subclass of Hook"
+        if priority is not None:
+            hook.priority = priority
+        index = bisect.bisect_right([h.priority for h in self._hooks], hook.priority)
+        self._hooks.insert(index, hook)
+
+    def call_hook(self, fn_name, *args, **kwargs):
+        for hook in self._hooks:
+            getattr(hook, fn_name)(self, *args, **kwargs)
+
+    # ------------------------------------------ loop ------------------------------------------
+    def run(self):
+        self._before_train()
+        self.call_hook("before_train")
+        for self.epoch in range(self.start_epoch, self.max_epoch):  # epoch
+            self._before_epoch()
+            self.call_hook("before_epoch")
+            for self.iter in range(self.start_iter, self.max_iter):  # iter, 从step ckpt resume时从start_iter开始
+                self._before_iter()
+                self.call_hook("before_iter")
+                self._train_one_iter()
+                self._after_iter()
+                self.call_hook("after_iter")
+            self.start_iter = 0
+            self._after_epoch()
+            self.call_hook("after_epoch")
+        self._after_train()
+        self.call_hook("after_train")
+
+    def _setup_logger(self):
+        """
+        设置日志目录, 日志文件, config.json和tensorboard
+        """
+        if self.parser.record:
+            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name, self.start_time)    # 日志目录
+        else:
+            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name)  # 日志目录
+            if get_rank() == 0:
+                if os.path.exists(self.output_dir):  # 如果存在self.output_dir删除
+                    try:
+                        shutil.rmtree(self.output_dir)
+                    except Exception as e:
+                        logger.info("global rank {} can't remove tree {}".format(get_rank(), self.output_dir))
+        setup_logger(self.output_dir, distributed_rank=get_rank(), filename=f"train_log.txt", mode="a")  # 设置只有rank=0输出日志，并重定向
+        logger.info("....... Train Before, Setting something ...... ")
+        logger.info("1. Logging Setting ...")
+        logger.info(f"create log file {self.output_dir}/train_log.txt")  # log txt
+        self.exp.pprint(pformat='json') if self.parser.detail else None  # 根据parser.detail来决定日志输出的详细
+        with open(os.path.join(self.output_dir, 'config.json'), 'w') as f:    # 将配置文件写到self.output_dir
+            json.dump(dict(self.exp), f)
+        logger.info(f"create Tensorboard log {self.output_dir}")
+        self.tblogger = SummaryWriter(self.output_dir) if get_rank() == 0 else None  # log tensorboard
+
+    def _before_train(self):
+        """
+        1.Logger Setting
+        2.Model Setting;
+        3.Optimizer Setting;
+        4.Resume setting;
+        5.DataLoader Setting;
+        6.Loss Setting;
+        7.Scheduler Setting;
+        8.DDP/EMA Setting;
+        9.Evaluator Setting;
+        """
+        self._setup_logger()
+        self.ckpt_saver = AsyncCheckpointSaver(self.output_dir, keep_last=self.save_keep_last) if get_rank() == 0 else None
+        self._last_save_time = time.time()
+
+        logger.info("2. Model Setting ...")
+        torch.cuda.set_device(get_local_rank())
+        model = self._build_model()
+        model.to("cuda:{}".format(get_local_rank()), memory_format=self.memory_format)    # model to self.device
+
+        logger.info("3. Optimizer Setting")
+        self.optimizer = Registers.optims.get(self.exp.optimizer.type)(model=model, **self.exp.optimizer.kwargs)
+
+        logger.info("4. Resume/FineTuning Setting ...")
+        model = self._resume_train(model)
+
+        logger.info("5. Dataloader Setting ... ")
+        self.max_epoch = self.exp.trainer.max_epochs
+        train_loader = Registers.dataloaders.get(self.exp.dataloader.type)(
+            is_distributed=get_world_size() > 1,
+            dataset=self.exp.dataloader.dataset,
+            seed=self.parser.seed,
+            **self.exp.dataloader.kwargs
+        )
+        self.max_iter = len(train_loader)
+        # resume时InfiniteSampler从断点继续, 否则会从seed的第一个permutation重新采样
+        sampler = getattr(train_loader.batch_sampler, "sampler", None)
+        if isinstance(sampler, InfiniteSampler) and (self.start_epoch or self.start_iter):
+            sampler.set_start((self.start_epoch * self.max_iter + self.start_iter) *
+                              train_loader.batch_sampler.batch_size * get_world_size())
+        if self.accumulate > 1:
+            logger.info("gradient accumulation: {} micro-batches per batch".format(self.accumulate))
+        logger.info("init prefetcher, this might take one minute or less...")
+        # to solve https://github.com/pytorch/pytorch/issues/11201
+        torch.multiprocessing.set_sharing_strategy('file_system')
+        self.train_loader = self._build_prefetcher(train_loader)
+
+        # GPU batch数据增强(可选), 在prefetcher拷贝到GPU之后执行, 配置与dataset.transforms相同
+        self.gpu_transforms = get_transformerGPU(self.exp.dataloader.gpu_transforms.kwargs) \
+            if "gpu_transforms" in self.exp.dataloader else None
+
+        logger.info("6. Loss Setting ... ")
+        self._build_loss()
+
+        logger.info("7. Scheduler Setting ... ")
+        self.lr_scheduler = Registers.schedulers.get(self.exp.lr_scheduler.type)(
+            lr=self.exp.optimizer.kwargs.lr,
+            iters_per_epoch=self.max_iter,
+            total_epochs=self.exp.trainer.max_epochs,
+            **self.exp.lr_scheduler.kwargs
+        )
+
+        logger.info("8. Other Setting ... ")
+        logger.info("occupy mem")
+        if self.parser.occupy:
+            occupy_mem(get_local_rank())
+
+        logger.info("Model DDP Setting")
+        if get_world_size() > 1:
+            model = DDP(model, device_ids=[get_local_rank()], broadcast_buffers=False, output_device=[get_local_rank()])
+
+        logger.info("Model EMA Setting")
+        # Exponential moving average
+        # 用EMA方法对模型的参数做平均，以提高测试指标并增加模型鲁棒性（减少模型权重抖动）
+        self.use_model_ema = self.parser.ema
+        if self.use_model_ema:
+            self.ema_model = self._build_ema(model)
+
+        self.model = model
+        self.model.train()
+
+        # 编译(可选), 编译后的模型只用于训练前向, DDP(no_sync), EMA和保存权重仍使用self.model
+        self.train_model = compile_model(self.model, **self.exp.trainer.compile.toDict()) \
+            if "compile" in self.exp.trainer else self.model
+
+        logger.info("9. Evaluator Setting ... ")
+        if self.async_eval:     # 只有rank0验证, 不参与多卡通信
+            self.evaluator = self._build_evaluator(is_distributed=False) if get_rank() == 0 else None
+            self.async_evaluator = AsyncEvalRunner(
+                lambda model, epoch: self._run_evaluate(model, self.evaluator, epoch, False)) if get_rank() == 0 else None
+        else:
+            self.evaluator = self._build_evaluator(is_distributed=get_world_size() > 1)
+        self.train_metrics = self._build_train_metrics()
+        self.best_acc = 0
+        logger.info("Setting finished, training start ......")
+
+    def _before_epoch(self):
+        logger.info("---> start train epoch{}".format(self.epoch + 1))
+
+    def _before_iter(self):
+        pass
+
+    def _forward(self, inps, targets):
+        """
+        前向计算(在autocast中调用)
+
+        :return: (loss, outputs)
+        """
+        raise NotImplementedError
+
+    def _split_batch(self, inps, targets):
+        """
+        将一个batch沿batch维切分为self.accumulate个micro-batch
+
+        :return: list of (inps, targets)
+        """
+        return list(zip(inps.chunk(self.accumulate), targets.chunk(self.accumulate)))
+
+    def _forward_backward(self, inps, targets):
+        """
+        前向+反向, 梯度累加:
+            accumulate>1时把loader的batch(逻辑batch)切分为accumulate个micro-batch依次前向反向,
+            除最后一个micro-batch外都在DDP no_sync下反向, 梯度只在最后一次反向时all-reduce;
+            每个micro-batch的loss乘以micro-batch大小/batch大小(batch不能整除时, 例如epoch最后一个batch, micro-batch大小不等),
+            loss为样本平均时, 累加后的梯度与整个batch一次前向反向相同
+
+        :return: (loss, outputs) loss为整个batch的平均损失(detach), outputs为最后一个micro-batch的输出
+        """
+        self.optimizer.zero_grad()   # 梯度清零
+        micro_batches = self._split_batch(inps, targets) if self.accumulate > 1 else [(inps, targets)]
+        total_loss = 0
+        for i, (micro_inps, micro_targets) in enumerate(micro_batches):
+            no_sync = is_parallel(self.model) and i < len(micro_batches) - 1
+            weight = micro_inps.size(0) / inps.size(0)
+            with self.model.no_sync() if no_sync else contextlib.nullcontext():
+                with torch.cuda.amp.autocast(enabled=self.parser.amp):    # 开启auto cast的context manager语义（model+loss）
+                    loss, outputs = self._forward(micro_inps, micro_targets)
+                self.scaler.scale(loss * weight).backward()   # 反向传播；Scales loss. 为了梯度放大
+            total_loss += loss.detach() * weight
+        return total_loss, outputs
+
+    def _optimize(self):
+        """
+        参数更新, EMA更新, 学习率更新, 每个逻辑batch(不是micro-batch)调用一次
+
+        :return: lr
+        """
+        # scaler.step() 首先把梯度的值unscale回来.
+        # 如果梯度的值不是infs或者NaNs, 那么调用optimizer.step()来更新权重,
+        # 否则，忽略step调用，从而保证权重不更新（不被破坏）
+        self.scaler.step(self.optimizer)    # optimizer.step 进行参数更新
+        self.scaler.update()    # 准备着，看是否要增大scaler
+
+        if self.use_model_ema:
+            self.ema_model.update(self.model)
+
+        lr = self.lr_scheduler.update_lr(self.progress_in_iter + 1)
+        for param_group in self.optimizer.param_groups:
+            param_group["lr"] = lr
+        return lr
+
+    def _after_iter(self):
+        """
+        `after_iter` contains two parts of logic:
+            * log information
+            * reset train metrics
+            * save step checkpoint
+        """
+        self._save_step_ckpt()
+        if self.async_eval and get_rank() == 0:
+            self._poll_async_eval()
+        if (self.iter + 1) % self.exp.trainer.log_per_iter != 0:
+            return
+        self.train_metrics.synchronize()    # 只在log_per_iter时同步CUDA event计时, 所有rank都需要, 以释放event
+        if get_rank() == 0:
+            # 剩余时间（不包括evaluator过程）
+            left_iters = self.max_iter * self.max_epoch - (self.progress_in_iter + 1)
+            eta_seconds = (self.train_metrics.batch_time.avg + self.train_metrics.data_time.avg) * left_iters
+            eta_str = "ETA: {}".format(datetime.timedelta(seconds=int(eta_seconds)))
+
+            progress_str = f"epoch: {self.epoch + 1}/{self.max_epoch}, iter: {self.iter + 1}/{self.max_iter} "
+            loss_str = "{}:{:2f}".format(self.loss_name, self.train_metrics.total_loss.avg)
+            time_str = "iter time:{:2f}, data time:{:2f}".format(self.train_metrics.batch_time.avg, self.train_metrics.data_time.avg)
+
+            logger.info(", ".join(
+                [progress_str] + self._log_str() + [
+                    "mem: {:.0f}Mb".format(gpu_mem_usage()),
+                    time_str,
+                    loss_str,
+                    "lr: {:.3e}".format(self.train_metrics.lr),
+                    eta_str
+                ]
+            ))
+            self.tblogger.add_scalar('train/{}'.format(self.loss_name), self.train_metrics.total_loss.avg, self.progress_in_iter)
+            self.tblogger.add_scalar('train/lr', self.train_metrics.lr, self.progress_in_iter)
+            self._log_tensorboard()
+        self._reset_train_metrics()
+
+    def _save_step_ckpt(self):
+        """
+        每save_interval_iters个iter或每save_interval_minutes分钟保存一次ckpt, 参与last-k轮换
+        """
+        step = self.progress_in_iter + 1
+        by_iter = self.save_interval_iters > 0 and step % self.save_interval_iters == 0
+        by_time = self.save_interval_minutes > 0 and time.time() - self._last_save_time >= self.save_interval_minutes * 60
+        if by_iter or by_time:
+            self._save_ckpt("step_{}".format(step), rotate=True)
+            self._last_save_time = time.time()
+
+    def _after_epoch(self):
+        self._save_ckpt(ckpt_name="latest")
+
+        if (self.epoch + 1) % self.exp.trainer.eval_interval == 0:
+            all_reduce_norm(self.model)  # BN 参数进行多卡同步，保证不同卡参数的一致性
+            self._evaluate_and_save_model()
+
+    def _after_train(self):
+        if self.async_eval and get_rank() == 0:
+            self.async_evaluator.wait()     # 等待最后一次验证
+            self._poll_async_eval()
+        if self.ckpt_saver is not None:
+            self.ckpt_saver.wait()  # 等待后台写完
+        logger.info("Training of experiment is done and the best Acc is {:.2f}".format(self.best_acc))
+        logger.info("DONE")
+
+    # ------------------------------------------ eval/ckpt ------------------------------------------
+    @property
+    def eval_model(self):
+        """
+        验证和保存权重时使用的模型, 使用EMA时为EMA模型, 否则为去掉DDP的模型
+        """
+        if self.use_model_ema:
+            return self.ema_model.eval_module("cuda:{}".format(get_local_rank()))
+        model = self.model
+        if is_parallel(model):
+            model = model.module
+        return model
+
+    def _evaluate_and_save_model(self):
+        if self.async_eval:
+            self._submit_async_eval()
+            return
+        score, metrics = self._run_evaluate(self.eval_model, self.evaluator, self.epoch, get_world_size() > 1)
+        self.model.train()
+        update_best_ckpt = self._report_eval(score, metrics, self.epoch)
+        self.call_hook("on_eval", metrics)
+
+        synchronize()
+        self._save_ckpt("last_epoch", update_best_ckpt)
+
+    def _report_eval(self, score, metrics, epoch):
+        """
+        更新best_acc并输出验证结果, 只有整个验证集的结果(metrics["full_eval"])用于选择best权重
+
+        :return: update_best_ckpt
+        """
+        update_best_ckpt = metrics["full_eval"] and score > self.best_acc    # 子集的指标不用于选择best权重
+        if metrics["full_eval"]:
+            self.best_acc = max(self.best_acc, score)
+        if not metrics["full_eval"]:
+            low, high = metrics["score_ci"]
+            logger.info("subset eval of epoch {} on {} samples, score:{:.4f}, {:.0%} CI:[{:.4f}, {:.4f}]".format(
+                epoch + 1, metrics["num_samples"], score, self.eval_policy.confidence, low, high))
+        if update_best_ckpt:
+            logger.info("Best score - epoch:{}, score:{}".format(epoch + 1, score))
+        if get_rank() == 0:
+            self._log_eval(metrics, epoch, update_best_ckpt)
+        return update_best_ckpt
+
+    def _run_evaluate(self, evalmodel, evaluator, epoch, distributed):
+        """
+        按eval_policy选择子集或整个验证集, 然后调用_evaluate; 异步验证时在后台线程中调用, 只计算不输出
+
+        :return: (score, metrics) metrics中增加full_eval, 子集验证时增加score_ci置信区间和num_samples
+        """
+        full_eval = True
+        if self.eval_policy is not None:
+            full_eval = self.eval_policy.apply(evaluator, epoch, self.max_epoch)
+        score, metrics = self._evaluate(evalmodel, evaluator, epoch, distributed)
+        metrics["full_eval"] = full_eval
+        if not full_eval:
+            low, high = self.eval_policy.confidence_interval(score, scale=self.score_scale)
+            metrics["score_ci"] = (low, high)
+            metrics["num_samples"] = self.eval_policy.num_samples
+        return score, metrics
+
+    def _submit_async_eval(self):
+        """
+        rank0把当前验证模型的快照交给后台验证, 其他rank直接继续训练
+        """
+        if get_rank() != 0:
+            return
+        self._poll_async_eval()
+        if self.async_evaluator.busy():
+            if not self.async_eval_wait and self.epoch + 1 < self.max_epoch:   # 最后一个epoch总是验证
+                logger.info("async eval of last epoch is still running, skip eval of epoch {}".format(self.epoch + 1))
+                return
+            self.async_evaluator.wait()
+            self._poll_async_eval()
+        self._save_ckpt("last_eval")    # 与同步验证相同的完整ckpt(含optimizer), 验证结果为best时链接为best_ckpt.pth
+        snapshot = deepcopy(self.eval_model).eval()
+        self.async_evaluator.submit(snapshot, self.epoch)
+        logger.info("submit async eval of epoch {}".format(self.epoch + 1))
+
+    def _poll_async_eval(self):
+        """
+        rank0(主线程)取回已完成的异步验证结果, 输出日志, 调用on_eval hook, 为best时把提交验证时保存的last_eval ckpt链接为best
+        """
+        result = self.async_evaluator.poll()
+        if result is None:
+            return
+        _, epoch, score, metrics = result
+        update_best_ckpt = self._report_eval(score, metrics, epoch)
+        self.call_hook("on_eval", metrics)
+        logger.info("async eval of epoch {} done, score:{} - update_best_ckpt:{}".format(epoch + 1, score, update_best_ckpt))
+        if update_best_ckpt:
+            self.ckpt_saver.link_best("last_eval")
+
+    def _save_ckpt(self, ckpt_name, update_best_ckpt=False, rotate=False):
+        """
+        rank0异步保存ckpt, 快照到pinned CPU内存后由后台线程写文件
+
+        :param ckpt_name: 保存为{ckpt_name}_ckpt.pth
+        :param update_best_ckpt: 是否更新best_ckpt.pth
+        :param rotate: 是否参与last-k轮换(step ckpt)
+        """
+        if get_rank() == 0:
+            if self.use_model_ema:
+                self.ema_model.synchronize()    # 累加还在拷贝中的最后一次EMA更新
+            save_model = self.ema_model.ema if self.use_model_ema else self.model
+            logger.info("Save weights to {} - update_best_ckpt:{}".format(self.output_dir, update_best_ckpt))
+            # epoch中间保存时, resume从下一个iter继续
+            start_epoch, start_iter = (self.epoch + 1, 0) if self.iter + 1 >= self.max_iter else (self.epoch, self.iter + 1)
+            ckpt_state = {
+                "start_epoch": start_epoch,
+                "start_iter": start_iter,
+                "model": save_model.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "scaler": self.scaler.state_dict(),
+            }
+            self.ckpt_saver.save(ckpt_state, ckpt_name, is_best=update_best_ckpt, rotate=rotate)
+
+    def _resume_train(self, model):
+        """
+        如果args.resume为true，将args.ckpt权重resume；
+        如果args.resume为false，将args.ckpt权重fine turning；
+        :param model:
+        :return:
+        """
+        if self.exp.trainer.resume:
+            logger.info("resume training")
+            # 获取ckpt路径
+            assert self.exp.trainer.ckpt is not None
+            ckpt_file = self.exp.trainer.ckpt
+            # 加载ckpt
+            ckpt = load_checkpoint_file(ckpt_file, device="cuda:{}".format(get_local_rank()))   # rank0读取后广播
+            # resume the model/optimizer state dict
+            model.load_state_dict(ckpt["model"])
+            self.optimizer.load_state_dict(ckpt["optimizer"])
+            if "scaler" in ckpt:    # GradScaler的scale
+                self.scaler.load_state_dict(ckpt["scaler"])
+            # resume the training states variables
+            self.start_epoch = ckpt["start_epoch"]
+            self.start_iter = ckpt.get("start_iter", 0)
+            logger.info("loaded checkpoint '{}' (epoch {}, iter {})".format(self.exp.trainer.ckpt, self.start_epoch, self.start_iter))
+        else:
+            if self.exp.trainer.ckpt is not None:
+                logger.info("loading checkpoint for fine tuning")
+                ckpt_file = self.exp.trainer.ckpt
+                ckpt = load_checkpoint_file(ckpt_file, device="cuda:{}".format(get_local_rank()))["model"]
+                model = load_ckpt(model, ckpt)
+            self.start_epoch = 0
+            self.start_iter = 0
+
+        return model
+
+    @property
+    def progress_in_iter(self):
+        return self.epoch * self.max_iter + self.iter
+
+    # ------------------------------------------ 子类实现 ------------------------------------------
+    def _build_model(self):
+        raise NotImplementedError
+
+    def _build_prefetcher(self, train_loader):
+        raise NotImplementedError
+
+    def _build_loss(self):
+        pass
+
+    def _build_evaluator(self, is_distributed):
+        return Registers.evaluators.get(self.exp.evaluator.type)(
+            is_distributed=is_distributed,
+            dataloader=self.exp.evaluator.dataloader,
+            num_classes=self.exp.model.kwargs.num_classes,
+        )
+
+    def _build_train_metrics(self):
+        raise NotImplementedError
+
+    def _build_ema(self, model):
+        """
+        exp.trainer.ema(可选)配置decay, interval, device, 例如 {"decay": 0.9998, "interval": 4, "device": "cpu"}
+        """
+        ema_kwargs = dict(decay=0.9998)
+        if "ema" in self.exp.trainer:
+            ema_kwargs.update(self.exp.trainer.ema.toDict())
+        return FusedModelEMA(model, updates=self.max_iter * self.start_epoch + self.start_iter, **ema_kwargs)
+
+    def _train_one_iter(self):
+        raise NotImplementedError
+
+    def _evaluate(self, evalmodel, evaluator, epoch, distributed):
+        """
+        同步验证时在所有rank上调用; 异步验证时只在rank0的后台线程中调用(distributed=False),
+        因此只计算并返回指标, 不读写trainer状态(best_acc, tblogger等), 日志和tensorboard在_log_eval中输出
+
+        :param evalmodel: 验证模型
+        :param evaluator: 验证器
+        :param epoch: 验证的epoch
+        :param distributed: 是否多卡验证
+        :return: (score, metrics) score用于选择best权重, metrics为dict, 传给on_eval hook
+        """
+        raise NotImplementedError
+
+    def _log_eval(self, metrics, epoch, is_best):
+        """
+        rank0把验证结果写到tensorboard, 每次验证都调用
+
+        :param metrics: dict _evaluate返回的metrics
+        :param epoch: 验证的epoch
+        :param is_best: 是否为新的best(只有整个验证集的验证才可能为true)
+        """
+        pass
+
+    def _log_str(self):
+        """
+        :return: list of str, 额外的日志输出
+        """
+        return []
+
+    def _log_tensorboard(self):
+        pass
+
+    def _reset_train_metrics(self):
+        self.train_metrics.reset_metrics()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+训练引擎BaseTrainer的hooks
+    hook按priority从小到大执行(相同priority按注册顺序), 通过Registers.hooks注册,
+    配置文件中 exp.trainer.hooks 启用, 例如:
+        "hooks": [
+            {"type": "ProfilerHook", "priority": 50, "kwargs": {"wait": 10, "warmup": 2, "active": 5}}
+        ]
+"""
+import os
+from loguru import logger
+
+import torch
+
+from dao.register import Registers
+from dao.utils import get_rank
+
+__all__ = ['Hook', 'ProfilerHook']
+
+
+class Hook:
+    priority = 50   # 越小越先执行
+
+    def before_train(self, trainer):
+        pass
+
+    def after_train(self, trainer):
+        pass
+
+    def before_epoch(self, trainer):
+        pass
+
+    def after_epoch(self, trainer):
+        pass
+
+    def before_iter(self, trainer):
+        pass
+
+    def after_iter(self, trainer):
+        pass
+
+    def on_eval(self, trainer, metrics):
+        """
+        :param trainer: BaseTrainer
+        :param metrics: dict 验证指标, 由trainer._evaluate返回
+        """
+        pass
+
+
+@Registers.hooks.register
+class ProfilerHook(Hook):
+    def __init__(self, wait=10, warmup=2, active=5, repeat=1, record_shapes=False, profile_memory=False,
+                 with_stack=False, main_process_only=True):
+        """
+        Function: 使用torch.profiler记录若干iter, 结果写到output_dir/profiler, 用tensorboard查看
+
+        :param wait: int 跳过的iter数
+        :param warmup: int 预热的iter数
+        :param active: int 记录的iter数
+        :param repeat: int 重复次数
+        :param record_shapes: bool 是否记录算子输入shape
+        :param profile_memory: bool 是否记录显存
+        :param with_stack: bool 是否记录调用栈
+        :param main_process_only: bool 只在rank=0上记录
+        """
+        self.schedule_kwargs = dict(wait=wait, warmup=warmup, active=active, repeat=repeat)
+        self.profile_kwargs = dict(record_shapes=record_shapes, profile_memory=profile_memory, with_stack=with_stack)
+        self.total_steps = (wait + warmup + active) * repeat
+        self.main_process_only = main_process_only
+        self.profiler = None
+        self.steps = 0
+
+    def before_train(self, trainer):
+        if self.main_process_only and get_rank() != 0:
+            return
+        trace_dir = os.path.join(trainer.output_dir, "profiler")
+        self.profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA],
+            schedule=torch.profiler.schedule(**self.schedule_kwargs),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+            **self.profile_kwargs
+        )
+        self.profiler.start()
+        logger.info("profiler start, trace will be saved to {}".format(trace_dir))
+
+    def after_iter(self, trainer):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.steps += 1
+        if self.steps >= self.total_steps:
+            self._stop()
+
+    def after_train(self, trainer):
+        self._stop()
+
+    def _stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+            logger.info("profiler stop")
@@ -23,6 +23,7 @@ import torch.nn.functional as F
 from torchvision import transforms as T
 
 from dao import Registers
+from dao.trainers.base_trainer import BaseTrainer
 from dao.utils import setup_logger
 from dao.dataloaders.augments import get_transformer
 from dao.utils import get_rank, get_local_rank, get_world_size  # 导入分布式库
@@ -30,14 +31,9 @@ from dao.utils import get_rank, get_local_rank, get_world_size  # 导入分布
 
 # -------------- PaDiM 实现方式1：https://github.com/AICoreRef/PaDiM-Anomaly-Detection-Localization-master
 @Registers.trainers.register
-class AnomalyTrainer:
+class AnomalyTrainer(BaseTrainer):
     def __init__(self, exp, parser):
-        self.exp = exp   # DotMap 格式 的配置文件
-        self.parser = parser  # 命令行配置文件
-
-        self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')  # 此次trainer的开始时间
-        self.data_type = torch.float16 if self.parser.fp16 else torch.float32  # 使用的数据类型
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.parser.amp)  # 在训练开始之前实例化一个Grad Scaler对象
+        super(AnomalyTrainer, self).__init__(exp, parser)
 
         # anomaly只支持单机单卡
         assert self.parser.devices == 1, "exp.envs.gpus.devices must 1, please set again "
@@ -46,8 +42,10 @@ class AnomalyTrainer:
 
     def run(self):
         self._before_train()
+        self.call_hook("before_train")
         self._train()
         self._after_train()
+        self.call_hook("after_train")
 
     def _before_train(self):
         """
@@ -55,29 +53,8 @@ class AnomalyTrainer:
         2.Model Setting;    包含fit和evaluate
         3.DataLoader Setting;
         """
-        if self.parser.record:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name, self.start_time)  # 日志目录
-        else:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name)  # 日志目录
-            if get_rank() == 0:
-                if os.path.exists(self.output_dir):  # 如果存在self.output_dir删除
-                    try:
-                        shutil.rmtree(self.output_dir)
-                        pass
-                    except Exception as e:
-                        logger.info("global rank {} can't remove tree {}".format(get_rank(), self.output_dir))
-        setup_logger(self.output_dir, distributed_rank=get_rank(), filename=f"train_log.txt", mode="a")  # 设置只有rank=0输出日志，并重定向
-
+        self._setup_logger()
         logger.warning("Anomaly Detection only supported Single Machine and Single GPU !!!!")
-        logger.info("....... Train Before, Setting something ...... ")
-
-        logger.info("1. Logging Setting ...")
-        logger.info(f"create log file {self.output_dir}/train_log.txt")  # log txt
-        self.exp.pprint(pformat='json') if self.parser.detail else None  # 根据parser.detail来决定日志输出的详细
-        with open(os.path.join(self.output_dir, 'config.json'), 'w') as f:    # 将配置文件写到self.output_dir
-            json.dump(dict(self.exp), f)
-        logger.info(f"create Tensorboard log {self.output_dir}")
-        self.tblogger = SummaryWriter(self.output_dir) if get_rank() == 0 else None  # log tensorboard
 
         logger.info("2. Model Setting ...")
         self.device = torch.device("cuda:{}".format(self.parser.gpu))
@@ -394,14 +371,9 @@ class AnomalyExport:
 
 # -----PaDiM 实现方式2：https://github.com/AICoreRef/ind_knn_ad
 @Registers.trainers.register
-class AnomalyTrainer2:
+class AnomalyTrainer2(BaseTrainer):
     def __init__(self, exp, parser):
-        self.exp = exp   # DotMap 格式 的配置文件
-        self.parser = parser  # 命令行配置文件
-
-        self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')  # 此次trainer的开始时间
-        self.data_type = torch.float16 if self.parser.fp16 else torch.float32  # 使用的数据类型
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.parser.amp)  # 在训练开始之前实例化一个Grad Scaler对象
+        super(AnomalyTrainer2, self).__init__(exp, parser)
 
         # anomaly只支持单机单卡
         assert self.parser.devices == 1, "exp.envs.gpus.devices must 1, please set again "
@@ -410,8 +382,10 @@ class AnomalyTrainer2:
 
     def run(self):
         self._before_train()
+        self.call_hook("before_train")
         self._train()
         self._after_train()
+        self.call_hook("after_train")
 
     def _before_train(self):
         """
@@ -419,29 +393,8 @@ class AnomalyTrainer2:
         2.Model Setting;    包含fit和evaluate
         3.DataLoader Setting;
         """
-        if self.parser.record:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name, self.start_time)  # 日志目录
-        else:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name)  # 日志目录
-            if get_rank() == 0:
-                if os.path.exists(self.output_dir):  # 如果存在self.output_dir删除
-                    try:
-                        shutil.rmtree(self.output_dir)
-                        pass
-                    except Exception as e:
-                        logger.info("global rank {} can't remove tree {}".format(get_rank(), self.output_dir))
-        setup_logger(self.output_dir, distributed_rank=get_rank(), filename=f"train_log.txt", mode="a")  # 设置只有rank=0输出日志，并重定向
-
+        self._setup_logger()
         logger.warning("Anomaly Detection only supported Single Machine and Single GPU !!!!")
-        logger.info("....... Train Before, Setting something ...... ")
-
-        logger.info("1. Logging Setting ...")
-        logger.info(f"create log file {self.output_dir}/train_log.txt")  # log txt
-        self.exp.pprint(pformat='json') if self.parser.detail else None  # 根据parser.detail来决定日志输出的详细
-        with open(os.path.join(self.output_dir, 'config.json'), 'w') as f:    # 将配置文件写到self.output_dir
-            json.dump(dict(self.exp), f)
-        logger.info(f"create Tensorboard log {self.output_dir}")
-        self.tblogger = SummaryWriter(self.output_dir) if get_rank() == 0 else None  # log tensorboard
 
         logger.info("2. Model Setting ...")
         self.device = torch.device("cuda:{}".format(self.parser.gpu))
@@ -7,338 +7,115 @@
 
 
 import os   # 导入系统相关库
-import time
 import json
 import datetime
 import shutil
 import numpy as np
+import matplotlib.pyplot as plt
 from PIL import Image
 from loguru import logger
 
 import torch    # 深度学习相关库
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary
 
 from dao.dataloaders.augments import get_transformer
-from dao.utils import get_rank, get_local_rank, get_world_size  # 导入分布式库
-from dao.utils import all_reduce_norm  # BN 参数进行多卡同步
-# from dao.utils import synchronize
+from dao.utils import get_local_rank, get_world_size  # 导入分布式库
 from dao.utils import DataPrefetcherCls
 from dao.utils import (       # 导入Train util库
     setup_logger,       # 日志设置
     load_ckpt,          # 加载ckpt
-    save_checkpoint,    # 存储ckpt
-    occupy_mem,         # 占据显存
-    gpu_mem_usage,      # 显存使用情况
-    ModelEMA,           # 指数移动平均
-    is_parallel,        # 是否时多卡模型
     MeterClsTrain,      # 训练评价指标
     plot_confusion_matrix,   # 绘制混淆矩阵
-    synchronize         # 同步所有进程(GPU)
+    compile_model,      # torch.compile/TorchScript
+    fuse_conv_bn, get_memory_format,  # conv+bn折叠, 内存格式
+    load_logits, softmax, threshold_sweep, reject_sweep,    # 分类输出分析
+    roc_curve, pr_curve, fit_temperature, expected_calibration_error,
 )
 
 from dao import Registers
+from dao.trainers.base_trainer import BaseTrainer
 
 
 @Registers.trainers.register
-class ClsTrainer:
-    def __init__(self, exp, parser):
-        self.exp = exp  # DotMap 格式 的配置文件
-        self.parser = parser  # 命令行配置文件
-
-        self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')   # 此次trainer的开始时间
-        self.data_type = torch.float16 if self.parser.fp16 else torch.float32   # 使用的数据类型
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.parser.amp)  # 在训练开始之前实例化一个Grad Scaler对象
-
-    def run(self):
-        self._before_train()
-        for self.epoch in range(self.start_epoch, self.max_epoch):  # epoch
-            self._before_epoch()
-            for self.iter in range(self.max_iter):  # iter
-                self._before_iter()
-                self._train_one_iter()
-                self._after_iter()
-            self._after_epoch()
-        self._after_train()
-
-    def _before_train(self):
-        """
-        1.Logger Setting
-        2.Model Setting;
-        3.Optimizer Setting;
-        4.Resume setting;
-        5.DataLoader Setting;
-        6.Loss Setting;
-        7.Scheduler Setting;
-        8.Evaluator Setting;
-        """
-        if self.parser.record:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name, self.start_time)    # 日志目录
-        else:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name)  # 日志目录
-            if get_rank() == 0:
-                if os.path.exists(self.output_dir):  # 如果存在self.output_dir删除
-                    try:
-                        shutil.rmtree(self.output_dir)
-                    except Exception as e:
-                        logger.info("global rank {} can't remove tree {}".format(get_rank(), self.output_dir))
-        setup_logger(self.output_dir, distributed_rank=get_rank(), filename=f"train_log.txt", mode="a")  # 设置只有rank=0输出日志，并重定向
-        logger.info("....... Train Before, Setting something ...... ")
-        logger.info("1. Logging Setting ...")
-        logger.info(f"create log file {self.output_dir}/train_log.txt")  # log txt
-        self.exp.pprint(pformat='json') if self.parser.detail else None  # 根据parser.detail来决定日志输出的详细
-        with open(os.path.join(self.output_dir, 'config.json'), 'w') as f:    # 将配置文件写到self.output_dir
-            json.dump(dict(self.exp), f)
-        logger.info(f"create Tensorboard log {self.output_dir}")
-        self.tblogger = SummaryWriter(self.output_dir) if get_rank() == 0 else None  # log tensorboard
+class ClsTrainer(BaseTrainer):
+    score_scale = 100.0     # top1为百分比
 
-        logger.info("2. Model Setting ...")
-        torch.cuda.set_device(get_local_rank())
+    def _build_model(self):
         model = Registers.cls_models.get(self.exp.model.type)(self.exp.model.backbone, **self.exp.model.kwargs)  # get model
         logger.info("\n{}".format(model)) if self.parser.detail else None  # log model structure
         summary(model, input_size=(224, 224), device="cpu") if self.parser.detail else None  # log torchsummary model
-        model.to("cuda:{}".format(get_local_rank()))    # model to self.device
-
-        logger.info("3. Optimizer Setting")
-        self.optimizer = Registers.optims.get(self.exp.optimizer.type)(model=model, **self.exp.optimizer.kwargs)
+        return model
 
-        logger.info("4. Resume/FineTuning Setting ...")
-        model = self._resume_train(model)
+    def _build_prefetcher(self, train_loader):
+        return DataPrefetcherCls(train_loader, memory_format=self.memory_format)
 
-        logger.info("5. Dataloader Setting ... ")
-        self.max_epoch = self.exp.trainer.max_epochs
-        self.train_loader = Registers.dataloaders.get(self.exp.dataloader.type)(
-            is_distributed=get_world_size() > 1,
-            dataset=self.exp.dataloader.dataset,
-            seed=self.parser.seed,
-            **self.exp.dataloader.kwargs
-        )
-        self.max_iter = len(self.train_loader)
-        logger.info("init prefetcher, this might take one minute or less...")
-        # to solve https://github.com/pytorch/pytorch/issues/11201
-        torch.multiprocessing.set_sharing_strategy('file_system')
-        self.train_loader = DataPrefetcherCls(self.train_loader)
-
-        logger.info("6. Loss Setting ... ")
+    def _build_loss(self):
         self.loss = Registers.losses.get(self.exp.loss.type)(**self.exp.loss.kwargs)
         self.loss.to(device="cuda:{}".format(get_local_rank()))
 
-        logger.info("7. Scheduler Setting ... ")
-        self.lr_scheduler = Registers.schedulers.get(self.exp.lr_scheduler.type)(
-            lr=self.exp.optimizer.kwargs.lr,
-            iters_per_epoch=self.max_iter,
-            total_epochs=self.exp.trainer.max_epochs,
-            **self.exp.lr_scheduler.kwargs
-        )
-
-        logger.info("8. Other Setting ... ")
-        logger.info("occupy mem")
-        if self.parser.occupy:
-            occupy_mem(get_local_rank())
-
-        logger.info("Model DDP Setting")
-        if get_world_size() > 1:
-            model = DDP(model, device_ids=[get_local_rank()], broadcast_buffers=False)  # , output_device=[get_local_rank()]
-
-        logger.info("Model EMA Setting")  # 用EMA方法对模型的参数做平均，以提高测试指标并增加模型鲁棒性（减少模型权重抖动）
-        if self.parser.ema:
-            self.ema_model = ModelEMA(model, 0.9998)
-            self.ema_model.updates = self.max_iter * self.start_epoch
-
-        self.model = model
-        self.model.train()
-
-        logger.info("9. Evaluator Setting ... ")
-        self.evaluator = Registers.evaluators.get(self.exp.evaluator.type)(
-            is_distributed=get_world_size() > 1,
+    def _build_evaluator(self, is_distributed):
+        return Registers.evaluators.get(self.exp.evaluator.type)(
+            is_distributed=is_distributed,
             dataloader=self.exp.evaluator.dataloader,
             **self.exp.evaluator.kwargs
         )
-        self.best_acc = 0
-        self.train_metrics = MeterClsTrain()
-        logger.info("Setting finished, training start ......")
-
-    def _before_epoch(self):
-        """
-        判断此次epoch是否需要马赛克增强
-        :return:
-        """
-        logger.info("---> start train epoch{}".format(self.epoch + 1))
 
-    def _before_iter(self):
-        pass
+    def _build_train_metrics(self):
+        return MeterClsTrain()
 
     def _train_one_iter(self):
-        iter_start_time = time.time()
+        self.train_metrics.timer.start()    # CUDA event计时, 不同步host
 
         inps, targets, path = self.train_loader.next()
+        if self.gpu_transforms is not None:
+            inps = self.gpu_transforms(image=inps)["image"]
         inps = inps.to(self.data_type)
         # targets = targets.to(self.data_type)
         targets.requires_grad = False
-        data_end_time = time.time()
-
-        with torch.cuda.amp.autocast(enabled=self.parser.amp):    # 开启auto cast的context manager语义（model+loss）
-            outputs = self.model(inps)
-            loss = self.loss(outputs, targets)
-
-        self.optimizer.zero_grad()   # 梯度清零
-        self.scaler.scale(loss).backward()   # 反向传播；Scales loss. 为了梯度放大
-        # scaler.step() 首先把梯度的值unscale回来.
-        # 如果梯度的值不是infs或者NaNs, 那么调用optimizer.step()来更新权重,
-        # 否则，忽略step调用，从而保证权重不更新（不被破坏）
-        self.scaler.step(self.optimizer)    # optimizer.step 进行参数更新
-        self.scaler.update()    # 准备着，看是否要增大scaler
+        self.train_metrics.timer.data_end()
 
-        if self.parser.ema:
-            self.ema_model.update(self.model)
+        loss, _ = self._forward_backward(inps, targets)
+        lr = self._optimize()
 
-        lr = self.lr_scheduler.update_lr(self.progress_in_iter + 1)
-        for param_group in self.optimizer.param_groups:
-            param_group["lr"] = lr
-
-        iter_end_time = time.time()
+        self.train_metrics.timer.stop()
         self.train_metrics.update(
-            data_time=data_end_time - iter_start_time,
-            batch_time=iter_end_time - iter_start_time,
-            total_loss=loss.item(),
-            outputs=outputs,
-            targets=targets,
+            total_loss=loss,
             lr=lr
         )
 
-    def _after_iter(self):
-        """
-        `after_iter` contains two parts of logic:
-            * log information
-            * reset setting of resize
-        """
-        # log needed information
-        if (self.iter + 1) % self.exp.trainer.log_per_iter == 0 and get_rank() == 0:
-            # TODO check ETA logic
-            left_iters = self.max_iter * self.max_epoch - (self.progress_in_iter + 1)
-            eta_seconds = (self.train_metrics.batch_time.avg + self.train_metrics.data_time.avg) * left_iters
-            eta_str = "ETA: {}".format(datetime.timedelta(seconds=int(eta_seconds)))
-
-            progress_str = f"epoch: {self.epoch + 1}/{self.max_epoch}, iter: {self.iter + 1}/{self.max_iter} "
-            loss_str = "loss:{:2f}".format(self.train_metrics.total_loss.avg)
-            time_str = "iter time:{:2f}, data time:{:2f}".format(self.train_metrics.batch_time.avg, self.train_metrics.data_time.avg)
-            topk_str = "top1:{:4f}, top2:{:4f}".format(self.train_metrics.precision_top1.avg, self.train_metrics.precision_top2.avg)
-
-            logger.info(
-                "{}, {}, mem: {:.0f}Mb, {}, {}, lr: {:.3e}, {}".format(
-                    progress_str,
-                    topk_str,
-                    gpu_mem_usage(),
-                    time_str,
-                    loss_str,
-                    self.train_metrics.lr,
-                    eta_str
-                )
-            )
-            self.tblogger.add_scalar('train/loss', self.train_metrics.total_loss.avg, self.progress_in_iter)
-            self.tblogger.add_scalar('train/lr', self.train_metrics.lr, self.progress_in_iter)
-            self.tblogger.add_scalar('train/top1', self.train_metrics.precision_top1.avg, self.progress_in_iter)
-            self.tblogger.add_scalar('train/top2', self.train_metrics.precision_top2.avg, self.progress_in_iter)
-            self.train_metrics.reset(False)
-
-    def _after_epoch(self):
-        self._save_ckpt(ckpt_name="latest")
-
-        if (self.epoch + 1) % self.exp.trainer.eval_interval == 0:
-            all_reduce_norm(self.model)  # BN 参数进行多卡同步，保证不同卡参数的一致性
-            self._evaluate_and_save_model()
-
-    def _after_train(self):
-        logger.info(
-            "Training of experiment is done and the best Acc is {:.2f}".format(self.best_acc)
-        )
-        logger.info("DONE")
-
-    def _evaluate_and_save_model(self):
-        if self.parser.ema:
-            evalmodel = self.ema_model.ema
-        else:
-            evalmodel = self.model
-            if is_parallel(evalmodel):
-                evalmodel = evalmodel.module
-
-        top1, top2, confusion_matrix = self.evaluator.evaluate(evalmodel, get_world_size() > 1,
-                                                               device="cuda:{}".format(get_local_rank()),
-                                                               output_dir=self.output_dir)
-        self.model.train()
-        # 将evaluator结果写到tensorboard中
-        if get_rank() == 0 and top1 > self.best_acc:
-            self.tblogger.add_scalar("val/top1", top1, self.epoch + 1)
-            self.tblogger.add_scalar("val/top2", top2, self.epoch + 1)
-            # 获得类别名称
-            # label_txt = os.path.join(self.exp.evaluator.dataloader.dataset.kwargs.data_dir, "labels.txt")
-            # class_names = []
-            # with open(label_txt, "r") as labels_file:
-            #     for label in labels_file.readlines():
-            #         class_names.append(label.strip().split()[0])
-            class_names = self.evaluator.class_names
+    def _forward(self, inps, targets):
+        outputs = self.train_model(inps)
+        loss = self.loss(outputs, targets)
+        self.train_metrics.update(outputs=outputs.detach(), targets=targets)     # 每个micro-batch统计topk
+        return loss, outputs
+
+    def _log_str(self):
+        return ["top1:{:4f}, top2:{:4f}".format(self.train_metrics.precision_top1.avg, self.train_metrics.precision_top2.avg)]
+
+    def _log_tensorboard(self):
+        self.tblogger.add_scalar('train/top1', self.train_metrics.precision_top1.avg, self.progress_in_iter)
+        self.tblogger.add_scalar('train/top2', self.train_metrics.precision_top2.avg, self.progress_in_iter)
+
+    def _reset_train_metrics(self):
+        self.train_metrics.reset(False)
+
+    def _evaluate(self, evalmodel, evaluator, epoch, distributed):
+        top1, top2, confusion_matrix = evaluator.evaluate(evalmodel, distributed,
+                                                          device="cuda:{}".format(get_local_rank()),
+                                                          output_dir=self.output_dir)
+        return top1, {"top1": top1, "top2": top2, "confusion_matrix": confusion_matrix,
+                      "class_metrics": evaluator.class_metrics}
+
+    def _log_eval(self, metrics, epoch, is_best):
+        self.tblogger.add_scalar("val/top1", metrics["top1"], epoch + 1)
+        self.tblogger.add_scalar("val/top2", metrics["top2"], epoch + 1)
+        if is_best:     # 混淆矩阵只在best时绘制
             self.tblogger.add_figure('val/confusion matrix',
-                                     figure=plot_confusion_matrix(confusion_matrix,
-                                                                  classes=class_names,
+                                     figure=plot_confusion_matrix(metrics["confusion_matrix"],
+                                                                  classes=self.evaluator.class_names,
                                                                   normalize=False,
                                                                   title='Normalized confusion matrix'),
-                                     global_step=self.epoch + 1)
-
-            logger.info("Best ACC - epoch:{}, top1:{}, top2:{}".format(self.epoch + 1, top1, top2))
-        synchronize()
-        self._save_ckpt("last_epoch", top1 > self.best_acc)
-        self.best_acc = max(self.best_acc, top1)
-
-    def _save_ckpt(self, ckpt_name, update_best_ckpt=False):
-        if get_rank() == 0:
-            save_model = self.ema_model.ema if self.parser.ema else self.model
-            logger.info("Save weights to {}".format(self.output_dir))
-            ckpt_state = {
-                "start_epoch": self.epoch + 1,
-                "model": save_model.state_dict(),
-                "optimizer": self.optimizer.state_dict(),
-            }
-            save_checkpoint(
-                ckpt_state,
-                update_best_ckpt,
-                self.output_dir,
-                ckpt_name,
-            )
-
-    def _resume_train(self, model):
-        """
-        如果args.resume为true，将args.ckpt权重resume；
-        如果args.resume为false，将args.ckpt权重fine turning；
-        :param model:
-        :return:
-        """
-        if self.exp.trainer.resume:
-            logger.info("resume training")
-            # 获取ckpt路径
-            assert self.exp.trainer.ckpt is not None
-            # 加载ckpt
-            ckpt_file = self.exp.trainer.ckpt
-            ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(get_local_rank()))
-            # resume the model/optimizer state dict
-            model.load_state_dict(ckpt["model"])
-            self.optimizer.load_state_dict(ckpt["optimizer"])
-            # resume the training states variables
-            self.start_epoch = ckpt["start_epoch"]
-            logger.info("loaded checkpoint '{}' (epoch {})".format(self.exp.trainer.ckpt, self.start_epoch))
-        else:
-            if self.exp.trainer.ckpt is not None:
-                logger.info("loading checkpoint for fine tuning")
-                ckpt_file = self.exp.trainer.ckpt
-                ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(get_local_rank()))["model"]
-                model = load_ckpt(model, ckpt)
-            self.start_epoch = 0
-
-        return model
-
-    @property
-    def progress_in_iter(self):
-        return self.epoch * self.max_iter + self.iter
+                                     global_step=epoch + 1)
 
 
 @Registers.trainers.register
@@ -349,12 +126,11 @@ class ClsEval:
 
         self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')  # 此次trainer的开始时间
 
-        # 因为ClsEval只支持单机单卡，且batchsize为1
+        # 工业验证(is_industry)只支持单机单卡, batchsize不限
         if self.exp.evaluator.kwargs.is_industry:
             assert self.parser.devices == 1, "exp.envs.gpus.devices must 1, please set again "
             assert self.parser.num_machines == 1, "exp.envs.gpus.devices must 1, please set again "
             assert self.parser.machine_rank == 0, "exp.envs.gpus.devices must 0, please set again "
-            assert exp.evaluator.dataloader.kwargs.batch_size == 1, "exp.envs.gpus.devices must 1, please set again "
 
     def run(self):
         self._before_eval()
@@ -393,7 +169,11 @@ class ClsEval:
         ckpt_file = self.exp.trainer.ckpt
         ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(self.parser.gpu))["model"]
         self.model = load_ckpt(model, ckpt)
+        self.model = fuse_conv_bn(self.model)    # 推理前把bn折叠到conv中
+        self.model.to(memory_format=get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None))
         self.model.eval()
+        if "compile" in self.exp.trainer:    # 编译(可选), 失败时退回原模型
+            self.model = compile_model(self.model, **self.exp.trainer.compile.toDict())
 
         logger.info("3. Evaluator Setting ... ")
         self.evaluator = Registers.evaluators.get(self.exp.evaluator.type)(
@@ -404,6 +184,106 @@ class ClsEval:
         logger.info("Setting finished, eval start ......")
 
 
+@Registers.trainers.register
+class ClsAnalysis:
+    """
+    离线分析ClsEvaluator(dump_logits=true)保存的logits, 不运行模型, 配置文件中:
+        "trainer": {"type": "ClsAnalysis", "log_dir": "...", "logits_dir": ".../logits"},
+        "analysis": {"ok_class": 0, "num_thresholds": 1001, "n_bins": 15, "calibrate": true, "escape_target": 0.0}
+    ok_class为OK类别id, 其他类别都看作NG, NG分数为 1 - p(OK)
+    """
+    def __init__(self, exp, parser):
+        self.exp = exp  # DotMap 格式 的配置文件
+        self.parser = parser  # 命令行配置文件
+
+        self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')  # 此次trainer的开始时间
+        self.analysis = self.exp.analysis.toDict() if "analysis" in self.exp else {}
+
+    def run(self):
+        self._before_analysis()
+        logits, labels, paths = load_logits(self.exp.trainer.logits_dir)
+        logger.info("load {} samples, {} classes from {}".format(len(labels), logits.shape[1],
+                                                                 self.exp.trainer.logits_dir))
+        result = {"num_samples": len(labels)}
+
+        # 1. 温度缩放和ECE
+        temperature = 1.0
+        probs = softmax(logits)
+        result["ece"], result["mce"], bins = expected_calibration_error(probs, labels, self.analysis.get("n_bins", 15))
+        self._plot_reliability(bins, "reliability.png")
+        if self.analysis.get("calibrate", True):
+            temperature, result["nll"], result["nll_calibrated"] = fit_temperature(logits, labels)
+            probs = softmax(logits, temperature)
+            result["ece_calibrated"], result["mce_calibrated"], bins = expected_calibration_error(
+                probs, labels, self.analysis.get("n_bins", 15))
+            self._plot_reliability(bins, "reliability_calibrated.png")
+        result["temperature"] = temperature
+
+        # 2. OK/NG阈值扫描, ROC/PR
+        thresholds = np.linspace(0, 1, self.analysis.get("num_thresholds", 1001))
+        ok_class = self.analysis.get("ok_class", 0)
+        scores, positives = 1 - probs[:, ok_class], labels != ok_class
+        sweep = threshold_sweep(scores, positives, thresholds)
+        self._write_csv(sweep, "threshold_sweep.csv")
+        fpr, tpr, _, result["auc"] = roc_curve(scores, positives)
+        precision, recall, _, result["ap"] = pr_curve(scores, positives)
+        self._plot_curve(fpr, tpr, "FPR(overkill)", "TPR(1-escape)", "ROC AUC={:.4f}".format(result["auc"]), "roc.png")
+        self._plot_curve(recall, precision, "Recall", "Precision", "PR AP={:.4f}".format(result["ap"]), "pr.png")
+        best = int(np.argmax(sweep["f1"]))
+        result["best_f1"] = {k: float(v[best]) for k, v in sweep.items()}
+        escape_ok = np.flatnonzero(sweep["escape_rate"] <= self.analysis.get("escape_target", 0.0))
+        if len(escape_ok):  # 漏检率不超过escape_target的最大阈值, 过检率最小
+            result["escape_target"] = {k: float(v[escape_ok[-1]]) for k, v in sweep.items()}
+
+        # 3. 多分类拒识阈值扫描
+        self._write_csv(reject_sweep(probs, labels, thresholds), "reject_sweep.csv")
+
+        logger.info("analysis result:\n{}".format(json.dumps(result, indent=4)))
+        with open(os.path.join(self.output_dir, "result.json"), 'w', encoding='utf-8') as result_file:
+            json.dump(result, result_file, indent=4)
+        logger.info("DONE")
+
+    def _before_analysis(self):
+        if self.parser.record:
+            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name, self.start_time)  # 日志目录
+        else:
+            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name)    # 日志目录
+            if os.path.exists(self.output_dir):  # 如果存在self.output_dir删除
+                shutil.rmtree(self.output_dir)
+        setup_logger(self.output_dir, distributed_rank=0, filename=f"analysis_log.txt", mode="a")  # 输出日志重定向
+        logger.info("....... Analysis Before, Setting something ...... ")
+        logger.info(f"create log file {self.output_dir}/analysis_log.txt")  # log txt
+        with open(os.path.join(self.output_dir, 'config.json'), 'w') as f:  # 将配置文件写到self.output_dir
+            json.dump(dict(self.exp), f)
+
+    def _write_csv(self, table, filename):
+        keys = list(table.keys())
+        np.savetxt(os.path.join(self.output_dir, filename), np.stack([table[k] for k in keys], 1),
+                   delimiter=",", header=",".join(keys), comments="", fmt="%.6g")
+
+    def _plot_curve(self, x, y, xlabel, ylabel, title, filename):
+        fig = plt.figure(dpi=100, figsize=(6, 6))
+        plt.plot(x, y)
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+        plt.title(title)
+        plt.grid(True)
+        fig.savefig(os.path.join(self.output_dir, filename))
+        plt.close(fig)
+
+    def _plot_reliability(self, bins, filename):
+        n_bins = len(bins["count"])
+        centers = (np.arange(n_bins) + 0.5) / n_bins
+        fig = plt.figure(dpi=100, figsize=(6, 6))
+        plt.bar(centers, bins["accuracy"], width=1.0 / n_bins, edgecolor="black", label="accuracy")
+        plt.plot([0, 1], [0, 1], "r--", label="perfect calibration")
+        plt.xlabel("Confidence")
+        plt.ylabel("Accuracy")
+        plt.legend()
+        fig.savefig(os.path.join(self.output_dir, filename))
+        plt.close(fig)
+
+
 @Registers.trainers.register
 class ClsDemo:
     def __init__(self, exp, parser):
@@ -471,7 +351,11 @@ class ClsDemo:
         ckpt_file = self.exp.trainer.ckpt
         ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(self.parser.gpu))["model"]
         self.model = load_ckpt(model, ckpt)
+        self.model = fuse_conv_bn(self.model)    # 推理前把bn折叠到conv中
+        self.model.to(memory_format=get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None))
         self.model.eval()
+        if "compile" in self.exp.trainer:    # 编译(可选), 失败时退回原模型
+            self.model = compile_model(self.model, **self.exp.trainer.compile.toDict())
 
         logger.info("Setting finished, demo start ......")
 
@@ -493,6 +377,7 @@ class ClsDemo:
         results = []
         picPath = os.path.join(self.output_dir, "pictures")
         os.makedirs(picPath, exist_ok=True)
+        transform = get_transformer(self.exp.images.transforms.kwargs)  # 增强, 所有图片共用
         for img_p in all_paths:
             # 将temp中的图片拷贝到self.output_dir的pictures中
             dstPic = os.path.join(picPath, img_p.split('/')[-1])
@@ -502,7 +387,6 @@ class ClsDemo:
             image = np.array(Image.open(dstPic))  # h,w
             if len(image.shape) == 2:   # 如果是单通道
                 image = np.expand_dims(image, axis=2)  # h,w,1
-            transform = get_transformer(self.exp.images.transforms.kwargs)  # 增强
             image = transform(image=image)['image']
             image = image.transpose(2, 0, 1)  # c, h, w
             results.append((dstPic, image))
@@ -562,6 +446,8 @@ class ClsExport:
         ckpt_file = self.exp.trainer.ckpt
         ckpt = torch.load(ckpt_file, map_location="cpu")["model"]
         self.model = load_ckpt(model, ckpt)
+        self.model = fuse_conv_bn(self.model)    # 推理前把bn折叠到conv中
+        self.model.to(memory_format=get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None))
         self.model.eval()
 
         logger.info("Setting finished, export onnx start ......")
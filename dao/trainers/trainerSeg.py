@@ -7,7 +7,6 @@
 
 import os   # 导入系统相关库
 import shutil
-import time
 import json
 import datetime
 import numpy as np
@@ -18,173 +17,61 @@ from loguru import logger
 import torch    # 深度学习相关库
 from torchsummary import summary
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary
 
 from dao.register import Registers
+from dao.trainers.base_trainer import BaseTrainer
 from dao.dataloaders.augments import get_transformer
 from dao.utils import (       # 导入Train util库
     setup_logger,       # 日志设置
     load_ckpt,          # 加载ckpt
-    save_checkpoint,    # 存储ckpt
-    occupy_mem,         # 占据显存
-    gpu_mem_usage,      # 显存使用情况
-    EMA,                # 指数移动平均
-    is_parallel,        # 是否时多卡模型
     MeterSegTrain,      # 训练评价指标
     denormalization,    # 反归一化
     get_palette,        # 获得画板颜色,颜色版共num_classes
     colorize_mask,      # 为mask图，填充颜色
-    synchronize,        # 同步所有进程(GPU)
     DataPrefetcherSeg,  # 数据预加载
-    all_reduce_norm,    # BN 参数进行多卡同步
-    get_rank, get_local_rank, get_world_size,  # 导入分布式库
+    get_local_rank, get_world_size,  # 导入分布式库
+    compile_model,      # torch.compile/TorchScript
+    fuse_conv_bn, get_memory_format,  # conv+bn折叠, 内存格式
 )
 
 
 @Registers.trainers.register
-class SegTrainer:
-    def __init__(self, exp, parser):
-        self.exp = exp  # DotMap 格式 的配置文件
-        self.parser = parser  # 命令行配置文件
-
-        self.start_time = datetime.datetime.now().strftime('%m-%d_%H-%M')  # 此次trainer的开始时间
-        self.data_type = torch.float16 if self.parser.fp16 else torch.float32  # 使用的数据类型
-        self.scaler = torch.cuda.amp.GradScaler(enabled=self.parser.amp)  # 在训练开始之前实例化一个Grad Scaler对象
-
-    def run(self):
-        self._before_train()
-        # epochs
-        for self.epoch in range(self.start_epoch, self.max_epoch):
-            self._before_epoch()
-            # iters
-            for self.iter in range(self.max_iter):
-                self._before_iter()
-                self._train_one_iter()
-                self._after_iter()
-            self._after_epoch()
-        self._after_train()
-
-    def _before_train(self):
-        """
-        1.Logger Setting
-        2.Model Setting;
-        3.Optimizer Setting;
-        4.Resume setting;
-        5.DataLoader Setting;
-        6.Loss Setting;
-        7.Scheduler Setting;
-        8.Evaluator Setting;
-        """
-        if self.parser.record:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name, self.start_time)    # 日志目录
-        else:
-            self.output_dir = os.path.join(self.exp.trainer.log_dir, self.exp.name)  # 日志目录
-            if get_rank() == 0:
-                if os.path.exists(self.output_dir):  # 如果存在self.output_dir删除
-                    try:
-                        shutil.rmtree(self.output_dir)
-                    except Exception as e:
-                        logger.info("global rank {} can't remove tree {}".format(get_rank(), self.output_dir))
-        setup_logger(self.output_dir, distributed_rank=get_rank(), filename=f"train_log.txt", mode="a")  # 设置只有rank=0输出日志，并重定向
-        logger.info("....... Train Before, Setting something ...... ")
-        logger.info("1. Logging Setting ...")
-        logger.info(f"create log file {self.output_dir}/train_log.txt")  # log txt
-        self.exp.pprint(pformat='json') if self.parser.detail else None  # 根据parser.detail来决定日志输出的详细
-        with open(os.path.join(self.output_dir, 'config.json'), 'w') as f:    # 将配置文件写到self.output_dir
-            json.dump(dict(self.exp), f)
-        logger.info(f"create Tensorboard log {self.output_dir}")
-        self.tblogger = SummaryWriter(self.output_dir) if get_rank() == 0 else None  # log tensorboard
-
-        logger.info("2. Model Setting ...")
-        torch.cuda.set_device(get_local_rank())
+class SegTrainer(BaseTrainer):
+    def _build_model(self):
         model = Registers.seg_models.get(self.exp.model.type)(self.exp.model.backbone, **self.exp.model.kwargs)
         logger.info("\n{}".format(model)) if self.parser.detail else None  # log model structure
         summary(model, input_size=(3, 224, 224), device="cpu") if self.parser.detail else None  # log torchsummary model
-        model.to("cuda:{}".format(get_local_rank()))    # model to self.device
-
-        logger.info("3. Optimizer Setting")
-        self.optimizer = Registers.optims.get(self.exp.optimizer.type)(model=model, **self.exp.optimizer.kwargs)
-
-        logger.info("4. Resume/FineTuning Setting ...")
-        model = self._resume_train(model)
+        return model
 
-        logger.info("5. Dataloader Setting ... ")
-        self.max_epoch = self.exp.trainer.max_epochs
-        self.no_aug = self.start_epoch >= self.max_epoch - self.exp.trainer.no_aug_epochs
-        self.train_loader = Registers.dataloaders.get(self.exp.dataloader.type)(
-            is_distributed=get_world_size() > 1,
-            dataset=self.exp.dataloader.dataset,
-            seed=self.parser.seed,
-            **self.exp.dataloader.kwargs
-        )
-        self.max_iter = len(self.train_loader)
-        logger.info("init prefetcher, this might take one minute or less...")
-        # to solve https://github.com/pytorch/pytorch/issues/11201
-        torch.multiprocessing.set_sharing_strategy('file_system')
-        self.train_loader = DataPrefetcherSeg(self.train_loader)
+    def _build_prefetcher(self, train_loader):
+        return DataPrefetcherSeg(train_loader, memory_format=self.memory_format)
 
-        logger.info("6. Loss Setting ... ")
+    def _build_loss(self):
         self.loss = Registers.losses.get(self.exp.loss.type)(**self.exp.loss.kwargs)
         self.loss.to(device="cuda:{}".format(get_local_rank()))
         if "aux_params" in self.exp.model.kwargs:
             self.loss_aux = Registers.losses.get(self.exp.aux_loss.type)(**self.exp.aux_loss.kwargs)
             self.loss_aux.to(device="cuda:{}".format(get_local_rank()))
 
-        logger.info("7. Scheduler Setting ... ")
-        self.lr_scheduler = Registers.schedulers.get(self.exp.lr_scheduler.type)(
-            lr=self.exp.optimizer.kwargs.lr,
-            iters_per_epoch=self.max_iter,
-            total_epochs=self.exp.trainer.max_epochs,
-            **self.exp.lr_scheduler.kwargs
-        )
-
-        logger.info("8. Other Setting ... ")
-        logger.info("occupy mem")
-        if self.parser.occupy:
-            occupy_mem(get_local_rank())
-
-        logger.info("Model DDP Setting")
-        if get_world_size() > 1:
-            model = DDP(model, device_ids=[get_local_rank()], broadcast_buffers=False, output_device=[get_local_rank()])
-
-        logger.info("Model EMA Setting")
-        # Exponential moving average
-        # 用EMA方法对模型的参数做平均，以提高测试指标并增加模型鲁棒性（减少模型权重抖动）
-        self.use_model_ema = self.parser.ema
-        if self.use_model_ema:
-            # self.ema_model = ModelEMA(model, 0.9998)
-            # self.ema_model.updates = self.max_iter * self.start_epoch
-            self.ema_model = EMA(model, 0.9998)
-            self.ema_model.register()
-
-        self.model = model
-        self.model.train()
-
-        logger.info("9. Evaluator Setting ... ")
-        self.evaluator = Registers.evaluators.get(self.exp.evaluator.type)(
-            is_distributed=get_world_size() > 1,
+    def _build_evaluator(self, is_distributed):
+        return Registers.evaluators.get(self.exp.evaluator.type)(
+            is_distributed=is_distributed,
             dataloader=self.exp.evaluator.dataloader,
             num_classes=self.exp.model.kwargs.num_classes,
+            inference=self.exp.evaluator.inference if "inference" in self.exp.evaluator else None,
         )
-        self.train_metrics = MeterSegTrain()
-        self.best_acc = 0
-        logger.info("Setting finished, training start ......")
-
-    def _before_epoch(self):
-        """
-        每次epoch前的操作，例如multi-scale， 马赛克增强，等取消与否。
-        :return:
-        """
-        logger.info("---> start train epoch{}".format(self.epoch + 1))
 
-    def _before_iter(self):
-        pass
+    def _build_train_metrics(self):
+        return MeterSegTrain()
 
     def _train_one_iter(self):
-        iter_start_time = time.time()
+        self.train_metrics.timer.start()    # CUDA event计时, 不同步host
 
         inps, targets, path = self.train_loader.next()
+        if self.gpu_transforms is not None:
+            transformed = self.gpu_transforms(image=inps, mask=targets)
+            inps, targets = transformed["image"], transformed["mask"]
         # show img and mask
         # Image.fromarray(denormalization(
         #     inps[0].cpu().numpy(),
@@ -199,155 +86,39 @@ class SegTrainer:
         inps = inps.to(self.data_type)
         # targets = targets.to(self.data_type)
         targets.requires_grad = False
-        data_end_time = time.time()
-
-        with torch.cuda.amp.autocast(enabled=self.parser.amp):    # 开启auto cast的context manager语义（model+loss）
-            outputs = self.model(inps)
-            if "aux_params" in self.exp.model.kwargs:
-                loss = self.loss(outputs[0], targets)  # PSP(master_branch)损失， 其他类似
-                loss += self.loss_aux(outputs[1], targets) * 0.4  # FCN损失
-            else:
-                loss = self.loss(outputs, targets)
-        self.optimizer.zero_grad()   # 梯度清零
-        self.scaler.scale(loss).backward()   # 反向传播；Scales loss. 为了梯度放大
-        # scaler.step() 首先把梯度的值unscale回来.
-        # 如果梯度的值不是infs或者NaNs, 那么调用optimizer.step()来更新权重,
-        # 否则，忽略step调用，从而保证权重不更新（不被破坏）
-        self.scaler.step(self.optimizer)    # optimizer.step 进行参数更新
-        self.scaler.update()    # 准备着，看是否要增大scaler
-
-        if self.use_model_ema:
-            # self.ema_model.update(self.model)
-            self.ema_model.update()
-        lr = self.lr_scheduler.update_lr(self.progress_in_iter + 1)
-        for param_group in self.optimizer.param_groups:
-            param_group["lr"] = lr
-
-        iter_end_time = time.time()
+        self.train_metrics.timer.data_end()
+
+        loss, _ = self._forward_backward(inps, targets)
+        lr = self._optimize()
+
+        self.train_metrics.timer.stop()
         self.train_metrics.update_metrics(
-            data_time=data_end_time - iter_start_time,
-            batch_time=iter_end_time - iter_start_time,
-            total_loss=loss.item(),
+            total_loss=loss,
             lr=lr
         )
 
-    def _after_iter(self):
-        """
-        `after_iter` contains two parts of logic:
-            * log information
-            * reset setting of resize
-        """
-        # log needed information
-        if (self.iter + 1) % self.exp.trainer.log_per_iter == 0 and get_rank() == 0:
-            # TODO check ETA logic
-            left_iters = self.max_iter * self.max_epoch - (self.progress_in_iter + 1)
-            eta_seconds = (self.train_metrics.batch_time.avg + self.train_metrics.data_time.avg) * left_iters
-            eta_str = "ETA: {}".format(datetime.timedelta(seconds=int(eta_seconds)))
-
-            progress_str = f"epoch: {self.epoch + 1}/{self.max_epoch}, iter: {self.iter + 1}/{self.max_iter} "
-            loss_str = "loss:{:2f}".format(self.train_metrics.total_loss.avg)
-            time_str = "iter time:{:2f}, data time:{:2f}".format(self.train_metrics.batch_time.avg, self.train_metrics.data_time.avg)
-
-            logger.info(
-                "{}, mem: {:.0f}Mb, {}, {}, lr: {:.3e}, {}".format(
-                    progress_str,
-                    gpu_mem_usage(),
-                    time_str,
-                    loss_str,
-                    self.train_metrics.lr,
-                    eta_str
-                )
-            )
-            self.tblogger.add_scalar('train/loss', self.train_metrics.total_loss.avg, self.progress_in_iter)
-            self.tblogger.add_scalar('train/lr', self.train_metrics.lr, self.progress_in_iter)
-            self.train_metrics.reset_metrics()
-
-    def _after_epoch(self):
-        self._save_ckpt(ckpt_name="latest")
-
-        if (self.epoch + 1) % self.exp.trainer.eval_interval == 0:
-            all_reduce_norm(self.model)
-            self._evaluate_and_save_model()
-
-    def _after_train(self):
-        logger.info("Training of experiment is done and the best Acc is {:.2f}".format(self.best_acc))
-        logger.info("DONE")
-
-    def _evaluate_and_save_model(self):
-        if self.use_model_ema:
-            # evalmodel = self.ema_model.ema
-            evalmodel = self.ema_model.model
-        else:
-            evalmodel = self.model
-            if is_parallel(evalmodel):
-                evalmodel = evalmodel.module
-
-        pixAcc, mIoU, Class_IoU = self.evaluator.evaluate(evalmodel, get_world_size() > 1, device="cuda:{}".format(get_local_rank()))
-        self.model.train()
-        logger.info("pixAcc:{}, mIoU:{}, Class_IoU:{}".format(pixAcc, mIoU, Class_IoU))
-
-        if get_rank() == 0:
-            self.tblogger.add_scalar("val/pixAcc", pixAcc, self.epoch + 1)
-            self.tblogger.add_scalar("val/mIoU", mIoU, self.epoch + 1)
-            for k, v in Class_IoU.items():
-                self.tblogger.add_scalar("val_detail/{} IoU".format(k), v, self.epoch + 1)
-
-        synchronize()
-        self._save_ckpt("last_epoch", mIoU > self.best_acc)
-        self.best_acc = max(self.best_acc, mIoU)
-
-    def _save_ckpt(self, ckpt_name, update_best_ckpt=False):
-        if get_rank() == 0:
-            # save_model = self.ema_model.ema if self.use_model_ema else self.model
-            save_model = self.ema_model.model if self.use_model_ema else self.model
-            logger.info("Save weights to {} - update_best_ckpt:{}".format(self.output_dir, update_best_ckpt))
-            ckpt_state = {
-                "start_epoch": self.epoch + 1,
-                "model": save_model.state_dict(),
-                "optimizer": self.optimizer.state_dict(),
-            }
-            save_checkpoint(
-                ckpt_state,
-                update_best_ckpt,
-                self.output_dir,
-                ckpt_name,
-            )
-
-    def _resume_train(self, model):
-        """
-        如果args.resume为true，将args.ckpt权重resume；
-        如果args.resume为false，将args.ckpt权重fine turning；
-        :param model:
-        :return:
-        """
-        if self.exp.trainer.resume:
-            logger.info("resume training")
-            # 获取ckpt路径
-            assert self.exp.trainer.ckpt is not None
-            ckpt_file = self.exp.trainer.ckpt
-            # 加载ckpt
-            ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(get_local_rank()))
-            # resume the model/optimizer state dict
-            model.load_state_dict(ckpt["model"])
-            self.optimizer.load_state_dict(ckpt["optimizer"])
-            # resume the training states variables
-            self.start_epoch = ckpt["start_epoch"]
-            logger.info(
-                "loaded checkpoint '{}' (epoch {})".format(self.exp.trainer.ckpt, self.start_epoch)
-            )  # noqa
+    def _forward(self, inps, targets):
+        outputs = self.train_model(inps)
+        if "aux_params" in self.exp.model.kwargs:
+            loss = self.loss(outputs[0], targets)  # PSP(master_branch)损失， 其他类似
+            loss += self.loss_aux(outputs[1], targets) * 0.4  # FCN损失
         else:
-            if self.exp.trainer.ckpt is not None:
-                logger.info("loading checkpoint for fine tuning")
-                ckpt_file = self.exp.trainer.ckpt
-                ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(get_local_rank()))["model"]
-                model = load_ckpt(model, ckpt)
-            self.start_epoch = 0
+            loss = self.loss(outputs, targets)
+        return loss, outputs
 
-        return model
+    def _evaluate(self, evalmodel, evaluator, epoch, distributed):
+        pixAcc, mIoU, Class_IoU = evaluator.evaluate(evalmodel, distributed, device="cuda:{}".format(get_local_rank()))
+        seg_metrics = evaluator.seg_metrics
+        return mIoU, {"pixAcc": pixAcc, "mIoU": mIoU, "Class_IoU": Class_IoU, "mDice": seg_metrics["Mean_Dice"],
+                      "fwIoU": seg_metrics["FWIoU"], "Class_Dice": seg_metrics["Class_Dice"]}
 
-    @property
-    def progress_in_iter(self):
-        return self.epoch * self.max_iter + self.iter
+    def _log_eval(self, metrics, epoch, is_best):
+        logger.info("pixAcc:{}, mIoU:{}, mDice:{}, fwIoU:{}, Class_IoU:{}".format(
+            metrics["pixAcc"], metrics["mIoU"], metrics["mDice"], metrics["fwIoU"], metrics["Class_IoU"]))
+        for k in ("pixAcc", "mIoU", "mDice", "fwIoU"):
+            self.tblogger.add_scalar("val/{}".format(k), metrics[k], epoch + 1)
+        for k, v in metrics["Class_IoU"].items():
+            self.tblogger.add_scalar("val_detail/{} IoU".format(k), v, epoch + 1)
 
 
 @Registers.trainers.register
@@ -366,9 +137,12 @@ class SegEval:
                                                                output_dir=self.output_dir,
                                                                save_pic=True
                                                                )
-        logger.info("pixACC:{}\nmIoU:{}\nClass_IoU_dict:{}".format(pixAcc, mIoU, Class_IoU_dict))
+        seg_metrics = self.evaluator.seg_metrics
+        result = "pixACC:{}\nmIoU:{}\nmDice:{}\nfwIoU:{}\nClass_IoU_dict:{}\nClass_Dice_dict:{}".format(
+            pixAcc, mIoU, seg_metrics["Mean_Dice"], seg_metrics["FWIoU"], Class_IoU_dict, seg_metrics["Class_Dice"])
+        logger.info(result)
         with open(os.path.join(self.output_dir, "result.txt"), 'w', encoding='utf-8') as result_file:
-            result_file.write("pixACC:{}\nmIoU:{}\nClass_IoU_dict:{}".format(pixAcc, mIoU, Class_IoU_dict))
+            result_file.write(result)
         logger.info("DONE")
 
     def _before_eval(self):
@@ -402,6 +176,8 @@ class SegEval:
         ckpt_file = self.exp.trainer.ckpt
         ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(get_local_rank()))["model"]
         model = load_ckpt(model, ckpt)
+        model = fuse_conv_bn(model)    # 推理前把bn折叠到conv中
+        model.to(memory_format=get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None))
 
         logger.info("Model DDP Setting")
         if get_world_size() > 1:
@@ -409,12 +185,16 @@ class SegEval:
 
         self.model = model
         self.model.eval()
+        if "compile" in self.exp.trainer:    # 编译(可选), 失败时退回原模型
+            self.model = compile_model(self.model, **self.exp.trainer.compile.toDict())
 
         logger.info("9. Evaluator Setting ... ")
         self.evaluator = Registers.evaluators.get(self.exp.evaluator.type)(
             is_distributed=get_world_size() > 1,
             dataloader=self.exp.evaluator.dataloader,
-            num_classes=self.exp.model.kwargs.num_classes
+            num_classes=self.exp.model.kwargs.num_classes,
+            inference=self.exp.evaluator.inference if "inference" in self.exp.evaluator else None,  # 滑窗/TTA
+            **(self.exp.evaluator.kwargs if "kwargs" in self.exp.evaluator else {})  # 例如writer_workers
         )
         logger.info("Setting finished, eval start ......")
 
@@ -438,7 +218,8 @@ class SegDemo:
         for image, shape, img_p in self.images:
             image = torch.tensor(image).unsqueeze(0)  # 1, c, h, w
             image = image.to(device="cuda:{}".format(self.parser.gpu))  # 1, c, h, w
-            output = self.model(image)
+            with torch.no_grad():
+                output = self.inference(self.model, image) if self.inference is not None else self.model(image)
             output = np.uint8(output.data.max(1)[1].cpu().numpy()[0])
             output = colorize_mask(output, get_palette(self.exp.model.kwargs.num_classes))
             output = output.resize((shape[1], shape[0]))
@@ -478,7 +259,15 @@ class SegDemo:
         ckpt_file = self.exp.trainer.ckpt
         ckpt = torch.load(ckpt_file, map_location="cuda:{}".format(self.parser.gpu))["model"]
         self.model = load_ckpt(model, ckpt)
+        self.model = fuse_conv_bn(self.model)    # 推理前把bn折叠到conv中
+        self.model.to(memory_format=get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None))
         self.model.eval()
+        if "compile" in self.exp.trainer:    # 编译(可选), 失败时退回原模型
+            self.model = compile_model(self.model, **self.exp.trainer.compile.toDict())
+
+        # 推理方式(可选), 与SegEvaluator共用Registers.seg_inferences, 例如滑窗/多尺度/翻转TTA
+        self.inference = Registers.seg_inferences.get(self.exp.inference.type)(
+            **(self.exp.inference.kwargs if "kwargs" in self.exp.inference else {})) if "inference" in self.exp else None
 
         self.images = self._get_images()  # ndarray
 
@@ -496,12 +285,12 @@ class SegDemo:
         for p in all_p:
             all_paths.append(os.path.join(self.exp.images.path, p))
 
+        transform = get_transformer(self.exp.images.transforms.kwargs)  # 增强, 所有图片共用
         for img_p in all_paths:
             image = np.array(Image.open(img_p))  # h,w
             if len(image.shape) == 2:
                 image = np.expand_dims(image, axis=2)  # h,w,1
             shape = image.shape
-            transform = get_transformer(self.exp.images.transforms.kwargs)
             image = transform(image=image)['image']
             image = image.transpose(2, 0, 1)  # c, h, w
             results.append((image, shape, img_p))
@@ -550,6 +339,8 @@ class SegExport:
         ckpt_file = self.exp.trainer.ckpt
         ckpt = torch.load(ckpt_file, map_location="cpu")["model"]
         self.model = load_ckpt(model, ckpt)
+        self.model = fuse_conv_bn(self.model)    # 推理前把bn折叠到conv中
+        self.model.to(memory_format=get_memory_format(self.exp.trainer.memory_format if "memory_format" in self.exp.trainer else None))
         self.model.eval()
 
         logger.info("Setting finished, export onnx start ......")
@@ -25,6 +25,8 @@ from .dist import get_local_size
 from .dist import time_synchronized
 from .dist import gather
 from .dist import all_gather
+from .dist import all_reduce_sum  # 所有rank求和，用于验证指标的规约
+from .dist import all_gather_tensor  # 收集所有rank上长度不同的tensor
 from .dist import find_free_port  # 查找空闲端口
 from .dist import synchronize  # 当所有进程都到barrier时，才继续执行
 
@@ -44,7 +46,7 @@ from .logger import setup_logger
 
 
 # 6.模型保存、模型加载
-from .checkpoint import save_checkpoint, load_ckpt
+from .checkpoint import save_checkpoint, load_ckpt, check_state_dict, load_checkpoint_file, AsyncCheckpointSaver
 
 
 # 7.数据预读取
@@ -56,17 +58,20 @@ from .metrics import occupy_mem, gpu_mem_usage
 
 
 # 9.EMA 指数平均
-from .ema import EMA, ModelEMA, is_parallel
+from .ema import EMA, ModelEMA, FusedModelEMA, is_parallel
 
 
 # 10.显示设置
 from .visualize import denormalization  # 反归一化
-from .palette import get_palette, colorize_mask  # 分割可视化
+from .palette import get_palette, colorize_mask, get_palette_lut, colorize_mask_lut  # 分割可视化
 
 # 11.YOLOX 目标检测boxes.py文件定义的同居
 from .boxes import (
     filter_box,
     postprocess,
+    batched_postprocess,
+    box_iou,        # IoU/GIoU/DIoU/CIoU, pairwise/elementwise, torch/numpy
+    box_wh_iou,     # anchor与标注框宽高的IoU
     bboxes_iou,
     matrix_iou,
     adjust_box_anns,
@@ -76,3 +81,22 @@ from .boxes import (
 
 # 12. YoloV3所需要函数
 from .detUtils import multi_gt_creator
+
+# 13. 模型编译 torch.compile/TorchScript
+from .model_compile import compile_model
+
+# 14. conv+bn折叠, channels_last内存格式
+from .model_fuse import fuse_conv_bn, get_memory_format
+
+# 15. 分类输出分析: 保存logits, 阈值扫描、ROC/PR、温度缩放、ECE
+from .cls_analysis import (
+    LogitsDumper,
+    load_logits,
+    softmax,
+    threshold_sweep,
+    reject_sweep,
+    roc_curve,
+    pr_curve,
+    fit_temperature,
+    expected_calibration_error,
+)
@@ -2,6 +2,8 @@
 # -*- coding:utf-8 -*-
 # Copyright (c) 2014-2021 Megvii Inc. All rights reserved.
 
+import math
+import time
 import numpy as np
 
 import torch
@@ -10,6 +12,10 @@ import torchvision
 __all__ = [
     "filter_box",
     "postprocess",
+    "batched_postprocess",
+    "box_iou",
+    "box_wh_iou",
+    "benchmark_box_iou",
     "bboxes_iou",
     "matrix_iou",
     "adjust_box_anns",
@@ -32,79 +38,219 @@ def filter_box(output, scale_range):
 
 # 后处理：非极大值抑制 NMS， 调用torchvision; prediction:torch.Size([16, 8400, 85])
 def postprocess(prediction, num_classes, conf_thre=0.7, nms_thre=0.45, class_agnostic=False):
-    box_corner = prediction.new(prediction.shape)   # torch.Size([16, 8400, 85])
-    box_corner[:, :, 0] = prediction[:, :, 0] - prediction[:, :, 2] / 2
-    box_corner[:, :, 1] = prediction[:, :, 1] - prediction[:, :, 3] / 2
-    box_corner[:, :, 2] = prediction[:, :, 0] + prediction[:, :, 2] / 2
-    box_corner[:, :, 3] = prediction[:, :, 1] + prediction[:, :, 3] / 2
-    prediction[:, :, :4] = box_corner[:, :, :4]
-
-    output = [None for _ in range(len(prediction))]
-    for i, image_pred in enumerate(prediction):
-
-        # If none are remaining => process next image
-        if not image_pred.size(0):
-            continue
-        # Get score and class with highest confidence
-        # 提取最大得分值对应的类别和预测得分值
-        class_conf, class_pred = torch.max(image_pred[:, 5: 5 + num_classes], 1, keepdim=True)
-
-        conf_mask = (image_pred[:, 4] * class_conf.squeeze() >= conf_thre).squeeze()
-        # Detections ordered as (x1, y1, x2, y2, obj_conf, class_conf, class_pred)
-        # 拼接
-        detections = torch.cat((image_pred[:, :5], class_conf, class_pred.float()), 1)
-        detections = detections[conf_mask]
-        if not detections.size(0):
-            continue
-
-        if class_agnostic:
-            nms_out_index = torchvision.ops.nms(
-                detections[:, :4],
-                detections[:, 4] * detections[:, 5],
-                nms_thre,
-            )
-        else:
-            nms_out_index = torchvision.ops.batched_nms(
-                detections[:, :4],
-                detections[:, 4] * detections[:, 5],
-                detections[:, 6],
-                nms_thre,
-            )
-
-        detections = detections[nms_out_index]
-        if output[i] is None:
-            output[i] = detections
-        else:
-            output[i] = torch.cat((output[i], detections))
+    return batched_postprocess(prediction, num_classes, conf_thre=conf_thre, nms_thre=nms_thre,
+                               class_agnostic=class_agnostic, conf_type="score")
 
+
+def _batched_nms(boxes, scores, idxs, nms_thre):
+    """
+    offset技巧: 每组(图片/类别)的框平移到互不重叠的区域, 一次nms处理整个batch的所有组
+    :return: 保留框的下标, 按分数降序
+    """
+    offsets = idxs.to(boxes) * (boxes.max() + 1)
+    return torchvision.ops.nms(boxes + offsets[:, None], scores, nms_thre)
+
+
+def _weighted_merge(detections, group, keep, nms_thre):
+    """
+    加权合并: 每个框按obj_conf加权合并到抑制它的保留框(同组中分数最高且IoU>nms_thre的保留框),
+    与逐框循环的weighted NMS结果相同; 整个batch一次计算, IoU矩阵为[K, M], 不同组(图片/类别)之间的IoU被mask掉
+    :return: [K, 4] 合并后的保留框
+    """
+    kept = detections[keep]
+    iou = torchvision.ops.box_iou(kept[:, :4], detections[:, :4])
+    match = (iou > nms_thre) & (group[keep][:, None] == group[None, :])
+    owner = match.int().argmax(0)     # 第一个(分数最高)匹配的保留框
+    weights = detections[:, 4] * match.any(0)
+    box_sum = kept.new_zeros(len(kept), 4).scatter_add_(0, owner[:, None].expand(-1, 4), detections[:, :4] * weights[:, None])
+    weight_sum = kept.new_zeros(len(kept)).scatter_add_(0, owner, weights)
+    return box_sum / weight_sum[:, None]
+
+
+def batched_postprocess(prediction, num_classes=None, conf_thre=0.7, nms_thre=0.45, class_agnostic=False,
+                        conf_type="score", weighted=False, pre_topk=None, max_det=None):
+    """
+    Function: 批量后处理, 整个batch的框一次NMS, 不逐图片/逐框循环
+
+    :param prediction: [B, N, 5+num_classes] (cx, cy, w, h, obj_conf, cls_conf...)
+    :param num_classes: int 类别数, None时从prediction推断
+    :param conf_thre: float 置信度阈值
+    :param nms_thre: float NMS的IoU阈值
+    :param class_agnostic: bool 不同类别的框之间也做NMS
+    :param conf_type: str "score"过滤obj_conf*cls_conf(YOLOX), "obj"过滤obj_conf(YOLOv3)
+    :param weighted: bool 被抑制的框按obj_conf加权合并到保留框
+    :param pre_topk: int 每张图片NMS前只保留分数最高的pre_topk个框, None表示不限制
+    :param max_det: int 每张图片最多输出的框数, None表示不限制
+    :return: list of [n, 7] (x1, y1, x2, y2, obj_conf, class_conf, class_pred), 按分数降序, 没有框时为None
+    """
+    assert conf_type in ("score", "obj"), "conf_type must be score or obj, but got {}".format(conf_type)
+    batch_size, num_boxes = prediction.shape[:2]
+    num_classes = prediction.shape[2] - 5 if num_classes is None else num_classes
+    output = [None for _ in range(batch_size)]
+
+    boxes = torch.cat((prediction[..., :2] - prediction[..., 2:4] / 2,
+                       prediction[..., :2] + prediction[..., 2:4] / 2), -1)
+    obj_conf = prediction[..., 4]
+    class_conf, class_pred = prediction[..., 5: 5 + num_classes].max(-1)
+    scores = obj_conf * class_conf
+    conf_mask = (obj_conf if conf_type == "obj" else scores) >= conf_thre   # [B, N]
+    batch_idx = torch.arange(batch_size, device=prediction.device)[:, None].expand(-1, num_boxes)
+
+    if pre_topk is not None and pre_topk < num_boxes:
+        topk_idx = torch.where(conf_mask, scores, scores.new_full((), -1)).topk(pre_topk, dim=1)[1]   # [B, k]
+        boxes = boxes.gather(1, topk_idx[..., None].expand(-1, -1, 4))
+        obj_conf, class_conf, class_pred, scores, conf_mask = [
+            x.gather(1, topk_idx) for x in (obj_conf, class_conf, class_pred, scores, conf_mask)]
+        batch_idx = batch_idx[:, :pre_topk]
+
+    # Detections ordered as (x1, y1, x2, y2, obj_conf, class_conf, class_pred)
+    detections = torch.cat((boxes, obj_conf[..., None], class_conf[..., None], class_pred[..., None].float()), -1)
+    detections, scores, batch_idx, class_pred = \
+        detections[conf_mask], scores[conf_mask], batch_idx[conf_mask], class_pred[conf_mask]
+    if not detections.size(0):
+        return output
+
+    group = batch_idx if class_agnostic else batch_idx * num_classes + class_pred
+    keep = _batched_nms(detections[:, :4], scores, group, nms_thre)
+    kept = detections[keep]
+    if weighted:
+        kept[:, :4] = _weighted_merge(detections, group, keep, nms_thre)
+
+    kept_batch = batch_idx[keep]
+    for i in range(batch_size):
+        detections_i = kept[kept_batch == i]
+        if max_det is not None:
+            detections_i = detections_i[:max_det]
+        if detections_i.size(0):
+            output[i] = detections_i
     return output
 
 
-# 计算两个bbox的iou
+def _corners(boxes, fmt):
+    """
+    :param fmt: str xyxy(左上角右下角), cxcywh(中心点+宽高), xywh(左上角+宽高)
+    :return: x1, y1, x2, y2 形状为boxes.shape[:-1]
+    """
+    if fmt == "xyxy":
+        return boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    if fmt == "cxcywh":
+        cx, cy, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+        return cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2
+    if fmt == "xywh":
+        x, y, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+        return x, y, x + w, y + h
+    raise ValueError("fmt must be xyxy, cxcywh or xywh, but got {}".format(fmt))
+
+
+def box_iou(boxes1, boxes2, iou_type="iou", fmt="xyxy", pairwise=True, pixel_offset=0, eps=1e-7, dtype=None):
+    """
+    Function: IoU/GIoU/DIoU/CIoU, torch.Tensor和np.ndarray通用, 所有检测的loss、匹配、验证都使用这个函数
+
+    :param boxes1: (..., N, 4) 前面的维度为batch(每张图片), elementwise时为(..., 4)
+    :param boxes2: (..., M, 4) 与boxes1的batch维度可广播
+    :param iou_type: str iou, giou, diou, ciou
+    :param fmt: str 框的格式 xyxy, cxcywh, xywh
+    :param pairwise: bool True返回(..., N, M)的IoU矩阵, False逐个框计算返回(...)
+    :param pixel_offset: 0或1, 1为像素坐标的+1约定(宽 = x2 - x1 + 1), 旧的YOLOv3/DetEvaluator使用
+    :param eps: float 防止除0
+    :param dtype: 计算精度(可选), 例如torch.float16, 半精度只适用于归一化/网格坐标(像素坐标的面积会溢出)
+    :return: 与输入相同类型(tensor/ndarray)
+    """
+    is_tensor = torch.is_tensor(boxes1)
+    maximum, minimum = (torch.maximum, torch.minimum) if is_tensor else (np.maximum, np.minimum)
+    atan = torch.atan if is_tensor else np.arctan
+    if dtype is not None:
+        boxes1 = boxes1.to(dtype) if is_tensor else boxes1.astype(dtype)
+        boxes2 = boxes2.to(dtype) if is_tensor else boxes2.astype(dtype)
+
+    b1_x1, b1_y1, b1_x2, b1_y2 = _corners(boxes1, fmt)
+    b2_x1, b2_y1, b2_x2, b2_y2 = _corners(boxes2, fmt)
+    if pairwise:    # (..., N, 1)和(..., 1, M)广播成(..., N, M)
+        b1_x1, b1_y1, b1_x2, b1_y2 = [v[..., :, None] for v in (b1_x1, b1_y1, b1_x2, b1_y2)]
+        b2_x1, b2_y1, b2_x2, b2_y2 = [v[..., None, :] for v in (b2_x1, b2_y1, b2_x2, b2_y2)]
+
+    w1, h1 = b1_x2 - b1_x1 + pixel_offset, b1_y2 - b1_y1 + pixel_offset
+    w2, h2 = b2_x2 - b2_x1 + pixel_offset, b2_y2 - b2_y1 + pixel_offset
+    inter_w = minimum(b1_x2, b2_x2) - maximum(b1_x1, b2_x1) + pixel_offset
+    inter_h = minimum(b1_y2, b2_y2) - maximum(b1_y1, b2_y1) + pixel_offset
+    inter = (inter_w * (inter_w > 0)) * (inter_h * (inter_h > 0))
+    union = w1 * h1 + w2 * h2 - inter
+    iou = inter / (union + eps)
+    if iou_type == "iou":
+        return iou
+
+    # 最小外接矩形
+    cw = maximum(b1_x2, b2_x2) - minimum(b1_x1, b2_x1) + pixel_offset
+    ch = maximum(b1_y2, b2_y2) - minimum(b1_y1, b2_y1) + pixel_offset
+    if iou_type == "giou":
+        c_area = cw * ch + eps
+        return iou - (c_area - union) / c_area
+    c2 = cw ** 2 + ch ** 2 + eps    # 外接矩形对角线距离的平方
+    rho2 = ((b2_x1 + b2_x2 - b1_x1 - b1_x2) ** 2 + (b2_y1 + b2_y2 - b1_y1 - b1_y2) ** 2) / 4   # 中心点距离的平方
+    if iou_type == "diou":
+        return iou - rho2 / c2
+    if iou_type == "ciou":
+        v = (4 / math.pi ** 2) * (atan(w2 / (h2 + eps)) - atan(w1 / (h1 + eps))) ** 2
+        alpha = v / (v - iou + (1 + eps))
+        if is_tensor:
+            alpha = alpha.detach()  # alpha作为权重, 不参与求导
+        return iou - (rho2 / c2 + v * alpha)
+    raise ValueError("iou_type must be iou, giou, diou or ciou, but got {}".format(iou_type))
+
+
+def box_wh_iou(wh1, wh2, eps=1e-16):
+    """
+    Function: 只考虑宽高(中心点对齐)的IoU矩阵, 用于anchor与标注框的匹配, torch.Tensor和np.ndarray通用
+
+    :param wh1: (N, 2) 例如anchor的(w, h)
+    :param wh2: (M, 2) 例如标注框的(w, h)
+    :return: (N, M)
+    """
+    minimum = torch.minimum if torch.is_tensor(wh1) else np.minimum
+    w1, h1 = wh1[:, 0, None], wh1[:, 1, None]
+    w2, h2 = wh2[None, :, 0], wh2[None, :, 1]
+    inter = minimum(w1, w2) * minimum(h1, h2)
+    return inter / (w1 * h1 + w2 * h2 - inter + eps)
+
+
+def benchmark_box_iou(num_boxes1=1000, num_boxes2=1000, batch=8, iou_type="iou", device="cuda", dtype=torch.float32,
+                      repeat=20):
+    """
+    Function: 测试box_iou的速度(pairwise, batch张图片), 与逐框循环对比, 例如
+        python -c "from dao.utils.boxes import benchmark_box_iou; print(benchmark_box_iou())"
+
+    :return: dict 每次调用的耗时(ms)
+    """
+    device = device if torch.cuda.is_available() else "cpu"
+    xy = torch.rand(batch, num_boxes1 + num_boxes2, 2, device=device) * 600
+    wh = torch.rand(batch, num_boxes1 + num_boxes2, 2, device=device) * 100 + 1
+    boxes = torch.cat([xy, xy + wh], -1).to(dtype)
+    boxes1, boxes2 = boxes[:, :num_boxes1], boxes[:, num_boxes1:]
+
+    def timeit(fn, n):
+        fn()
+        torch.cuda.synchronize() if device != "cpu" else None
+        t = time.time()
+        for _ in range(n):
+            fn()
+        torch.cuda.synchronize() if device != "cpu" else None
+        return (time.time() - t) / n * 1000
+
+    result = {
+        "batched": timeit(lambda: box_iou(boxes1, boxes2, iou_type), repeat),
+        "per_image": timeit(lambda: [box_iou(b1, b2, iou_type) for b1, b2 in zip(boxes1, boxes2)], repeat),
+        "per_box": timeit(lambda: [box_iou(b, boxes2[0], iou_type, pairwise=False) for b in boxes1[0, :100, None]],
+                          1) * num_boxes1 / 100 * batch,
+        "numpy": timeit(lambda: box_iou(boxes1.float().cpu().numpy(), boxes2.float().cpu().numpy(), iou_type), 1),
+    }
+    return result
+
+
+# 计算两个bbox的iou矩阵, xyxy=False时为(cx, cy, w, h)
 def bboxes_iou(bboxes_a, bboxes_b, xyxy=True):
     if bboxes_a.shape[1] != 4 or bboxes_b.shape[1] != 4:
         raise IndexError
-
-    if xyxy:
-        tl = torch.max(bboxes_a[:, None, :2], bboxes_b[:, :2])
-        br = torch.min(bboxes_a[:, None, 2:], bboxes_b[:, 2:])
-        area_a = torch.prod(bboxes_a[:, 2:] - bboxes_a[:, :2], 1)
-        area_b = torch.prod(bboxes_b[:, 2:] - bboxes_b[:, :2], 1)
-    else:
-        tl = torch.max(
-            (bboxes_a[:, None, :2] - bboxes_a[:, None, 2:] / 2),
-            (bboxes_b[:, :2] - bboxes_b[:, 2:] / 2),
-        )
-        br = torch.min(
-            (bboxes_a[:, None, :2] + bboxes_a[:, None, 2:] / 2),
-            (bboxes_b[:, :2] + bboxes_b[:, 2:] / 2),
-        )
-
-        area_a = torch.prod(bboxes_a[:, 2:], 1)
-        area_b = torch.prod(bboxes_b[:, 2:], 1)
-    en = (tl < br).type(tl.type()).prod(dim=2)
-    area_i = torch.prod(br - tl, 2) * en  # * ((tl < br).all())
-    return area_i / (area_a[:, None] + area_b - area_i)
+    return box_iou(bboxes_a, bboxes_b, fmt="xyxy" if xyxy else "cxcywh", eps=0)
 
 
 # 计算iou矩阵
@@ -112,13 +258,7 @@ def matrix_iou(a, b):
     """
     return iou of a and b, numpy version for data augenmentation
     """
-    lt = np.maximum(a[:, np.newaxis, :2], b[:, :2])
-    rb = np.minimum(a[:, np.newaxis, 2:], b[:, 2:])
-
-    area_i = np.prod(rb - lt, axis=2) * (lt < rb).all(axis=2)
-    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
-    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
-    return area_i / (area_a[:, np.newaxis] + area_b - area_i + 1e-12)
+    return box_iou(a, b, eps=1e-12)
 
 
 # 调整框的大小
@@ -3,44 +3,168 @@
 # Copyright (c) 2014-2021 Megvii Inc. All rights reserved.
 import os
 import shutil
+import threading
+from collections import OrderedDict
 from loguru import logger
 
 import torch
+from torch import distributed as dist
 
-__all__ = ['load_ckpt', 'save_checkpoint']
+__all__ = ['load_ckpt', 'check_state_dict', 'load_checkpoint_file', 'save_checkpoint', 'AsyncCheckpointSaver']
+
+
+def check_state_dict(model_state_dict, ckpt):
+    """
+    用集合运算比较key, 一次比较shape, 返回可加载的权重和跳过的key
+
+    :param model_state_dict: model.state_dict()
+    :param ckpt: dict ckpt中的权重
+    :return: load_dict, report{"missing": [...], "unexpected": [...], "shape_mismatch": [(key, ckpt_shape, model_shape)]}
+    """
+    model_keys, ckpt_keys = set(model_state_dict.keys()), set(ckpt.keys())
+    common = model_keys & ckpt_keys
+    shape_mismatch = [(k, tuple(ckpt[k].shape), tuple(model_state_dict[k].shape))
+                      for k in common if model_state_dict[k].shape != ckpt[k].shape]
+    mismatch_keys = set(k for k, _, _ in shape_mismatch)
+    load_dict = {k: ckpt[k] for k in model_state_dict.keys() if k in common and k not in mismatch_keys}
+    report = {
+        "missing": sorted(model_keys - ckpt_keys),
+        "unexpected": sorted(ckpt_keys - model_keys),
+        "shape_mismatch": sorted(shape_mismatch),
+    }
+    return load_dict, report
 
 
 def load_ckpt(model, ckpt):
     """
-    将ckpt中的权重加载到model中，将key相同的，shape相同的加载
+    将ckpt中的权重加载到model中，将key相同的，shape相同的加载, 跳过的key汇总输出一次
     :param model:
     :param ckpt:
     :return:
     """
-    model_state_dict = model.state_dict()
-    load_dict = {}
-    for key_model, v in model_state_dict.items():
-        if key_model not in ckpt:
-            logger.warning(
-                "{} is not in the ckpt. Please double check and see if this is desired.".format(
-                    key_model
-                )
-            )
-            continue
-        v_ckpt = ckpt[key_model]
-        if v.shape != v_ckpt.shape:
-            logger.warning(
-                "Shape of {} in checkpoint is {}, while shape of {} in model is {}.".format(
-                    key_model, v_ckpt.shape, key_model, v.shape
-                )
-            )
-            continue
-        load_dict[key_model] = v_ckpt
+    load_dict, report = check_state_dict(model.state_dict(), ckpt)
+    if report["missing"]:
+        logger.warning("{} keys are not in the ckpt. Please double check and see if this is desired: {}".format(
+            len(report["missing"]), report["missing"]))
+    if report["unexpected"]:
+        logger.info("{} keys in the ckpt are not used: {}".format(len(report["unexpected"]), report["unexpected"]))
+    if report["shape_mismatch"]:
+        logger.warning("{} keys are skipped because of shape mismatch (key, ckpt shape, model shape): {}".format(
+            len(report["shape_mismatch"]), report["shape_mismatch"]))
+    logger.info("load {}/{} keys from ckpt".format(len(load_dict), len(model.state_dict())))
 
     model.load_state_dict(load_dict, strict=False)
     return model
 
 
+class _TensorPlaceholder:
+    """
+    广播ckpt时代替tensor的占位符, 只记录位置, shape和dtype
+    """
+    __slots__ = ("index", "shape", "dtype")
+
+    def __init__(self, index, shape, dtype):
+        self.index, self.shape, self.dtype = index, shape, dtype
+
+
+def _flatten_tensors(obj, tensors):
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return _TensorPlaceholder(len(tensors) - 1, tuple(obj.shape), obj.dtype)
+    if isinstance(obj, dict):
+        out = OrderedDict((k, _flatten_tensors(v, tensors)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _fill_tensors(obj, tensors):
+    if isinstance(obj, _TensorPlaceholder):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        out = OrderedDict((k, _fill_tensors(v, tensors)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_fill_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _collect_placeholders(obj, out):
+    if isinstance(obj, _TensorPlaceholder):
+        out.append(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _collect_placeholders(v, out)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _collect_placeholders(v, out)
+    return out
+
+
+def _broadcast_ckpt(ckpt, device):
+    """
+    rank0把ckpt广播给其他rank: 先广播结构(不含tensor数据), 再按dtype把tensor拼成一个buffer广播, 每种dtype只广播一次
+    """
+    tensors = []
+    skeleton = [_flatten_tensors(ckpt, tensors) if dist.get_rank() == 0 else None]
+    dist.broadcast_object_list(skeleton, src=0)
+    skeleton = skeleton[0]
+    placeholders = sorted(_collect_placeholders(skeleton, []), key=lambda p: p.index)
+
+    results = [None] * len(placeholders)
+    for dtype in sorted(set(p.dtype for p in placeholders), key=str):
+        group = [p for p in placeholders if p.dtype == dtype]
+        numels = [int(torch.Size(p.shape).numel()) for p in group]
+        buf = torch.empty(sum(numels), dtype=dtype, device=device)
+        if dist.get_rank() == 0:
+            torch.cat([tensors[p.index].reshape(-1).to(device) for p in group], out=buf)
+        dist.broadcast(buf, src=0)
+        for p, t in zip(group, torch.split(buf, numels)):
+            results[p.index] = t.view(p.shape)
+    return _fill_tensors(skeleton, results)
+
+
+def load_checkpoint_file(ckpt_file, device="cpu", broadcast=True):
+    """
+    Function: 读取ckpt文件
+        1. 使用mmap读取(torch>=2.1), 只有用到的tensor才从磁盘读入内存;
+        2. 多卡时只有rank0读文件, 然后广播给其他rank, 读取时间不随卡数增加
+
+    :param ckpt_file: ckpt路径
+    :param device: tensor放到的设备, nccl后端时必须为当前rank的GPU
+    :param broadcast: bool 多卡时是否由rank0读取后广播
+    :return: ckpt
+    """
+    distributed = broadcast and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    ckpt = None
+    if not distributed or dist.get_rank() == 0:
+        try:
+            ckpt = torch.load(ckpt_file, map_location="cpu", mmap=True)
+        except (TypeError, RuntimeError):    # 旧版torch或非zip格式的ckpt不支持mmap
+            ckpt = torch.load(ckpt_file, map_location="cpu")
+    if distributed:
+        return _broadcast_ckpt(ckpt, device)
+    return _to_device(ckpt, device)
+
+
+def _to_device(obj, device):
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    if isinstance(obj, dict):
+        out = OrderedDict((k, _to_device(v, device)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_device(v, device) for v in obj)
+    return obj
+
+
 def save_checkpoint(state, is_best, save_dir, model_name=""):
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
@@ -49,3 +173,103 @@ def save_checkpoint(state, is_best, save_dir, model_name=""):
     if is_best:
         best_filename = os.path.join(save_dir, "best_ckpt.pth")
         shutil.copyfile(filename, best_filename)
+
+
+def _link_or_copy(src, dst):
+    """
+    用硬链接代替拷贝, 先链接到临时文件再rename, 保证dst总是完整的; 不支持硬链接时(跨设备等)退回拷贝
+    """
+    tmp = dst + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class AsyncCheckpointSaver:
+    def __init__(self, save_dir, keep_last=3, pin_memory=True):
+        """
+        Function: 异步保存ckpt
+            1. state中的tensor拷贝到(复用的)pinned CPU内存, 只在拷贝完成时同步一次GPU;
+            2. 后台线程torch.save到临时文件, 再os.replace原子替换, 中途崩溃不会留下损坏的ckpt;
+            3. rotate=True的ckpt(按step/时间保存)只保留最近keep_last个;
+            4. best_ckpt.pth硬链接到对应ckpt, 不再拷贝文件
+            同一时间只有一个写线程, 下一次save前会等待上一次写完
+
+        :param save_dir: 保存目录
+        :param keep_last: int rotate的ckpt保留个数
+        :param pin_memory: bool 是否使用pinned内存
+        """
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = {}      # 复用的CPU内存, key为state中的路径
+        self._rotating = []     # rotate的ckpt路径, 从旧到新
+        self._thread = None
+        os.makedirs(save_dir, exist_ok=True)
+
+    def _to_cpu(self, obj, path=()):
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type == "cpu":
+                return obj.clone()
+            buf = self._buffers.get(path)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=self.pin_memory)
+                self._buffers[path] = buf
+            return buf.copy_(obj.detach(), non_blocking=self.pin_memory)
+        if isinstance(obj, dict):
+            out = OrderedDict((k, self._to_cpu(v, path + (k,))) for k, v in obj.items())
+            if hasattr(obj, "_metadata"):   # state_dict的版本信息
+                out._metadata = obj._metadata
+            return out
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_cpu(v, path + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, state, model_name, is_best=False, rotate=False):
+        """
+        :param state: dict, 可以包含GPU上的tensor
+        :param model_name: 保存为{model_name}_ckpt.pth
+        :param is_best: 是否链接为best_ckpt.pth
+        :param rotate: 是否参与last-k轮换
+        """
+        self.wait()     # 上一次写完才能复用CPU内存
+        cpu_state = self._to_cpu(state)
+        if self.pin_memory:
+            torch.cuda.current_stream().synchronize()   # 等待non_blocking拷贝完成
+        filename = os.path.join(self.save_dir, model_name + "_ckpt.pth")
+        self._thread = threading.Thread(target=self._write, args=(cpu_state, filename, is_best, rotate), daemon=True)
+        self._thread.start()
+
+    def _write(self, cpu_state, filename, is_best, rotate):
+        try:
+            tmp = filename + ".tmp"
+            torch.save(cpu_state, tmp)
+            os.replace(tmp, filename)   # 原子替换
+            if is_best:
+                _link_or_copy(filename, os.path.join(self.save_dir, "best_ckpt.pth"))
+            if rotate:
+                if filename in self._rotating:
+                    self._rotating.remove(filename)
+                self._rotating.append(filename)
+                while len(self._rotating) > self.keep_last:
+                    old = self._rotating.pop(0)
+                    if os.path.exists(old):
+                        os.remove(old)  # best_ckpt.pth是硬链接, 不受影响
+        except Exception as e:
+            logger.error("save checkpoint {} failed: {}".format(filename, e))
+
+    def link_best(self, model_name):
+        """
+        把已保存的{model_name}_ckpt.pth链接为best_ckpt.pth(等待写完)
+        """
+        self.wait()
+        _link_or_copy(os.path.join(self.save_dir, model_name + "_ckpt.pth"), os.path.join(self.save_dir, "best_ckpt.pth"))
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+分类输出分析: 验证时把logits(float16, memmap)与图片路径、标签一起保存一次, 之后不再运行模型,
+    一次性(对所有阈值向量化)计算阈值扫描(过检/漏检/拒识率), ROC/PR曲线, 温度缩放和ECE
+    保存: ClsEvaluator的kwargs "dump_logits": true, 输出到 output_dir/logits
+    分析: trainer.type 为 ClsAnalysis
+"""
+import os
+import json
+import glob
+import numpy as np
+
+__all__ = ['LogitsDumper', 'load_logits', 'softmax', 'threshold_sweep', 'reject_sweep', 'roc_curve', 'pr_curve',
+           'fit_temperature', 'expected_calibration_error']
+
+
+class LogitsDumper:
+    """
+    每个rank把自己分片的logits写到 rank{r}_logits.npy(float16 memmap, [N, C]),
+    标签写到 rank{r}_labels.npy, 图片路径按相同顺序写到 rank{r}_paths.txt
+    """
+    def __init__(self, dump_dir, num_samples, num_classes, rank=0):
+        """
+        :param dump_dir: 输出目录
+        :param num_samples: int 本rank的样本数(len(sampler))
+        :param num_classes: int 类别数
+        :param rank: int 当前rank
+        """
+        os.makedirs(dump_dir, exist_ok=True)
+        self.prefix = os.path.join(dump_dir, "rank{}_".format(rank))
+        self.logits = np.lib.format.open_memmap(self.prefix + "logits.npy", mode="w+", dtype=np.float16,
+                                                shape=(num_samples, num_classes))
+        self.labels = np.lib.format.open_memmap(self.prefix + "labels.npy", mode="w+", dtype=np.int64,
+                                                shape=(num_samples,))
+        self.paths = open(self.prefix + "paths.txt", "w", encoding="utf-8")
+        self.count = 0
+
+    def write(self, outputs, targets, paths):
+        """
+        :param outputs: tensor (b, C) logits
+        :param targets: tensor (b,)
+        :param paths: list of str
+        """
+        b = outputs.shape[0]
+        assert self.count + b <= len(self.logits), "more samples than len(sampler)"
+        self.logits[self.count:self.count + b] = outputs.detach().half().cpu().numpy()
+        self.labels[self.count:self.count + b] = targets.detach().cpu().numpy()
+        self.paths.writelines(p + "\n" for p in paths)
+        self.count += b
+
+    def close(self):
+        self.logits.flush()
+        self.labels.flush()
+        self.paths.close()
+        with open(self.prefix + "meta.json", "w") as f:
+            json.dump({"num_samples": self.count, "num_classes": self.logits.shape[1]}, f)
+
+
+def load_logits(dump_dir):
+    """
+    读取LogitsDumper保存的所有rank的结果
+    :return: logits (N, C) float16(单个rank时为只读memmap), labels (N,) int64, paths list of str
+    """
+    metas = sorted(glob.glob(os.path.join(dump_dir, "rank*_meta.json")),
+                   key=lambda p: int(os.path.basename(p)[4:].split("_")[0]))
+    assert len(metas), "no logits found in {}".format(dump_dir)
+    logits, labels, paths = [], [], []
+    for meta_file in metas:
+        prefix = meta_file[:-len("meta.json")]
+        with open(meta_file) as f:
+            n = json.load(f)["num_samples"]
+        logits.append(np.load(prefix + "logits.npy", mmap_mode="r")[:n])
+        labels.append(np.load(prefix + "labels.npy", mmap_mode="r")[:n])
+        with open(prefix + "paths.txt", encoding="utf-8") as f:
+            paths += f.read().splitlines()[:n]
+    if len(metas) == 1:
+        return logits[0], np.asarray(labels[0]), paths
+    return np.concatenate(logits), np.concatenate(labels), paths
+
+
+def softmax(logits, temperature=1.0):
+    """
+    :param logits: (N, C) 任意浮点类型, 按float64计算
+    """
+    z = np.asarray(logits, dtype=np.float64) / temperature
+    z = z - z.max(1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(1, keepdims=True)
+
+
+def _count_above(scores, flags, thresholds):
+    """
+    对所有阈值向量化: 分数降序排序后累加flags, searchsorted得到每个阈值下 score >= t 的样本数和其中flags的个数
+    :return: (num_above, flag_above) 均为 (T,)
+    """
+    order = np.argsort(-scores, kind="stable")
+    flag_cum = np.concatenate([[0], np.cumsum(flags[order])])
+    num_above = np.searchsorted(-scores[order], -np.asarray(thresholds, dtype=np.float64), side="right")
+    return num_above, flag_cum[num_above]
+
+
+def threshold_sweep(scores, positives, thresholds=None):
+    """
+    二分类(OK/NG)阈值扫描, score >= t 判为正类(NG)
+    :param scores: (N,) 正类分数, 例如 1 - p(OK)
+    :param positives: (N,) bool 是否为正类
+    :param thresholds: (T,) 默认 0~1 共1001个阈值
+    :return: dict, 每个值为 (T,) 数组: threshold, tp, fp, fn, tn, precision, recall,
+        escape_rate(漏检率 fn/P), overkill_rate(过检率 fp/N), accuracy, f1
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    positives = np.asarray(positives, dtype=bool)
+    thresholds = np.linspace(0, 1, 1001) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+    num_above, tp = _count_above(scores, positives, thresholds)
+    fp = num_above - tp
+    num_pos = positives.sum()
+    num_neg = len(positives) - num_pos
+    fn, tn = num_pos - tp, num_neg - fp
+    precision = tp / np.maximum(num_above, 1)
+    recall = tp / max(num_pos, 1)
+    return {
+        "threshold": thresholds,
+        "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+        "precision": precision,
+        "recall": recall,
+        "escape_rate": fn / max(num_pos, 1),
+        "overkill_rate": fp / max(num_neg, 1),
+        "accuracy": (tp + tn) / max(len(positives), 1),
+        "f1": 2 * precision * recall / np.maximum(precision + recall, 1e-12),
+    }
+
+
+def reject_sweep(probs, labels, thresholds=None):
+    """
+    多分类拒识阈值扫描: 最大概率 < t 的样本拒识(交给人工)
+    :param probs: (N, C) softmax概率
+    :param labels: (N,)
+    :return: dict, 每个值为 (T,) 数组: threshold, reject_rate(拒识率), accuracy(接受样本的准确率), error_rate(错误率, 相对全部样本)
+    """
+    probs = np.asarray(probs)
+    labels = np.asarray(labels)
+    thresholds = np.linspace(0, 1, 1001) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+    correct = probs.argmax(1) == labels
+    num_accept, num_correct = _count_above(probs.max(1).astype(np.float64), correct, thresholds)
+    n = max(len(labels), 1)
+    return {
+        "threshold": thresholds,
+        "reject_rate": 1 - num_accept / n,
+        "accuracy": num_correct / np.maximum(num_accept, 1),
+        "error_rate": (num_accept - num_correct) / n,
+    }
+
+
+def _distinct_counts(scores, positives):
+    """按分数降序, 每个不同分数处的累计tp, fp"""
+    order = np.argsort(-scores, kind="stable")
+    scores, positives = scores[order], positives[order]
+    idx = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]   # 每个不同分数的最后一个位置
+    tps = np.cumsum(positives)[idx]
+    fps = idx + 1 - tps
+    return tps, fps, scores[idx]
+
+
+def roc_curve(scores, positives):
+    """
+    :return: fpr, tpr, thresholds (曲线从(0, 0)开始), auc
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    positives = np.asarray(positives, dtype=bool)
+    tps, fps, thresholds = _distinct_counts(scores, positives)
+    tpr = np.r_[0, tps] / max(positives.sum(), 1)
+    fpr = np.r_[0, fps] / max(len(positives) - positives.sum(), 1)
+    thresholds = np.r_[np.inf, thresholds]
+    auc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)    # 梯形积分
+    return fpr, tpr, thresholds, auc
+
+
+def pr_curve(scores, positives):
+    """
+    :return: precision, recall, thresholds, ap(阶梯积分, 与sklearn的average_precision相同)
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    positives = np.asarray(positives, dtype=bool)
+    tps, fps, thresholds = _distinct_counts(scores, positives)
+    precision = tps / (tps + fps)
+    recall = tps / max(positives.sum(), 1)
+    ap = np.sum(np.diff(np.r_[0, recall]) * precision)
+    return precision, recall, thresholds, ap
+
+
+def _nll(logits, labels, temperature):
+    z = np.asarray(logits, dtype=np.float64) / temperature
+    z = z - z.max(1, keepdims=True)
+    log_probs = z - np.log(np.exp(z).sum(1, keepdims=True))
+    return -log_probs[np.arange(len(labels)), labels].mean()
+
+
+def fit_temperature(logits, labels, t_min=0.05, t_max=20.0, iters=60):
+    """
+    温度缩放: 在log(T)上做黄金分割搜索, 最小化验证集的NLL(NLL对1/T是凸函数)
+    :return: (temperature, nll_before, nll_after)
+    """
+    labels = np.asarray(labels)
+    lo, hi = np.log(t_min), np.log(t_max)
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = hi - ratio * (hi - lo), lo + ratio * (hi - lo)
+    fa, fb = _nll(logits, labels, np.exp(a)), _nll(logits, labels, np.exp(b))
+    for _ in range(iters):
+        if fa < fb:
+            hi, b, fb = b, a, fa
+            a = hi - ratio * (hi - lo)
+            fa = _nll(logits, labels, np.exp(a))
+        else:
+            lo, a, fa = a, b, fb
+            b = lo + ratio * (hi - lo)
+            fb = _nll(logits, labels, np.exp(b))
+    temperature = float(np.exp((lo + hi) / 2))
+    return temperature, _nll(logits, labels, 1.0), _nll(logits, labels, temperature)
+
+
+def expected_calibration_error(probs, labels, n_bins=15):
+    """
+    :param probs: (N, C) softmax概率
+    :param labels: (N,)
+    :return: (ece, mce, bins) bins为dict, 每个值为 (n_bins,) 数组: confidence, accuracy, count, 可用于可靠性图
+    """
+    probs = np.asarray(probs)
+    confidence = probs.max(1).astype(np.float64)
+    correct = (probs.argmax(1) == np.asarray(labels)).astype(np.float64)
+    bin_ids = np.clip(np.ceil(confidence * n_bins).astype(np.int64) - 1, 0, n_bins - 1)  # (i/n, (i+1)/n]
+    count = np.bincount(bin_ids, minlength=n_bins)
+    conf_sum = np.bincount(bin_ids, weights=confidence, minlength=n_bins)
+    acc_sum = np.bincount(bin_ids, weights=correct, minlength=n_bins)
+    conf_mean, acc_mean = conf_sum / np.maximum(count, 1), acc_sum / np.maximum(count, 1)
+    gap = np.abs(conf_mean - acc_mean)
+    ece = float((gap * count).sum() / max(count.sum(), 1))
+    mce = float(gap[count > 0].max()) if count.any() else 0.0
+    return ece, mce, {"confidence": conf_mean, "accuracy": acc_mean, "count": count}
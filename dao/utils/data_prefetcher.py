@@ -6,7 +6,7 @@ import torch
 
 
 class DataPrefetcherDet:
-    def __init__(self, loader, device):
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
         """
         Function: 数据提前加载
             DataPrefetcher is inspired by code of following file:
@@ -24,23 +24,29 @@ class DataPrefetcherDet:
             # dataloader必须设置pin_memory=True来满足第一个条件。
         :param loader: dataloader类的实例
         :param device: GPU设备
+        :param memory_format: images拷贝到GPU后的内存格式, 例如torch.channels_last
         """
         self.loader = iter(loader)
         self.dataset = loader.dataset
         self.device = device
+        self.memory_format = memory_format
         #  CUDA流表示一个GPU操作队列,该队列中的操作将以添加到流中的先后顺序而依次执行。
         #  可以将一个流看做是GPU上的一个任务,不同任务可以并行执行。
         self.stream = torch.cuda.Stream()  # 新开cuda stream来拷贝tensor到gpu。
         self.input_cuda = self._input_cuda_for_image    # for image, labels
         self.record_stream = DataPrefetcherDet._record_stream_for_image
+        self.counts = None
         self.preload()
 
     def preload(self):
         try:
-            self.next_images, self.next_labels, self.next_paths = next(self.loader)
+            batch = next(self.loader)
         except StopIteration:
-            self.next_images, self.next_labels , self.next_paths = None, None, None
+            self.next_images, self.next_labels, self.next_paths, self.next_counts = None, None, None, None
             return
+        # DetectionCollate(max_boxes)返回填充后的labels[B, max_boxes, 6]和counts[B]
+        self.next_images, self.next_labels, self.next_paths = batch[:3]
+        self.next_counts = batch[3] if len(batch) > 3 else None
 
         with torch.cuda.stream(self.stream):
             self.input_cuda()
@@ -50,16 +56,22 @@ class DataPrefetcherDet:
         image = self.next_images
         labels = self.next_labels
         path = self.next_paths
+        self.counts = self.next_counts  # 当前batch每张图片的bbox数量, 未填充时为None
         if image is not None:
             self.record_stream(image)
         if labels is not None:
             self.record_stream(labels)
+        if self.counts is not None:
+            self.record_stream(self.counts)
         self.preload()
         return image, labels, path
 
     def _input_cuda_for_image(self):
         self.next_images = self.next_images.cuda(device=self.device, non_blocking=True)
+        self.next_images = self.next_images.contiguous(memory_format=self.memory_format)
         self.next_labels = self.next_labels.cuda(device=self.device, non_blocking=True)
+        if self.next_counts is not None:
+            self.next_counts = self.next_counts.cuda(device=self.device, non_blocking=True)
 
     @staticmethod
     def _record_stream_for_image(input):
@@ -191,8 +203,9 @@ class DataPrefetcherCls:
     dataloader必须设置pin_memory=True来满足第一个条件
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, memory_format=torch.contiguous_format):
         self.loader = iter(loader)
+        self.memory_format = memory_format  # input拷贝到GPU后的内存格式, 例如torch.channels_last
         # CUDA流表示一个GPU操作队列，该队列中的操作将以添加到流中的先后顺序而依次执行
         # 可以将一个流看作时GPU上的一个任务，不同的任务可以并行执行
         self.stream = torch.cuda.Stream()
@@ -229,7 +242,7 @@ class DataPrefetcherCls:
         return input, target, path
 
     def _input_cuda_for_image(self):
-        self.next_input = self.next_input.cuda(non_blocking=True)
+        self.next_input = self.next_input.cuda(non_blocking=True).contiguous(memory_format=self.memory_format)
 
     @staticmethod
     def _record_stream_for_image(input):
@@ -255,8 +268,9 @@ class DataPrefetcherSeg:
     dataloader必须设置pin_memory=True来满足第一个条件
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, memory_format=torch.contiguous_format):
         self.loader = iter(loader)
+        self.memory_format = memory_format  # input拷贝到GPU后的内存格式, 例如torch.channels_last
         # CUDA流表示一个GPU操作队列，该队列中的操作将以添加到流中的先后顺序而依次执行
         # 可以将一个流看作时GPU上的一个任务，不同的任务可以并行执行
         self.stream = torch.cuda.Stream()
@@ -293,7 +307,7 @@ class DataPrefetcherSeg:
         return input, target, path
 
     def _input_cuda_for_image(self):
-        self.next_input = self.next_input.cuda(non_blocking=True)
+        self.next_input = self.next_input.cuda(non_blocking=True).contiguous(memory_format=self.memory_format)
 
     @staticmethod
     def _record_stream_for_image(input):
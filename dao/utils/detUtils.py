@@ -5,6 +5,8 @@
 # @Copy From:
 import numpy as np
 
+from .boxes import box_wh_iou
+
 # We use ignore thresh to decide which anchor box can be kept.
 ignore_thresh = 0.5
 
@@ -30,43 +32,15 @@ def set_anchors(anchor_size):
 
 def compute_iou(anchor_boxes, gt_box):
     """
+    假设anchor和gt中心点对齐(multi_gt_creator中只按宽高匹配anchor), 只使用w, h, c_x_s, c_y_s被忽略
     Input:
         anchor_boxes : ndarray -> [[c_x_s, c_y_s, anchor_w, anchor_h], ..., [c_x_s, c_y_s, anchor_w, anchor_h]].
         gt_box : ndarray -> [c_x_s, c_y_s, anchor_w, anchor_h].
     Output:
         iou : ndarray -> [iou_1, iou_2, ..., iou_m], and m is equal to the number of anchor boxes.
     """
-    # compute the iou between anchor box and gt box
-    # First, change [c_x_s, c_y_s, anchor_w, anchor_h] ->  [xmin, ymin, xmax, ymax]
-    # anchor box :
-    ab_x1y1_x2y2 = np.zeros([len(anchor_boxes), 4])
-    ab_x1y1_x2y2[:, 0] = anchor_boxes[:, 0] - anchor_boxes[:, 2] / 2  # xmin
-    ab_x1y1_x2y2[:, 1] = anchor_boxes[:, 1] - anchor_boxes[:, 3] / 2  # ymin
-    ab_x1y1_x2y2[:, 2] = anchor_boxes[:, 0] + anchor_boxes[:, 2] / 2  # xmax
-    ab_x1y1_x2y2[:, 3] = anchor_boxes[:, 1] + anchor_boxes[:, 3] / 2  # ymax
-    w_ab, h_ab = anchor_boxes[:, 2], anchor_boxes[:, 3]
-
-    # gt_box :
-    # We need to expand gt_box(ndarray) to the shape of anchor_boxes(ndarray), in order to compute IoU easily.
-    gt_box_expand = np.repeat(gt_box, len(anchor_boxes), axis=0)
-
-    gb_x1y1_x2y2 = np.zeros([len(anchor_boxes), 4])
-    gb_x1y1_x2y2[:, 0] = gt_box_expand[:, 0] - gt_box_expand[:, 2] / 2  # xmin
-    gb_x1y1_x2y2[:, 1] = gt_box_expand[:, 1] - gt_box_expand[:, 3] / 2  # ymin
-    gb_x1y1_x2y2[:, 2] = gt_box_expand[:, 0] + gt_box_expand[:, 2] / 2  # xmax
-    gb_x1y1_x2y2[:, 3] = gt_box_expand[:, 1] + gt_box_expand[:, 3] / 2  # ymin
-    w_gt, h_gt = gt_box_expand[:, 2], gt_box_expand[:, 3]
-
-    # Then we compute IoU between anchor_box and gt_box
-    S_gt = w_gt * h_gt
-    S_ab = w_ab * h_ab
-    I_w = np.minimum(gb_x1y1_x2y2[:, 2], ab_x1y1_x2y2[:, 2]) - np.maximum(gb_x1y1_x2y2[:, 0], ab_x1y1_x2y2[:, 0])
-    I_h = np.minimum(gb_x1y1_x2y2[:, 3], ab_x1y1_x2y2[:, 3]) - np.maximum(gb_x1y1_x2y2[:, 1], ab_x1y1_x2y2[:, 1])
-    S_I = I_h * I_w
-    U = S_gt + S_ab - S_I + 1e-20
-    IoU = S_I / U
-
-    return IoU
+    # 中心点对齐(都为0), 只比较宽高
+    return box_wh_iou(anchor_boxes[:, 2:4], np.asarray(gt_box, dtype=np.float64).reshape(-1, 4)[:, 2:4], eps=1e-20)[:, 0]
 
 
 def multi_gt_creator(input_size, strides, label_lists, anchor_size):
@@ -82,6 +56,8 @@ def multi_gt_creator(input_size, strides, label_lists, anchor_size):
     for s in strides:
         gt_tensor.append(np.zeros([batch_size, h // s, w // s, anchor_number, 1 + 1 + 4 + 1 + 4]))
 
+    anchor_boxes = set_anchors(all_anchor_size)     # 所有标注框共用
+
     # generate gt datas
     for batch_index in range(batch_size):
         for gt_label in label_lists[batch_index]:
@@ -99,7 +75,6 @@ def multi_gt_creator(input_size, strides, label_lists, anchor_size):
                 continue
 
                 # compute the IoU
-            anchor_boxes = set_anchors(all_anchor_size)
             gt_box = np.array([[0, 0, box_w, box_h]])
             iou = compute_iou(anchor_boxes, gt_box)
 
@@ -33,6 +33,8 @@ __all__ = [
     "time_synchronized",
     "gather",
     "all_gather",
+    "all_reduce_sum",
+    "all_gather_tensor",
     "find_free_port"
 ]
 
@@ -315,6 +317,43 @@ def gather(data, dst=0, group=None):
         return []
 
 
+def all_reduce_sum(tensor):
+    """
+    Function: 对tensor在所有rank上求和(in-place)，用于汇总验证时的充分统计量(计数、混淆矩阵、直方图等)，
+        相比gather原始输出，只通信固定大小的tensor，不需要pickle。
+        单卡时直接返回。
+
+    :param tensor: torch.Tensor, nccl后端时需在当前GPU上
+    :return: 求和后的tensor
+    """
+    if get_world_size() == 1:
+        return tensor
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_gather_tensor(tensor):
+    """
+    Function: 收集所有rank上第0维长度不同的tensor(例如每个rank验证分片的检测结果)，
+        先all_gather长度，再padding到最大长度all_gather，不需要pickle。单卡时直接返回[tensor]。
+
+    :param tensor: torch.Tensor, 除第0维外形状相同，nccl后端时需在当前GPU上
+    :return: list of torch.Tensor, 按rank排列
+    """
+    if get_world_size() == 1:
+        return [tensor]
+    size = torch.tensor([tensor.shape[0]], dtype=torch.int64, device=tensor.device)
+    sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+
+    padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+    padded[:tensor.shape[0]] = tensor
+    tensors = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(tensors, padded)
+    return [t[:s] for t, s in zip(tensors, sizes)]
+
+
 def shared_random_seed():
     """
     Returns:
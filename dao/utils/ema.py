@@ -7,7 +7,7 @@ from copy import deepcopy
 import torch
 import torch.nn as nn
 
-__all__ = ["ModelEMA", "is_parallel", "EMA"]
+__all__ = ["ModelEMA", "FusedModelEMA", "is_parallel", "EMA"]
 
 
 def is_parallel(model):
@@ -71,6 +71,134 @@ class ModelEMA:
         return torch.load(weights_path)
 
 
+class FusedModelEMA:
+    """
+    与ModelEMA相同的指数移动平均(参数和浮点buffer, decay带warmup), 区别:
+        1. 初始化时缓存ema与model中浮点tensor的列表, update时不再每次构建state_dict;
+        2. 用torch._foreach_mul_/_foreach_add_一次更新所有tensor, 只有几次kernel launch;
+        3. interval>1时每interval次调用才更新一次, decay取interval次方, 近似每次都更新;
+        4. device不为None时ema保存在device上(例如"cpu"), 节省训练卡显存; 每次update时model的tensor先在GPU上拼接成
+           一个flat tensor, 一次non_blocking拷贝到预先分配的pinned buffer(两个buffer交替使用), 记录CUDA event后立即返回,
+           拷贝完成后的foreach更新在下一次update(或synchronize, eval_module)时进行, 训练线程不等待拷贝;
+           读取self.ema之前需要先调用synchronize()
+    """
+
+    def __init__(self, model, decay=0.9999, updates=0, interval=1, device=None):
+        """
+        Args:
+            model (nn.Module): model to apply EMA.
+            decay (float): ema decay reate.
+            updates (int): counter of EMA updates.
+            interval (int): update every interval steps.
+            device (str): device of ema model, None means same as model.
+        """
+        model = model.module if is_parallel(model) else model
+        self.ema = deepcopy(model).eval()
+        if device is not None:
+            self.ema.to(device)
+        self.device = device
+        self.updates = updates
+        self.interval = max(int(interval), 1)
+        # decay exponential ramp (to help early epochs)
+        self.decay = lambda x: decay * (1 - math.exp(-x / 2000))
+        for p in self.ema.parameters():
+            p.requires_grad_(False)
+
+        self._steps = 0
+        self._model = None
+        self._ema_tensors, self._model_tensors = [], []
+        self._staging = []  # device不为None时, 每种dtype一组: (model tensors, 2个flat buffer, 每个buffer中的views, ema tensors)
+        self._slot = 0      # 下一次拷贝使用的buffer
+        self._pending = None    # 已开始拷贝但还没有累加到ema的(buffer, event, decay)
+        self._cache_tensors(model)
+
+    def _cache_tensors(self, model):
+        """
+        按state_dict的key配对ema和model中的浮点tensor, state_dict中的tensor与参数共享存储, 原地更新即可
+        """
+        self.synchronize()  # 之前的拷贝使用旧的staging buffer
+        msd = model.state_dict()
+        self._ema_tensors, self._model_tensors = [], []
+        for k, v in self.ema.state_dict().items():
+            if v.dtype.is_floating_point:
+                self._ema_tensors.append(v)
+                self._model_tensors.append(msd[k].detach())
+        self._model = model
+        self._staging = []
+        if self.device is None or all(t.device == e.device for t, e in zip(self._model_tensors, self._ema_tensors)):
+            return
+
+        # 按dtype分组, 每组预先分配两个flat buffer(从GPU拷贝到cpu时为pinned memory), 一个拷贝时另一个累加到ema
+        groups = {}
+        for e, t in zip(self._ema_tensors, self._model_tensors):
+            groups.setdefault(t.dtype, ([], []))
+            groups[t.dtype][0].append(t)
+            groups[t.dtype][1].append(e)
+        for dtype, (model_tensors, ema_tensors) in groups.items():
+            pin = model_tensors[0].is_cuda and torch.device(self.device).type == "cpu"
+            flats, views = [], []
+            for _ in range(2):
+                flat = torch.empty(sum(t.numel() for t in model_tensors), dtype=dtype, device=self.device, pin_memory=pin)
+                flat_views, offset = [], 0
+                for t in model_tensors:
+                    flat_views.append(flat[offset:offset + t.numel()].view_as(t))
+                    offset += t.numel()
+                flats.append(flat)
+                views.append(flat_views)
+            self._staging.append((model_tensors, flats, views, ema_tensors))
+
+    def update(self, model):
+        self._steps += 1
+        if self._steps % self.interval != 0:
+            return
+        model = model.module if is_parallel(model) else model
+        if model is not self._model:
+            self._cache_tensors(model)
+
+        with torch.no_grad():
+            self.updates += self.interval
+            d = self.decay(self.updates) ** self.interval
+            if not self._staging:
+                torch._foreach_mul_(self._ema_tensors, d)
+                torch._foreach_add_(self._ema_tensors, self._model_tensors, alpha=1.0 - d)
+                return
+            # 每组一次拼接+一次拷贝到当前buffer, 不等待; 然后把上一次(另一个buffer)的拷贝累加到ema
+            slot = self._slot
+            for model_tensors, flats, _, _ in self._staging:
+                flats[slot].copy_(torch.cat([t.reshape(-1) for t in model_tensors]), non_blocking=True)
+            event = None
+            if self._model_tensors[0].is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+            self.synchronize()
+            self._pending = (slot, event, d)
+            self._slot = 1 - slot
+
+    def synchronize(self):
+        """
+        等待最后一次拷贝完成并累加到ema, 读取self.ema(验证, 保存权重)之前调用
+        """
+        if self._pending is None:
+            return
+        slot, event, d = self._pending
+        self._pending = None
+        if event is not None:
+            event.synchronize()     # 通常在上一个训练step中已经完成
+        with torch.no_grad():
+            for _, _, views, ema_tensors in self._staging:
+                torch._foreach_mul_(ema_tensors, d)
+                torch._foreach_add_(ema_tensors, views[slot], alpha=1.0 - d)
+
+    def eval_module(self, device):
+        """
+        返回在device上的ema模型, ema不在device上时返回一份拷贝
+        """
+        self.synchronize()
+        if self.device is None:
+            return self.ema
+        return deepcopy(self.ema).to(device)
+
+
 class EMA:
     def __init__(self, model, decay):
         self.model = model.module if is_parallel(model) else model
@@ -10,6 +10,9 @@ import matplotlib.pyplot as plt
 
 import torch
 
+from .dist import all_reduce_sum
+from .metrics import DeviceAverageMeter, CudaIterTimer
+
 
 __all__ = ['MeterClsTrain', 'MeterClsEval', 'plot_confusion_matrix']
 
@@ -55,12 +58,16 @@ class MeterClsTrain(object):
     def __init__(self):
         self.batch_time = AverageMeter()  # batch训练时间
         self.data_time = AverageMeter()  # 读取数据时间
-        self.total_loss = AverageMeter()    # total loss
-        self.precision_top1, self.precision_top2 = AverageMeter(), AverageMeter()
+        self.timer = CudaIterTimer()    # CUDA event计时, synchronize时更新batch_time, data_time
+        self.total_loss = DeviceAverageMeter()    # total loss, 在device上累加
+        self.precision_top1, self.precision_top2 = DeviceAverageMeter(), DeviceAverageMeter()
         self.lr = 0
 
     def update(self, data_time=None, batch_time=None, total_loss=None,
                outputs=None, targets=None, lr=None):
+        """
+        Function: 更新训练指标, total_loss, outputs, targets为device上的tensor, 不会同步host
+        """
         if batch_time is not None:
             self.batch_time.update(batch_time)
         if data_time is not None:
@@ -69,11 +76,19 @@ class MeterClsTrain(object):
             self.total_loss.update(total_loss)
         if outputs is not None and targets is not None:
             top1, top2 = self._eval_topk(outputs, targets, topk=(1, 2))
-            self.precision_top1.update(top1.item())
-            self.precision_top2.update(top2.item())
+            self.precision_top1.update(top1)
+            self.precision_top2.update(top2)
         if lr is not None:
             self.lr = lr
 
+    def synchronize(self):
+        """
+        Function: log_per_iter时调用, 同步CUDA event计时到batch_time, data_time
+        """
+        for data_time, batch_time in self.timer.summary():
+            self.data_time.update(data_time)
+            self.batch_time.update(batch_time)
+
     def _eval_topk(self, output, target, topk=(1,)):
         """Computes the accuracy over the k top predictions for the specified values of k"""
         with torch.no_grad():
@@ -94,9 +109,8 @@ class MeterClsTrain(object):
         if flag:
             self.batch_time.initialized = False  # batch训练时间
             self.data_time.initialized = False  # 读取数据时间
-            self.total_loss.initialized = False
-            self.precision_top1.initialized = False
-            self.precision_top2.initialized = False
+            self.total_loss = DeviceAverageMeter()
+            self.precision_top1, self.precision_top2 = DeviceAverageMeter(), DeviceAverageMeter()
 
 
 class MeterClsEval(object):
@@ -106,7 +120,9 @@ class MeterClsEval(object):
         self.total_loss = AverageMeter()    # 损失值
         self.precision_top1, self.precision_top2 = AverageMeter(), AverageMeter()   # top1 top2
 
-        self.confusion_matrix = [[0 for j in range(num_class)] for i in range(num_class)]   # 混淆矩阵
+        self.num_class = num_class
+        self.reset_stats()      # 样本数、topk命中数、混淆矩阵([C, C] int64 tensor)，多卡验证时all_reduce
+        self.global_confusion_matrix = torch.zeros(num_class, num_class, dtype=torch.int64)  # reduce_stats后的混淆矩阵
         self.lr = 0     # 学习率
 
     def update(self, data_time=None, batch_time=None, total_loss=None, outputs=None, targets=None, lr=None):
@@ -140,11 +156,91 @@ class MeterClsEval(object):
             return res
 
     def eval_confusionMatrix(self, preds, labels):
+        """
+        用bincount在device上更新[C, C]的int64混淆矩阵(行为label, 列为pred), 不逐样本循环
+        preds:(b, num_class) logits, labels:(b,)
+        """
         preds = torch.argmax(preds, 1)
-        for t, p in zip(labels, preds):
-            self.confusion_matrix[t][p] += 1
+        if self.confusion_matrix is None or self.confusion_matrix.device != preds.device:
+            self.confusion_matrix = torch.zeros(self.num_class, self.num_class, dtype=torch.int64, device=preds.device)
+        self.confusion_matrix += torch.bincount(
+            labels.long() * self.num_class + preds, minlength=self.num_class ** 2
+        ).view(self.num_class, self.num_class)
         return self.confusion_matrix
 
+    def count_topk(self, output, target, topk=(1,)):
+        """Computes the number of correct predictions over the k top predictions, 返回命中个数(long tensor)而不是百分比"""
+        with torch.no_grad():
+            maxk = max(topk)
+            _, pred = output.topk(maxk, 1, True, True)
+            pred = pred.t()
+            correct = pred.eq(target.view(1, -1).expand_as(pred))
+            return torch.stack([correct[:k].sum() for k in topk])
+
+    def reset_stats(self, keep_outputs=False):
+        """
+        重置验证的充分统计量：样本数、topk命中数、混淆矩阵
+        :param keep_outputs: bool 是否保留每个batch的logits(cpu), 默认不保留, 验证显存为O(C²)而不是O(N·C)
+        """
+        self.num_samples = 0
+        self.topk_hits = 0
+        self.confusion_matrix = None    # 第一次update时在outputs的device上创建
+        self.keep_outputs = keep_outputs
+        self.outputs = []
+
+    def update_stats(self, outputs, targets, topk=(1, 2)):
+        """
+        按batch累加充分统计量(都在device上, 不同步host)
+        outputs:(b, num_class) logits, targets:(b,) 与outputs同一device
+        """
+        self.topk_hits = self.count_topk(outputs, targets, topk) + self.topk_hits
+        self.num_samples += targets.size(0)
+        self.eval_confusionMatrix(outputs, targets)
+        if self.keep_outputs:
+            self.outputs.append(outputs.detach().cpu())
+
+    def reduce_stats(self, device=None, topk=(1, 2), distributed=True):
+        """
+        将所有rank的充分统计量打包成一个tensor做一次all_reduce求和，再计算全局指标
+        :param distributed: bool 为False时只用本rank的统计量(例如只在rank0上异步验证)
+        :return: topk准确率列表(百分比)，混淆矩阵(list of list)
+        """
+        # 本rank没有样本时(分片为空)统计量仍为0
+        topk_hits = self.topk_hits if torch.is_tensor(self.topk_hits) else torch.zeros(len(topk), dtype=torch.int64)
+        confusion_matrix = self.confusion_matrix if self.confusion_matrix is not None else \
+            torch.zeros(self.num_class, self.num_class, dtype=torch.int64)
+        stats = torch.cat([
+            torch.tensor([self.num_samples], dtype=torch.int64, device=device),
+            topk_hits.to(device),
+            confusion_matrix.to(device).flatten(),
+        ])
+        if distributed:
+            stats = all_reduce_sum(stats)
+        stats = stats.cpu()
+        num_samples = max(stats[0].item(), 1)
+        precisions = [hits * 100.0 / num_samples for hits in stats[1:1 + len(topk)].tolist()]
+        self.global_confusion_matrix = stats[1 + len(topk):].view(self.num_class, self.num_class)
+        return precisions, self.global_confusion_matrix.tolist()
+
+    def class_metrics(self, confusion_matrix=None):
+        """
+        由混淆矩阵计算每个类别的precision, recall, F1
+        :param confusion_matrix: [C, C] tensor/list, 默认为reduce_stats得到的全局混淆矩阵
+        :return: dict {"precision": [C], "recall": [C], "f1": [C], "support": [C]}
+        """
+        cm = self.global_confusion_matrix if confusion_matrix is None else torch.as_tensor(confusion_matrix)
+        cm = cm.double()
+        tp = cm.diag()
+        precision = tp / cm.sum(0).clamp(min=1)    # 列和: 预测为该类的样本数
+        recall = tp / cm.sum(1).clamp(min=1)       # 行和: 该类的样本数
+        f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+        return {
+            "precision": precision.tolist(),
+            "recall": recall.tolist(),
+            "f1": f1.tolist(),
+            "support": cm.sum(1).long().tolist(),
+        }
+
     def initialized(self, flag=False):
         if flag:
             self.batch_time.initialized = False  # batch训练时间
@@ -8,7 +8,7 @@ from collections import defaultdict, deque
 
 import torch
 
-from .metrics import AverageMeter
+from .metrics import AverageMeter, DeviceAverageMeter, CudaIterTimer
 
 
 __all__ = ['MeterDetTrain', 'MeterDetEval', 'MeterBuffer']
@@ -19,17 +19,29 @@ class MeterDetTrain(object):
         """
         Function:  监控data_time, batch_time,lr, total_loss
         """
+        self.timer = CudaIterTimer()    # CUDA event计时, synchronize时更新batch_time, data_time
         self.reset_metrics()
         self.lr = 0
 
-    def update_metrics(self, data_time=0, batch_time=0, lr=0, total_loss=0):
+    def update_metrics(self, data_time=None, batch_time=None, lr=0, total_loss=None):
         """
-        Function:  更新data_time, batch_time,lr, total_loss
+        Function:  更新data_time, batch_time,lr, total_loss; total_loss为device上的tensor, 不会同步host
         """
-        self.batch_time.update(batch_time)
-        self.data_time.update(data_time)
+        if batch_time is not None:
+            self.batch_time.update(batch_time)
+        if data_time is not None:
+            self.data_time.update(data_time)
         self.lr = lr
-        self.total_loss.update(total_loss)
+        if total_loss is not None:
+            self.total_loss.update(total_loss)
+
+    def synchronize(self):
+        """
+        Function: log_per_iter时调用, 同步CUDA event计时到batch_time, data_time
+        """
+        for data_time, batch_time in self.timer.summary():
+            self.data_time.update(data_time)
+            self.batch_time.update(batch_time)
 
     def reset_metrics(self):
         """
@@ -40,7 +52,7 @@ class MeterDetTrain(object):
         """
         self.batch_time = AverageMeter()    # 训练时间
         self.data_time = AverageMeter()     # 读取数据时间
-        self.total_loss = AverageMeter()    # 损失值
+        self.total_loss = DeviceAverageMeter()    # 损失值, 在device上累加
 
 
 class MeterDetEval(object):
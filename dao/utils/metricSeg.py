@@ -8,6 +8,9 @@ import torch
 import itertools
 import matplotlib.pyplot as plt
 
+from .dist import all_reduce_sum
+from .metrics import DeviceAverageMeter, CudaIterTimer
+
 __all__ = ['MeterSegTrain', 'MeterSegEval']
 
 
@@ -53,15 +56,26 @@ class MeterSegTrain(object):
     监控data_time, batch_time, total_loss, lr
     """
     def __init__(self):
+        self.timer = CudaIterTimer()    # CUDA event计时, synchronize时更新batch_time, data_time
         self.reset_metrics()
         self.lr = 0
 
-    def update_metrics(self, data_time=0, batch_time=0, total_loss=0, lr=0):
-        self.batch_time.update(batch_time)
-        self.data_time.update(data_time)
-        self.total_loss.update(total_loss)
+    def update_metrics(self, data_time=None, batch_time=None, total_loss=None, lr=0):
+        """total_loss为device上的tensor, 不会同步host"""
+        if batch_time is not None:
+            self.batch_time.update(batch_time)
+        if data_time is not None:
+            self.data_time.update(data_time)
+        if total_loss is not None:
+            self.total_loss.update(total_loss)
         self.lr = lr
 
+    def synchronize(self):
+        """log_per_iter时调用, 同步CUDA event计时到batch_time, data_time"""
+        for data_time, batch_time in self.timer.summary():
+            self.data_time.update(data_time)
+            self.batch_time.update(batch_time)
+
     def reset_metrics(self):
         """重置metrics
             1、训练时间：batch_time
@@ -70,70 +84,70 @@ class MeterSegTrain(object):
         """
         self.batch_time = AverageMeter()    # 训练时间
         self.data_time = AverageMeter()  # 读取数据时间
-        self.total_loss = AverageMeter()    # 损失值
+        self.total_loss = DeviceAverageMeter()    # 损失值, 在device上累加
 
 
 class MeterSegEval(object):
+    """
+    分割验证指标: 在device上累加[C, C]的int64混淆矩阵(行为label, 列为pred), 验证结束时all_reduce一次,
+    再由混淆矩阵计算pixAcc, mIoU, 每个类别的IoU, Dice和fwIoU, 多卡验证结果与单卡相同
+    """
     def __init__(self, num_class=38):
+        self.num_classes = num_class
         self.reset_metrics()
         self.lr = 0
-        self.num_classes = num_class
-
-    def update_seg_metrics(self, correct, labeled, inter, union):
-        self.total_correct += correct  # 预测正确的像素点
-        self.total_label += labeled  # 所有像素点
-        self.total_inter += inter  # 21类中的交，即预测正确的像素点（每一个类）, list shape 为21
-        self.total_union += union  # 21类中的并，即预测正确与错误的像素点（每一个类）
-
-    def get_seg_metrics(self):
-        pixAcc = 1.0 * self.total_correct / (np.spacing(1) + self.total_label)  # 预测正确的像素准确率
-        IoU = 1.0 * self.total_inter / (np.spacing(1) + self.total_union)
-        mIoU = IoU.mean()
-        return {
-            "Pixel_Accuracy": np.round(pixAcc, 3),
-            "Mean_IoU": np.round(mIoU, 3),
-            "Class_IoU": dict(zip(range(self.num_classes), np.round(IoU, 3)))
-        }
 
     def reset_metrics(self):
-        """重置metrics
-            1、交：total_inter, 并：total_union
-            2、准确率：total_correct, total_label
+        """重置混淆矩阵, 第一次update时在outputs的device上创建"""
+        self.confusion_matrix = None
+
+    def update_confusion_matrix(self, output, target):
+        """
+        功能：用bincount更新混淆矩阵, 不同步host
+        output(4,21,380,380) logits, target(4,380,380), 不在[0, num_classes)内的像素(例如255轮廓)不参与计算
+        """
+        predict = torch.argmax(output, 1)
+        target = target.long()
+        labeled = (target >= 0) & (target < self.num_classes)
+        if self.confusion_matrix is None or self.confusion_matrix.device != predict.device:
+            self.confusion_matrix = torch.zeros(self.num_classes, self.num_classes,
+                                                dtype=torch.int64, device=predict.device)
+        self.confusion_matrix += torch.bincount(
+            target[labeled] * self.num_classes + predict[labeled], minlength=self.num_classes ** 2
+        ).view(self.num_classes, self.num_classes)
+        return self.confusion_matrix
+
+    def reduce_seg_metrics(self, device=None, distributed=True):
         """
-        self.total_inter, self.total_union = 0, 0  # 交、并
-        self.total_correct, self.total_label = 0, 0  # 准确率
+        将所有rank的混淆矩阵做一次all_reduce求和，之后get_seg_metrics得到的是全局精确的指标, 而不是各rank指标的平均
+        本rank没有样本时(分片为空)混淆矩阵为0
+        """
+        confusion_matrix = self.confusion_matrix if self.confusion_matrix is not None else \
+            torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64)
+        confusion_matrix = confusion_matrix.to(device=device)
+        if distributed:
+            confusion_matrix = all_reduce_sum(confusion_matrix)
+        self.confusion_matrix = confusion_matrix
 
-    def eval_metrics(self, output, target, num_class):
+    def get_seg_metrics(self):
         """
-        功能：计算度量
-        output(4,21,380,380) target(4,380,380) num_class=21
+        :return: dict Pixel_Accuracy, Mean_IoU, Class_IoU, Mean_Dice, Class_Dice, FWIoU;
+            与原来一致, mIoU/mDice是所有类别的平均(没有出现的类别IoU为0)
         """
-        # 分割是预测每个像素，所以每个像素都是一个类别，共380*380个像素。所以predict为（4，380，380），eg. predict[0][1][1]=20 代表第0张图片第（1，1）个像素的类别是20
-        _, predict = torch.max(output.data, 1)
-        predict = predict + 1   # 原来是[0, 20]类，先将背景作为1类，[1, 21] & [256]
-        target = target + 1
-
-        # （4,380,380) 属于正常范围（分类值在【1，21】）内的每个像素. 255(+1后为256）是标注的轮廓，不是object， 所以不属于labeled中
-        labeled = (target > 0) * (target <= num_class)  # torch.Size([4, 380, 380]) True or False(原value是255的）; 即排除原255像素值的mask
-        # 获得标注正确的像素个数，和所有标注的像素个数(除去255）
-        correct, num_labeled = self._batch_pix_accuracy(predict, target, labeled)   # correct为预测正确个数， num_labeled为标签标注像素个数
-        # 获得predict与target的inter(21 length),union(21)
-        inter, union = self._batch_intersection_union(predict, target, num_class,  labeled)
-        return [np.round(correct, 5), np.round(num_labeled, 5), np.round(inter, 5), np.round(union, 5)]
-
-    def _batch_pix_accuracy(self, predict, target, labeled):
-        pixel_labeled = labeled.sum()  # 380*380*batchsize - 像素值为255的个数3228 = 574372
-        pixel_correct = ((predict == target) * labeled).sum()  # 类别标注正确的像素个数
-        assert pixel_correct <= pixel_labeled, "Correct area should be smaller than Labeled"
-        return pixel_correct.cpu().numpy(), pixel_labeled.cpu().numpy()
-
-    def _batch_intersection_union(self, predict, target, num_class, labeled):
-        predict = predict * labeled.long()  # labeled的predict， torch.Size([16, 224, 224])
-        intersection = predict * (predict == target).long()  # 与target一致的predict, 交, 筛选, torch.Size([16, 224, 224])
-
-        area_inter = torch.histc(intersection.float(), bins=num_class, max=num_class, min=1)  # 预测正确的直方图（类别），交
-        area_pred = torch.histc(predict.float(), bins=num_class, max=num_class, min=1)  # 预测的直方图（类别），predict 面积
-        area_lab = torch.histc(target.float(), bins=num_class, max=num_class, min=1)  # 标签的直方图（类别），target面积
-        area_union = area_pred + area_lab - area_inter
-        assert (area_inter <= area_union).all(), "Intersection area should be smaller than Union area"
-        return area_inter.cpu().numpy(), area_union.cpu().numpy()
+        cm = self.confusion_matrix.double().cpu().numpy() if self.confusion_matrix is not None else \
+            np.zeros((self.num_classes, self.num_classes))
+        inter = np.diag(cm)                     # 交, 每个类别预测正确的像素
+        area_lab, area_pred = cm.sum(1), cm.sum(0)
+        union = area_lab + area_pred - inter    # 并
+        pixAcc = inter.sum() / (np.spacing(1) + cm.sum())   # 预测正确的像素准确率
+        IoU = inter / (np.spacing(1) + union)
+        Dice = 2 * inter / (np.spacing(1) + area_lab + area_pred)
+        FWIoU = (area_lab / (np.spacing(1) + cm.sum()) * IoU).sum()    # 按标签像素频率加权的IoU
+        return {
+            "Pixel_Accuracy": np.round(pixAcc, 3),
+            "Mean_IoU": np.round(IoU.mean(), 3),
+            "Class_IoU": dict(zip(range(self.num_classes), np.round(IoU, 3))),
+            "Mean_Dice": np.round(Dice.mean(), 3),
+            "Class_Dice": dict(zip(range(self.num_classes), np.round(Dice, 3))),
+            "FWIoU": np.round(FWIoU, 3),
+        }
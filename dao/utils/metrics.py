@@ -53,6 +53,79 @@ class AverageMeter(object):
         return np.round(self.avg, 5)
 
 
+class DeviceAverageMeter(object):
+    def __init__(self):
+        """
+        Function:
+            在device上累加tensor, 只有读取val/avg时才同步到host, 避免每个iter调用.item()
+        """
+        self.initialized = False
+        self._val = None
+        self._sum = None
+        self.count = 0
+
+    def update(self, val, weight=1):
+        if torch.is_tensor(val):
+            val = val.detach()
+        self._val = val
+        self._sum = val * weight if self._sum is None else self._sum + val * weight
+        self.count = self.count + weight
+        self.initialized = True
+
+    @property
+    def val(self):
+        return None if self._val is None else float(self._val)
+
+    @property
+    def sum(self):
+        return None if self._sum is None else float(self._sum)
+
+    @property
+    def avg(self):
+        return None if self._sum is None else float(self._sum) / self.count
+
+
+class CudaIterTimer(object):
+    def __init__(self):
+        """
+        Function:
+            使用CUDA event记录每个iter的开始、数据就绪、结束, 只在summary时同步一次.
+            event记录在当前stream上, 测得的是GPU实际执行时间, 而不是time.time()测得的kernel下发时间
+        """
+        self._pending = []
+        self._current = None
+
+    @staticmethod
+    def _record():
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def start(self):
+        self._current = [self._record()]
+
+    def data_end(self):
+        self._current.append(self._record())
+
+    def stop(self):
+        self._current.append(self._record())
+        self._pending.append(tuple(self._current))
+        self._current = None
+
+    def summary(self):
+        """
+        Function: 等待最后一个event完成, 返回并清空已记录的iter时间
+        :return: list of (data_time, batch_time), 单位秒
+        """
+        if not self._pending:
+            return []
+        self._pending[-1][-1].synchronize()
+        times = [(start.elapsed_time(data) / 1000., start.elapsed_time(end) / 1000.)
+                 for start, data, end in self._pending]
+        self._pending = []
+        return times
+
+
 def occupy_mem(cuda_device, mem_ratio=0.9):
     """
     pre-allocate gpu memory for training to avoid memory Fragmentation.
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+模型编译(torch.compile / TorchScript), 在配置文件 exp.trainer.compile 中启用, 例如:
+    "compile": {"mode": "max-autotune", "warmup": 3, "input_size": [1, 3, 224, 224], "cache_dir": "/ai/data/compile_cache"}
+编译失败或遇到不支持的算子时退回到原模型(eager), 所以打开此配置总是安全的
+"""
+import os
+from loguru import logger
+
+import torch
+
+__all__ = ['compile_model']
+
+
+def _script(model, input_size):
+    """
+    TorchScript: 先尝试script, 失败时用input_size构造输入trace
+    """
+    try:
+        return torch.jit.script(model)
+    except Exception as e:
+        if input_size is None:
+            raise
+        logger.info("torch.jit.script failed ({}), try torch.jit.trace".format(e))
+        device = next(model.parameters()).device
+        return torch.jit.trace(model, torch.randn(*input_size, device=device))
+
+
+def compile_model(model, mode="default", backend="inductor", dynamic=False, script=False,
+                  warmup=0, input_size=None, cache_dir=None, name="model"):
+    """
+    Function: 编译模型, 返回编译后的模型, 失败时返回原模型
+        编译后的模型与原模型共享参数, 所以DDP, EMA, 保存权重仍使用原模型
+
+    :param model: nn.Module
+    :param mode: str torch.compile的mode, default/reduce-overhead/max-autotune
+    :param backend: str torch.compile的backend
+    :param dynamic: bool 是否动态shape
+    :param script: bool 使用TorchScript而不是torch.compile(torch<2.0时总是使用TorchScript)
+    :param warmup: int 编译后用随机输入前向warmup次, 只在model.eval()时执行, 训练时会改变BN统计量
+    :param input_size: list warmup和trace的输入尺寸, 例如[1, 3, 224, 224]
+    :param cache_dir: str 编译结果缓存目录, torch.compile的inductor缓存, TorchScript保存为{name}.pt
+    :param name: str TorchScript保存的文件名
+    """
+    try:
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)   # 必须在编译前设置
+
+        if script or not hasattr(torch, "compile"):
+            compiled = _script(model, input_size)
+            if cache_dir is not None:
+                torch.jit.save(compiled, os.path.join(cache_dir, "{}.pt".format(name)))
+        else:
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True  # 不支持的算子(graph break/编译错误)退回eager
+            compiled = torch.compile(model, mode=mode, backend=backend, dynamic=dynamic)
+
+        if warmup > 0 and input_size is not None and not model.training:
+            device = next(model.parameters()).device
+            x = torch.randn(*input_size, device=device)
+            with torch.no_grad():
+                for _ in range(warmup):
+                    compiled(x)
+        logger.info("compile model with {}".format("TorchScript" if script or not hasattr(torch, "compile")
+                                                    else "torch.compile(mode={})".format(mode)))
+        return compiled
+    except Exception as e:
+        logger.warning("compile model failed, fallback to eager mode: {}".format(e))
+        return model
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# @Author:FelixFu
+# @Date: 2021.12.17
+# @GitHub:https://github.com/felixfu520
+# @Copy From:
+"""
+推理加速: conv+bn折叠, channels_last内存格式
+    memory_format 在配置文件 exp.trainer.memory_format 中设置, "channels_last" 或 "contiguous"(默认)
+"""
+from loguru import logger
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+__all__ = ['fuse_conv_bn', 'get_memory_format']
+
+_CONV_BN = ((nn.Conv1d, nn.BatchNorm1d), (nn.Conv2d, nn.BatchNorm2d), (nn.Conv3d, nn.BatchNorm3d))
+
+
+def get_memory_format(name=None):
+    """
+    :param name: str "channels_last"/"contiguous", None表示contiguous
+    :return: torch.memory_format
+    """
+    if name is None or name == "contiguous":
+        return torch.contiguous_format
+    if name == "channels_last":
+        return torch.channels_last
+    raise ValueError("memory_format must be channels_last or contiguous, but got {}".format(name))
+
+
+def _is_conv_bn(conv, bn):
+    return any(isinstance(conv, c) and type(bn) is b for c, b in _CONV_BN)
+
+
+def _conv_bn_pairs_fx(model):
+    """
+    用torch.fx追踪计算图, 找到输出只被bn使用的conv, 并且conv和bn都只调用一次
+    """
+    traced = torch.fx.symbolic_trace(model)
+    modules = dict(model.named_modules())
+    calls = {}
+    for node in traced.graph.nodes:
+        if node.op == "call_module":
+            calls[node.target] = calls.get(node.target, 0) + 1
+    pairs = []
+    for node in traced.graph.nodes:
+        if node.op != "call_module" or len(node.args) == 0:
+            continue
+        prev = node.args[0]
+        if not isinstance(prev, torch.fx.Node) or prev.op != "call_module" or len(prev.users) != 1:
+            continue
+        if calls[prev.target] == 1 and calls[node.target] == 1 and \
+                _is_conv_bn(modules[prev.target], modules[node.target]):
+            pairs.append((prev.target, node.target))
+    return pairs
+
+
+def _set_module(model, name, module):
+    parent_name, _, attr = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, attr, module)
+
+
+def fuse_conv_bn(model):
+    """
+    Function: 把bn折叠进前面的conv(原地修改), bn替换为nn.Identity, 模型结构和模块名不变(CAM等按名字取层仍可用)
+        只用于推理, 会把model设为eval模式; torch.fx无法追踪的模型不折叠
+
+    :param model: nn.Module
+    :return: model
+    """
+    model.eval()
+    try:
+        pairs = _conv_bn_pairs_fx(model)
+    except Exception as e:
+        # 没有计算图时无法确认conv的输出只被bn使用(自定义forward可能按下标调用Sequential中的层), 错误的折叠会改变输出
+        logger.warning("torch.fx trace failed ({}), skip conv+bn fusion".format(e))
+        return model
+
+    fused = 0
+    with torch.no_grad():
+        for conv_name, bn_name in pairs:
+            conv, bn = model.get_submodule(conv_name), model.get_submodule(bn_name)
+            if not bn.track_running_stats or bn.running_mean is None:
+                continue
+            _set_module(model, conv_name, fuse_conv_bn_eval(conv, bn))
+            _set_module(model, bn_name, nn.Identity())
+            fused += 1
+    logger.info("fuse {} conv+bn".format(fused))
+    return model
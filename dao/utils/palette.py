@@ -5,6 +5,7 @@
 # @github:https://github.com/felixfu520
 import PIL
 import numpy as np
+from functools import lru_cache
 
 
 def get_palette(num_classes):
@@ -38,3 +39,21 @@ def colorize_mask(mask, palette):
     new_mask = PIL.Image.fromarray(mask.astype(np.uint8)).convert('P')
     new_mask.putpalette(palette)
     return new_mask
+
+
+@lru_cache(maxsize=None)
+def get_palette_lut(num_classes):
+    """
+    功能：缓存的调色板查找表, 补零到256色, 返回bytes(768), 可直接用于Image.putpalette, 多线程共享
+    """
+    palette = get_palette(num_classes)[:256 * 3]
+    return bytes(palette + [0] * (256 * 3 - len(palette)))
+
+
+def colorize_mask_lut(mask, lut):
+    """
+    功能：用get_palette_lut的查找表为mask图(uint8)填充颜色, 不重新计算调色板
+    """
+    new_mask = PIL.Image.fromarray(mask.astype(np.uint8, copy=False)).convert('P')
+    new_mask.putpalette(lut)
+    return new_mask
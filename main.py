@@ -214,8 +214,8 @@ def main_worker(modules_file, custom_file, parsers):
     exp = DotMap(json.load(open(modules_file)))   # load config.json
     # 判断status是否满足要求
     status = exp['fullName'].split("-")[-2]
-    assert status in ("trainval", "eval", "demo", "export"), \
-        logger.error("This status {} is not supported, now supported trainval, eval, demo, export".format(status))
+    assert status in ("trainval", "eval", "demo", "export", "analysis"), \
+        logger.error("This status {} is not supported, now supported trainval, eval, demo, export, analysis".format(status))
     # 初始化trainer类，并开始训练
     trainer = Registers.trainers.get(exp.trainer.type)(exp, parsers)    # exp modules组件配置字典;parsers 命令行参数
     trainer.run()